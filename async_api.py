@@ -0,0 +1,121 @@
+"""
+Non-blocking variants of the APIs in functions.py.
+
+Every API call blocks its thread on psycopg2, so a front end that serves a
+request with several independent reads pays for them one after the other.
+AsyncAPI runs the calls on a pool of worker threads, each with its own pooled
+connection, and hands back a handle right away:
+
+    import paper.async_api as async_api
+    api = async_api.configure(maxconn=20, dsn="dbname=paper")
+    timeline = api.get_timeline(uname="foo")
+    tags = api.get_most_popular_tags(count=10)
+    (status, papers), (status2, counts) = async_api.gather([timeline, tags])
+
+Calls take the same arguments as the APIs without conn, and a handle's get()
+returns the same (status, res) the API returns, or (DB_ERROR, None) like
+pool.call_db. Calls issued by one thread are not ordered with respect to
+each other; wait for a write before issuing a read that depends on it.
+
+The web front end this was asked for is asyncio based, but this code base is
+Python 2 and psycopg2 only, so the handles are multiprocessing AsyncResults.
+An asyncio caller can still await them via loop.run_in_executor(None, get).
+"""
+
+import inspect
+
+from multiprocessing.pool import ThreadPool
+
+import functions
+import pool as db_pool
+
+
+class AsyncAPI(object):
+    """
+    Runs the APIs of functions.py on worker threads with pooled connections.
+
+    :param pool: A pool.ConnectionPool, the one configured in pool by default
+    :param workers: Number of worker threads, the pool's maxconn by default
+    """
+
+    def __init__(self, pool=None, workers=None):
+        if pool is None:
+            pool = db_pool.get_pool()
+        self.pool = pool
+        # more workers than connections would only wait for checkouts
+        self._workers = ThreadPool(workers or pool.maxconn)
+
+    def submit(self, func, argdict):
+        """
+        Start an API call.
+
+        :param func: An API from functions.py
+        :param argdict: A dict of keyword arguments for the API, without conn
+        :return: A handle whose get() returns the (status, res) of the call
+        """
+        return self._workers.apply_async(db_pool.call_db, (func, argdict, self.pool))
+
+    def __getattr__(self, name):
+        if name not in functions.API:
+            raise AttributeError(name)
+        func = getattr(functions, name)
+
+        # bind against the API itself, not the (conn, *args, **kwargs) of
+        # the results.cached and instrument wrappers around it
+        api = func
+        while hasattr(api, '__wrapped__'):
+            api = api.__wrapped__
+
+        def call(*args, **kwargs):
+            argdict = inspect.getcallargs(api, None, *args, **kwargs)
+            del argdict['conn']
+            return self.submit(func, argdict)
+        call.__name__ = name
+        call.__doc__ = func.__doc__
+        return call
+
+    def close(self):
+        """
+        Wait for the calls in flight and stop the worker threads. The
+        connection pool is left open.
+        """
+        self._workers.close()
+        self._workers.join()
+
+
+def gather(handles, timeout=None):
+    """
+    Wait for several calls.
+
+    :param handles: A list of handles returned by AsyncAPI calls
+    :param timeout: Seconds to wait for each call, None to wait forever
+    :return: A list of their (status, res), in the order of handles
+    """
+    return [handle.get(timeout) for handle in handles]
+
+
+_api = None
+
+
+def configure(workers=None, **kwargs):
+    """
+    Create the AsyncAPI used by get_api, with a connection pool of its own.
+    Takes the same arguments as pool.ConnectionPool, plus workers.
+    """
+    global _api
+    if _api is not None:
+        _api.close()
+        _api.pool.closeall()
+    _api = AsyncAPI(db_pool.ConnectionPool(**kwargs), workers)
+    return _api
+
+
+def get_api():
+    """
+    Get the AsyncAPI set up by configure, creating one on the pool used by
+    pool.call_db if configure has not been called.
+    """
+    global _api
+    if _api is None:
+        _api = AsyncAPI()
+    return _api
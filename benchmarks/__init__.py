@@ -0,0 +1,10 @@
+"""
+Benchmarks of the APIs in functions.py. They need a database they are allowed
+to wipe and are run from the directory containing the paper package, e.g.
+
+    python -m paper.benchmarks.harness --dsn "dbname=paper_bench" --scales small
+
+generate.py makes the synthetic data, harness.py times every API at several
+scales and compares against JSON baselines, and the other modules benchmark a
+single optimization.
+"""
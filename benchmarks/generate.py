@@ -0,0 +1,201 @@
+"""
+Seeded generator of synthetic users, papers, tags and likes.
+
+Popularity follows Zipf's law everywhere it matters to the queries: a few
+users post and like most of the papers, a few tags are on most papers, a few
+words make up most of the texts and a few papers get most of the likes. Which
+user, tag or paper is popular is shuffled by the seed, so popularity does not
+correlate with names or pids.
+
+The records are generated lazily in the format of bulk_load, so even the
+largest scales are loaded without holding them in memory:
+
+    python -m paper.benchmarks.generate --dsn "dbname=paper_bench" --scale medium
+"""
+
+import bisect
+import json
+import random
+import sys
+
+from datetime import datetime, timedelta
+
+
+# Sizes of the predefined scales
+SCALES = {
+    'small': {'users': 1000, 'papers': 10000, 'likes': 10000, 'tags': 200},
+    'medium': {'users': 10000, 'papers': 100000, 'likes': 100000, 'tags': 1000},
+    'large': {'users': 50000, 'papers': 200000, 'likes': 1000000, 'tags': 5000},
+}
+
+# Zipf exponent used when none is given
+ZIPF_EXPONENT = 1.1
+# Number of distinct words the titles, descriptions and texts are made of
+VOCABULARY = 5000
+
+START_TIME = datetime(2016, 1, 1)
+
+
+class Zipf(object):
+    """
+    Sampler of items whose probabilities follow Zipf's law.
+
+    :param items: A list of items, popularity is assigned in a random order
+    :param exponent: The exponent s, the item of rank k has weight 1 / k^s
+    :param rng: A random.Random
+    """
+
+    def __init__(self, items, exponent, rng):
+        self.items = list(items)
+        rng.shuffle(self.items)
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, len(self.items) + 1):
+            total += 1.0 / rank ** exponent
+            self.cumulative.append(total)
+        self.total = total
+
+    def sample(self):
+        index = bisect.bisect_left(self.cumulative, self.rng.random() * self.total)
+        return self.items[min(index, len(self.items) - 1)]
+
+    def sample_distinct(self, count):
+        """
+        Sample up to count different items
+        """
+        chosen = []
+        for i in range(4 * count):
+            item = self.sample()
+            if item not in chosen:
+                chosen.append(item)
+                if len(chosen) == count:
+                    break
+        return chosen
+
+
+def usernames(users):
+    return ['user%d' % i for i in range(users)]
+
+
+def tagnames(tags):
+    return ['tag%d' % i for i in range(tags)]
+
+
+def words(vocabulary=VOCABULARY):
+    return ['word%d' % i for i in range(vocabulary)]
+
+
+def generate(users, papers, likes, tags, seed=0, exponent=ZIPF_EXPONENT):
+    """
+    Generate a dataset.
+
+    :param users, papers, likes, tags: Ints of how many rows to generate; likes
+        that turn out to be duplicates or self likes are skipped by the loader
+    :param seed: Seed of the random generator
+    :param exponent: Zipf exponent of every popularity distribution
+    :return: A dict of 'users', 'papers' and 'likes' generators of JSONL lines
+    """
+    unames = usernames(users)
+
+    def user_lines():
+        for u in unames:
+            yield json.dumps({'username': u, 'password': u})
+
+    def paper_lines():
+        rng = random.Random(seed)
+        authors = Zipf(unames, exponent, rng)
+        tag_pick = Zipf(tagnames(tags), exponent, rng)
+        word_pick = Zipf(words(), exponent, rng)
+        for i in range(papers):
+            yield json.dumps({
+                'key': str(i),
+                'username': authors.sample(),
+                'title': ' '.join(word_pick.sample() for j in range(4)),
+                'description': ' '.join(word_pick.sample() for j in range(20)),
+                'text': ' '.join(word_pick.sample() for j in range(100)),
+                'tags': tag_pick.sample_distinct(rng.randint(1, 5)),
+                'begin_time': str(START_TIME + timedelta(minutes=i)),
+            })
+
+    def like_lines():
+        rng = random.Random(seed + 1)
+        likers = Zipf(unames, exponent, rng)
+        liked = Zipf(range(papers), exponent, rng)
+        for i in range(likes):
+            key = liked.sample()
+            # a paper is liked after it was posted
+            minutes = key + rng.randrange(papers + 1)
+            yield json.dumps({
+                'username': likers.sample(),
+                'key': str(key),
+                'like_time': str(START_TIME + timedelta(minutes=minutes)),
+            })
+
+    return {'users': user_lines(), 'papers': paper_lines(), 'likes': like_lines()}
+
+
+def load(conn, users, papers, likes, tags, seed=0, exponent=ZIPF_EXPONENT):
+    """
+    Generate a dataset, bulk load it and ANALYZE the tables.
+
+    :param conn: A postgres database connection object
+    :return: The (status, report) of bulk_load.bulk_load
+    """
+    import paper.bulk_load as bulk_load
+
+    streams = generate(users, papers, likes, tags, seed, exponent)
+    status, report = bulk_load.bulk_load(conn, **streams)
+    if status == 0:
+        conn.autocommit = True
+        try:
+            cur = conn.cursor()
+            cur.execute("VACUUM ANALYZE;")
+        finally:
+            conn.autocommit = False
+    return status, report
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    import psycopg2 as psy
+
+    import paper.functions as funcs
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset")
+    parser.add_argument('--dsn', default='', help="libpq connection string")
+    parser.add_argument('--scale', default='small', choices=sorted(SCALES))
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--papers', type=int)
+    parser.add_argument('--likes', type=int)
+    parser.add_argument('--tags', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--exponent', type=float, default=ZIPF_EXPONENT)
+    parser.add_argument('--out', help="write JSONL files to this directory "
+                                      "instead of resetting and loading the database")
+    args = parser.parse_args()
+
+    sizes = dict(SCALES[args.scale])
+    for name in sizes:
+        if getattr(args, name) is not None:
+            sizes[name] = getattr(args, name)
+    if args.out:
+        streams = generate(seed=args.seed, exponent=args.exponent, **sizes)
+        for name in ('users', 'papers', 'likes'):
+            with open(os.path.join(args.out, name + '.jsonl'), 'w') as f:
+                for line in streams[name]:
+                    f.write(line + '\n')
+        sys.exit(0)
+    conn = psy.connect(args.dsn)
+    try:
+        funcs.reset_db(conn)
+        status, report = load(conn, seed=args.seed, exponent=args.exponent, **sizes)
+    finally:
+        conn.close()
+    if status != 0:
+        print "loading synthetic data failed"
+        sys.exit(1)
+    print "%d rows in %.2fs (%.0f rows/sec)" % (
+        sum(report['rows'].values()), report['seconds'], report['rows_per_sec'])
@@ -0,0 +1,282 @@
+"""
+Latency benchmark of every API in ALL_FUNCS at several data scales.
+
+For each scale the database is reset and loaded with a synthetic dataset from
+generate.py, then every API is called a number of times with arguments drawn
+from the data. The p50/p95/p99 latencies and the average number of rows
+returned are printed and can be saved as a JSON baseline. A later run with
+--compare flags every API whose p50 or p95 got slower than the baseline by
+more than the threshold:
+
+    python -m paper.benchmarks.harness --dsn "dbname=paper_bench" \\
+        --scales small medium --save baseline.json
+    python -m paper.benchmarks.harness --dsn "dbname=paper_bench" \\
+        --scales small medium --compare baseline.json --threshold 0.2
+
+Writes are balanced so the data stays the same while the reads are timed:
+delete_paper deletes the papers added by add_new_paper and unlike_paper
+takes back the likes of like_paper. reset_db wipes everything and is timed
+last. The result and recommendation caches are bypassed unless --cache is
+given, so the numbers are those of the queries.
+"""
+
+import json
+import random
+import sys
+import time
+
+import paper.benchmarks.generate as generate
+import paper.functions as funcs
+import paper.recommend as recommend
+import paper.results as results
+
+from paper.customize_checker import ALL_FUNCS
+
+
+# Number of calls per API and scale
+ITERATIONS = 200
+# Relative slowdown reported as a regression
+THRESHOLD = 0.2
+# Slowdowns smaller than this many seconds are noise, whatever the ratio
+MIN_DELTA = 0.0005
+
+# APIs that have to run after the one that creates their input
+_AFTER = {'delete_paper': 'add_new_paper', 'unlike_paper': 'like_paper'}
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def _rows(res):
+    """
+    Number of rows in the res of an API
+    """
+    if res is None:
+        return 0
+    if isinstance(res, list):
+        return len(res)
+    if isinstance(res, tuple) and len(res) == 2 and isinstance(res[0], list):
+        return len(res[0])
+    return 1
+
+
+class Workload(object):
+    """
+    Draws API arguments from the loaded data and keeps track of the rows
+    the write APIs created, so they can be removed again.
+    """
+
+    def __init__(self, conn, seed=0):
+        self.rng = random.Random(seed)
+        cur = conn.cursor()
+        cur.execute("SELECT username FROM users;")
+        self.unames = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT pid FROM papers;")
+        self.pids = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT tagname FROM tag_counts;")
+        self.tags = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT MIN(begin_time), MAX(begin_time) FROM papers;")
+        self.first, self.last = cur.fetchone()
+        conn.rollback()
+        self.words = generate.words()
+        self.added = []
+        self.liked = []
+        self.signups = 0
+
+    def args(self, name):
+        """
+        Get the keyword arguments of the next call of an API
+        """
+        rng = self.rng
+        if name == 'signup':
+            self.signups += 1
+            return {'uname': 'bench%d' % self.signups, 'pwd': 'bench'}
+        if name == 'login':
+            uname = rng.choice(self.unames)
+            return {'uname': uname, 'pwd': uname}
+        if name == 'add_new_paper':
+            return {'uname': rng.choice(self.unames), 'title': 'benchmark',
+                    'desc': 'benchmark paper',
+                    'text': ' '.join(rng.choice(self.words) for i in range(100)),
+                    'tags': rng.sample(self.tags, min(3, len(self.tags)))}
+        if name == 'delete_paper':
+            return {'pid': self.added.pop() if self.added else -1}
+        if name == 'like_paper':
+            return {'uname': rng.choice(self.unames), 'pid': rng.choice(self.pids)}
+        if name == 'unlike_paper':
+            uname, pid = self.liked.pop() if self.liked else ('', -1)
+            return {'uname': uname, 'pid': pid}
+        if name in ('get_paper_tags', 'get_likes'):
+            return {'pid': rng.choice(self.pids)}
+        if name in ('get_timeline', 'get_papers_by_liked', 'get_recommend_papers',
+                    'get_number_papers_user', 'get_number_tags_user',
+                    'get_number_liked_user'):
+            return {'uname': rng.choice(self.unames)}
+        if name == 'get_papers_by_tag':
+            return {'tag': rng.choice(self.tags)}
+        if name == 'get_papers_by_keyword':
+            return {'keyword': rng.choice(self.words)}
+        if name == 'get_most_popular_papers':
+            # somewhere in the last tenth of the time range
+            span = self.last - self.first
+            return {'begin_time': self.last - span * rng.random() / 10}
+        if name in ('get_most_active_users', 'get_most_popular_tags',
+                    'get_most_popular_tag_pairs', 'get_timeline_all'):
+            return {'count': 10}
+        return {}
+
+    def record(self, name, args, status, res):
+        """
+        Remember what a successful write created
+        """
+        if status != 0:
+            return
+        if name == 'add_new_paper':
+            self.added.append(res)
+        elif name == 'like_paper':
+            self.liked.append((args['uname'], args['pid']))
+
+
+def measure(conn, name, workload, iterations, cache=False):
+    """
+    Time an API.
+
+    :return: A dict with the 'p50', 'p95', 'p99' and 'mean' latency in seconds,
+             the average number of 'rows' returned and the number of 'failures'
+    """
+    func = getattr(funcs, name)
+    samples = []
+    rows = 0
+    failures = 0
+    for i in range(iterations if name != 'reset_db' else 1):
+        args = workload.args(name)
+        if not cache:
+            recommend.clear()
+        start = time.time()
+        status, res = func(conn, **args)
+        samples.append(time.time() - start)
+        conn.rollback()
+        workload.record(name, args, status, res)
+        rows += _rows(res)
+        if status != 0:
+            failures += 1
+    return {
+        'p50': percentile(samples, 0.5),
+        'p95': percentile(samples, 0.95),
+        'p99': percentile(samples, 0.99),
+        'mean': sum(samples) / len(samples),
+        'rows': float(rows) / len(samples),
+        'failures': failures,
+    }
+
+
+def run(conn, scales, iterations=ITERATIONS, seed=0, cache=False, names=None):
+    """
+    Benchmark the APIs at several scales.
+
+    :param conn: A postgres database connection object, its database is wiped
+    :param scales: A list of scale names of generate.SCALES
+    :param iterations: Number of calls per API
+    :param seed: Seed of the data and of the arguments
+    :param cache: Whether the result caches are used
+    :param names: The APIs to time, ALL_FUNCS by default
+    :return: (status, retval)
+        (0, {scale: {api: stats, ...}, ...})    Success
+        (1, None)                               Loading a scale failed
+    """
+    if names is None:
+        names = ALL_FUNCS
+    # producers before their consumers, and reset_db at the very end
+    names = sorted(names, key=lambda n: (n == 'reset_db', n in _AFTER))
+    results.set_enabled(cache)
+    report = {}
+    for scale in scales:
+        funcs.reset_db(conn)
+        status, loaded = generate.load(conn, seed=seed, **generate.SCALES[scale])
+        if status != 0:
+            return 1, None
+        workload = Workload(conn, seed)
+        report[scale] = dict((name, measure(conn, name, workload, iterations, cache))
+                             for name in names)
+    return 0, report
+
+
+def compare(report, baseline, threshold=THRESHOLD, min_delta=MIN_DELTA):
+    """
+    Find the APIs that got slower than in a baseline.
+
+    :param report: The report of run()
+    :param baseline: The report of an earlier run()
+    :param threshold: Relative slowdown of p50 or p95 counted as a regression
+    :param min_delta: Slowdowns below this many seconds are ignored
+    :return: A list of (scale, api, percentile, baseline seconds, current seconds)
+    """
+    regressions = []
+    for scale in sorted(report):
+        for name in sorted(report[scale]):
+            old = baseline.get(scale, {}).get(name)
+            if old is None:
+                continue
+            new = report[scale][name]
+            for key in ('p50', 'p95'):
+                if new[key] > old[key] * (1 + threshold) and new[key] - old[key] > min_delta:
+                    regressions.append((scale, name, key, old[key], new[key]))
+    return regressions
+
+
+def print_report(report):
+    maxlen = len(max(ALL_FUNCS, key=len))
+    for scale in sorted(report):
+        print "[%s]" % scale
+        print "%s %9s %9s %9s %8s %8s" % ("api".ljust(maxlen), "p50 ms", "p95 ms",
+                                         "p99 ms", "rows", "failed")
+        for name in sorted(report[scale]):
+            stats = report[scale][name]
+            print "%s %9.3f %9.3f %9.3f %8.1f %8d" % (
+                name.ljust(maxlen), 1000 * stats['p50'], 1000 * stats['p95'],
+                1000 * stats['p99'], stats['rows'], stats['failures'])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import psycopg2 as psy
+
+    parser = argparse.ArgumentParser(description="Benchmark the APIs at several scales")
+    parser.add_argument('--dsn', default='', help="libpq connection string of a "
+                                                  "database that may be wiped")
+    parser.add_argument('--scales', nargs='+', default=['small'],
+                        choices=sorted(generate.SCALES))
+    parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', action='store_true', help="keep the result caches on")
+    parser.add_argument('--only', nargs='+', choices=ALL_FUNCS, help="APIs to time")
+    parser.add_argument('--save', help="write the report to this JSON file")
+    parser.add_argument('--compare', help="compare against this JSON baseline")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    args = parser.parse_args()
+
+    conn = psy.connect(args.dsn)
+    try:
+        status, report = run(conn, args.scales, args.iterations, args.seed,
+                             args.cache, args.only)
+    finally:
+        conn.close()
+    if status != 0:
+        print "loading synthetic data failed"
+        sys.exit(1)
+    print_report(report)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        for scale, name, key, old, new in regressions:
+            print "REGRESSION [%s] %s %s: %.3fms -> %.3fms (+%.0f%%)" % (
+                scale, name, key, 1000 * old, 1000 * new, 100 * (new / old - 1))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,108 @@
+"""
+Throughput of replaying queued likes: one like_paper (and unlike_paper) call
+per event against like_papers_bulk (and unlike_papers_bulk) in batches. The
+same random events are replayed both ways, and every pass is undone by the
+matching unlike pass, so both start from the same data. The statuses of both
+ways are checked to agree. The result cache is turned off.
+"""
+
+import random
+import sys
+import time
+
+import psycopg2 as psy
+
+import paper.functions as funcs
+import paper.migrations as migrations
+import paper.results as results
+
+
+def events(conn, count, seed=0):
+    """
+    Draw random (uname, pid) events, some of them self likes or repeated.
+    Pairs that are already liked are left out, or the unlike passes would
+    remove likes the like passes did not add.
+    """
+    rng = random.Random(seed)
+    cur = conn.cursor()
+    cur.execute("SELECT username FROM users;")
+    unames = [row[0] for row in cur.fetchall()]
+    cur.execute("SELECT pid FROM papers;")
+    pids = [row[0] for row in cur.fetchall()]
+    cur.execute("SELECT username, pid FROM likes;")
+    liked = set(cur.fetchall())
+    conn.rollback()
+    drawn = []
+    while len(drawn) < count:
+        event = (rng.choice(unames), rng.choice(pids))
+        if event not in liked:
+            drawn.append(event)
+    return drawn
+
+
+def per_event(conn, func, events):
+    return [func(conn, uname, pid)[0] for uname, pid in events]
+
+
+def bulk(conn, func, events, batch):
+    statuses = []
+    for start in range(0, len(events), batch):
+        status, res = func(conn, events[start:start + batch])
+        if status != 0:
+            return None
+        statuses.extend(res)
+    return statuses
+
+
+def run(conn, count=10000, batch=1000, seed=0):
+    """
+    :return: A dict of events per second for 'like', 'unlike', 'like_bulk' and
+             'unlike_bulk', and whether the statuses of both ways 'agree'
+    """
+    todo = events(conn, count, seed)
+    rates = {}
+    statuses = {}
+    for name, call in (
+            ('like', lambda: per_event(conn, funcs.like_paper, todo)),
+            ('unlike', lambda: per_event(conn, funcs.unlike_paper, todo)),
+            ('like_bulk', lambda: bulk(conn, funcs.like_papers_bulk, todo, batch)),
+            ('unlike_bulk', lambda: bulk(conn, funcs.unlike_papers_bulk, todo, batch))):
+        start = time.time()
+        statuses[name] = call()
+        seconds = time.time() - start
+        rates[name] = count / seconds if seconds > 0 else float(count)
+    rates['agree'] = (statuses['like'] == statuses['like_bulk']
+                      and statuses['unlike'] == statuses['unlike_bulk'])
+    return rates
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark like_papers_bulk")
+    parser.add_argument('--dsn', default='', help="libpq connection string")
+    parser.add_argument('--seed', action='store_true',
+                        help="reset the database and load synthetic data first")
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--batch', type=int, default=1000, help="events per bulk call")
+    args = parser.parse_args()
+
+    results.set_enabled(False)
+    conn = psy.connect(args.dsn)
+    try:
+        if args.seed:
+            funcs.reset_db(conn)
+            status, report = migrations.seed_synthetic(conn)
+            if status != 0:
+                print "loading synthetic data failed"
+                sys.exit(1)
+        report = run(conn, args.events, args.batch)
+    finally:
+        conn.close()
+    for name in ('like', 'unlike', 'like_bulk', 'unlike_bulk'):
+        print "%-11s %10.0f events/sec" % (name, report[name])
+    print "speedup     like %.1fx  unlike %.1fx" % (
+        report['like_bulk'] / report['like'], report['unlike_bulk'] / report['unlike'])
+    if not report['agree']:
+        print "the bulk statuses differ from the per-event ones"
+        sys.exit(1)
@@ -0,0 +1,117 @@
+"""
+Latency of tag autocomplete: suggest_tags, served from the in-process index
+of tag_index.py, against the LIKE 'prefix%' query it replaces. Prefixes are
+cut from random tag names, so short ones match many tags. Every suggestion
+is checked to match the SQL result.
+
+The index is timed twice: 'index_cold' asks for every prefix once, so each
+call computes its prefix, and 'index' asks again from the memo:
+
+    python -m paper.benchmarks.tag_suggest --dsn "dbname=paper_bench" \\
+        --seed --tags 100000
+"""
+
+import random
+import sys
+import time
+
+import psycopg2 as psy
+
+import paper.functions as funcs
+import paper.migrations as migrations
+import paper.tag_index as tag_index
+
+from paper.benchmarks.harness import percentile
+
+
+def sql_suggest(conn, prefix, count):
+    """
+    The LIKE fallback, ordering ties like the index does
+    """
+    cur = conn.cursor()
+    pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    cur.execute("SELECT tagname, count FROM tag_counts WHERE tagname LIKE %s \
+        ORDER BY count DESC, tagname COLLATE \"C\" LIMIT %s;", (pattern, count))
+    tags = cur.fetchall()
+    conn.rollback()
+    return tags
+
+
+def prefixes(conn, count, seed=0):
+    """
+    Draw distinct prefixes of random tag names, of every length
+    """
+    rng = random.Random(seed)
+    cur = conn.cursor()
+    cur.execute("SELECT tagname FROM tag_counts;")
+    tagnames = [row[0] for row in cur.fetchall()]
+    conn.rollback()
+    drawn = set()
+    for i in range(10 * count):
+        tag = rng.choice(tagnames)
+        drawn.add(tag[:rng.randint(1, len(tag))])
+        if len(drawn) >= count:
+            break
+    return sorted(drawn)
+
+
+def run(conn, count=10, distinct=1000, seed=0):
+    """
+    :return: A dict of 'sql', 'index_cold' and 'index' latency samples in
+             seconds, the seconds the index took to 'load' and the number of
+             'mismatches'
+    """
+    todo = prefixes(conn, distinct, seed)
+    tag_index.clear()
+    start = time.time()
+    funcs.suggest_tags(conn, '', count)
+    report = {'load': time.time() - start, 'sql': [], 'index_cold': [], 'index': []}
+    conn.rollback()
+    expected = {}
+    for prefix in todo:
+        start = time.time()
+        expected[prefix] = sql_suggest(conn, prefix, count)
+        report['sql'].append(time.time() - start)
+    mismatches = 0
+    for name in ('index_cold', 'index'):
+        for prefix in todo:
+            start = time.time()
+            status, tags = funcs.suggest_tags(conn, prefix, count)
+            report[name].append(time.time() - start)
+            if status != 0 or tags != expected[prefix]:
+                mismatches += 1
+    report['mismatches'] = mismatches
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark suggest_tags")
+    parser.add_argument('--dsn', default='', help="libpq connection string")
+    parser.add_argument('--seed', action='store_true',
+                        help="reset the database and load synthetic data first")
+    parser.add_argument('--tags', type=int, default=100000,
+                        help="distinct tags of the synthetic data")
+    parser.add_argument('--prefixes', type=int, default=1000, help="distinct prefixes")
+    parser.add_argument('--count', type=int, default=10, help="tags per suggestion")
+    args = parser.parse_args()
+
+    conn = psy.connect(args.dsn)
+    try:
+        if args.seed:
+            funcs.reset_db(conn)
+            status, report = migrations.seed_synthetic(conn, likes=0, tags=args.tags)
+            if status != 0:
+                print "loading synthetic data failed"
+                sys.exit(1)
+        report = run(conn, args.count, args.prefixes)
+    finally:
+        conn.close()
+    print "index load  %10.3fms" % (1000 * report['load'])
+    for name in ('sql', 'index_cold', 'index'):
+        print "%-11s p50 %9.3fms  p95 %9.3fms" % (
+            name, 1000 * percentile(report[name], 0.5), 1000 * percentile(report[name], 0.95))
+    if report['mismatches']:
+        print "%d suggestions differ from the SQL ones" % report['mismatches']
+        sys.exit(1)
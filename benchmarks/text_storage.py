@@ -0,0 +1,200 @@
+"""
+Paper rows with their texts inline against the texts in the content-addressed
+paper_texts table of migration 8.
+
+The database is reset to the latest schema but with the texts inline, i.e.
+every migration except 8, and filled with papers, a share of which repeat
+the text of another paper. Timeline throughput and table sizes are measured,
+the database is migrated to the latest version, which applies migration 8
+(and VACUUM FULL gives back the space of the dropped column), and
+everything is measured again:
+
+    python -m paper.benchmarks.text_storage --dsn "dbname=paper_bench" \\
+        --papers 100000 --words 300 --duplicates 0.5
+
+The result cache is turned off, so every call reaches the database.
+"""
+
+import random
+import sys
+import time
+
+import psycopg2 as psy
+
+import paper.functions as funcs
+import paper.migrations as migrations
+import paper.results as results
+import paper.streaming as streaming
+
+from paper.benchmarks.harness import percentile
+
+
+# The migration moving the texts out of papers
+TEXT_VERSION = 8
+
+
+def load_inline(conn, users, papers, words, duplicates, tags):
+    """
+    Wipe the database, build the latest schema without TEXT_VERSION and
+    generate the papers in SQL, since bulk_load writes the current schema.
+
+    :param duplicates: The share of papers whose text is also used by another
+    :return: (status, retval) of migrations.migrate
+    """
+    cur = conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS schema_version, co_likes, tag_pair_counts, tag_counts, \
+        tags, tagnames, like_buckets, likes, papers, paper_texts, users CASCADE;")
+    conn.commit()
+    status, applied = migrations.migrate(conn, TEXT_VERSION - 1)
+    if status != 0:
+        return status, applied
+    _apply_later(conn)
+    distinct = max(1, int(papers * (1 - duplicates)))
+    cur.execute("INSERT INTO users SELECT 'user' || i, 'user' || i \
+        FROM generate_series(0, %s - 1) i;", (users,))
+    # the text of a paper only depends on i % distinct
+    cur.execute("INSERT INTO papers(username, title, begin_time, description, data) \
+        SELECT 'user' || (i %% %s), 'paper ' || i, \
+            TIMESTAMP '2016-01-01' + i * INTERVAL '1 minute', 'description of paper ' || i, \
+            (SELECT string_agg('word' || ((i %% %s) * 7919 + j * 104729) %% 5000, ' ') \
+             FROM generate_series(1, %s) j) \
+        FROM generate_series(0, %s - 1) i;", (users, distinct, words, papers))
+    cur.execute("INSERT INTO tagnames SELECT 'tag' || i FROM generate_series(0, %s - 1) i;",
+                (tags,))
+    cur.execute("INSERT INTO tags SELECT pid, 'tag' || (pid %% %s) FROM papers;", (tags,))
+    conn.commit()
+    _vacuum(conn, "VACUUM ANALYZE;")
+    return status, applied
+
+
+def _apply_later(conn):
+    """
+    Apply the migrations after TEXT_VERSION without recording them, so the
+    read APIs find the columns they filter on and migrate() still applies
+    TEXT_VERSION. It then applies them again, which they allow.
+    """
+    cur = conn.cursor()
+    for migration in migrations.MIGRATIONS:
+        if migration.version > TEXT_VERSION:
+            for command in migration.commands:
+                cur.execute(command)
+            for name, definition in migration.indexes:
+                cur.execute("CREATE INDEX IF NOT EXISTS %s ON %s;" % (name, definition))
+    conn.commit()
+
+
+def _vacuum(conn, sql):
+    conn.autocommit = True
+    try:
+        conn.cursor().execute(sql)
+    finally:
+        conn.autocommit = False
+
+
+def sizes(conn):
+    """
+    :return: A dict of the 'papers_heap', 'papers_total' and 'paper_texts'
+             sizes in bytes, TOAST and indexes included in the totals
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT pg_relation_size('papers'), pg_total_relation_size('papers'), \
+        COALESCE(pg_total_relation_size(to_regclass('paper_texts')), 0);")
+    heap, total, texts = cur.fetchone()
+    conn.rollback()
+    return {'papers_heap': heap, 'papers_total': total, 'paper_texts': texts}
+
+
+def measure(conn, calls, count, seed=0):
+    """
+    Time get_timeline for random users and get_timeline_all, and stream the
+    whole timeline once.
+
+    :return: A dict of 'get_timeline' and 'get_timeline_all' latency samples in
+             seconds, the number of calls that 'failed' and the
+             'scan_rows_per_sec' of the full timeline
+    """
+    rng = random.Random(seed)
+    cur = conn.cursor()
+    cur.execute("SELECT username FROM users;")
+    unames = [row[0] for row in cur.fetchall()]
+    conn.rollback()
+    samples = {'get_timeline': [], 'get_timeline_all': [], 'failed': 0}
+    for i in range(calls):
+        start = time.time()
+        status, res = funcs.get_timeline(conn, rng.choice(unames), count)
+        samples['get_timeline'].append(time.time() - start)
+        samples['failed'] += status != 0
+        start = time.time()
+        status, res = funcs.get_timeline_all(conn, count)
+        samples['get_timeline_all'].append(time.time() - start)
+        samples['failed'] += status != 0
+        conn.rollback()
+    start = time.time()
+    rows = sum(1 for row in streaming.iter_timeline_all(conn))
+    seconds = time.time() - start
+    samples['scan_rows_per_sec'] = rows / seconds if seconds > 0 else float(rows)
+    return samples
+
+
+def run(conn, users=1000, papers=100000, words=300, duplicates=0.5, tags=100,
+        calls=500, count=50):
+    """
+    Measure before and after migrating the texts out of papers.
+
+    :return: (status, retval)
+        (0, {'before': report, 'after': report})    Success, a report is the
+            dict of measure() plus the dict of sizes()
+        (1, None)                                   Loading or migrating failed
+    """
+    report = {}
+    if load_inline(conn, users, papers, words, duplicates, tags)[0] != 0:
+        return 1, None
+    report['before'] = dict(measure(conn, calls, count), **sizes(conn))
+    if migrations.migrate(conn)[0] != 0:
+        return 1, None
+    _vacuum(conn, "VACUUM FULL ANALYZE papers;")
+    _vacuum(conn, "ANALYZE paper_texts;")
+    report['after'] = dict(measure(conn, calls, count), **sizes(conn))
+    return 0, report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the paper text storage")
+    parser.add_argument('--dsn', default='', help="libpq connection string of a "
+                                                  "database that may be wiped")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--papers', type=int, default=100000)
+    parser.add_argument('--words', type=int, default=300, help="words per text")
+    parser.add_argument('--duplicates', type=float, default=0.5,
+                        help="share of papers repeating another text")
+    parser.add_argument('--calls', type=int, default=500, help="calls per API")
+    parser.add_argument('--count', type=int, default=50, help="papers per call")
+    args = parser.parse_args()
+
+    results.set_enabled(False)
+    conn = psy.connect(args.dsn)
+    try:
+        status, report = run(conn, args.users, args.papers, args.words, args.duplicates,
+                             calls=args.calls, count=args.count)
+    finally:
+        conn.close()
+    if status != 0:
+        print "loading or migrating failed"
+        sys.exit(1)
+    failed = report['before']['failed'] + report['after']['failed']
+    if failed:
+        # the timings of failing calls mean nothing
+        print "%d timeline calls failed" % failed
+        sys.exit(1)
+    for name in ('before', 'after'):
+        r = report[name]
+        print "[%s]" % name
+        for api in ('get_timeline', 'get_timeline_all'):
+            print "  %-16s p50 %7.3fms  p95 %7.3fms" % (
+                api, 1000 * percentile(r[api], 0.5), 1000 * percentile(r[api], 0.95))
+        print "  full scan        %10.0f rows/sec" % r['scan_rows_per_sec']
+        print "  papers heap      %10.1f MB" % (r['papers_heap'] / 1048576.0)
+        print "  papers total     %10.1f MB" % (r['papers_total'] / 1048576.0)
+        print "  paper_texts      %10.1f MB" % (r['paper_texts'] / 1048576.0)
@@ -0,0 +1,98 @@
+"""
+Latency of a profile page: the five separate per-user APIs against the single
+get_user_profile query. Every profile is also checked to match the separate
+calls. The result cache is turned off, so every call reaches the database.
+"""
+
+import sys
+import time
+
+import psycopg2 as psy
+
+import paper.functions as funcs
+import paper.migrations as migrations
+import paper.results as results
+
+from paper.benchmarks.harness import percentile
+
+
+def separate_profile(conn, uname, count):
+    """
+    Build the same dict as get_user_profile with the five separate APIs
+    """
+    profile = {}
+    for key, func, kwargs in (
+            ('number_papers', funcs.get_number_papers_user, {}),
+            ('number_liked', funcs.get_number_liked_user, {}),
+            ('number_tags', funcs.get_number_tags_user, {}),
+            ('timeline', funcs.get_timeline, {'count': count}),
+            ('papers_by_liked', funcs.get_papers_by_liked, {'count': count})):
+        status, res = func(conn, uname, **kwargs)
+        if status != 0:
+            return status, None
+        profile[key] = res
+    return 0, profile
+
+
+def run(conn, users=200, rounds=5, count=10):
+    """
+    Time both ways of loading the profiles of some users.
+
+    :return: A dict of 'separate' and 'composite' latency samples in seconds
+             and the number of 'mismatches'
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT username FROM users ORDER BY username LIMIT %s;", (users,))
+    unames = [row[0] for row in cur.fetchall()]
+    conn.rollback()
+    samples = {'separate': [], 'composite': []}
+    mismatches = 0
+    for i in range(rounds):
+        for uname in unames:
+            start = time.time()
+            status, expected = separate_profile(conn, uname, count)
+            samples['separate'].append(time.time() - start)
+            start = time.time()
+            status2, profile = funcs.get_user_profile(conn, uname, count)
+            samples['composite'].append(time.time() - start)
+            if status != 0 or status2 != 0 or expected != profile:
+                mismatches += 1
+            conn.rollback()
+    return {'separate': samples['separate'], 'composite': samples['composite'],
+            'mismatches': mismatches}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark get_user_profile")
+    parser.add_argument('--dsn', default='', help="libpq connection string")
+    parser.add_argument('--seed', action='store_true',
+                        help="reset the database and load synthetic data first")
+    parser.add_argument('--users', type=int, default=200, help="profiles per round")
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--count', type=int, default=10, help="papers per list")
+    args = parser.parse_args()
+
+    results.set_enabled(False)
+    conn = psy.connect(args.dsn)
+    try:
+        if args.seed:
+            funcs.reset_db(conn)
+            status, report = migrations.seed_synthetic(conn)
+            if status != 0:
+                print "loading synthetic data failed"
+                sys.exit(1)
+        report = run(conn, args.users, args.rounds, args.count)
+    finally:
+        conn.close()
+    for name in ('separate', 'composite'):
+        samples = report[name]
+        print "%-9s mean %7.3fms  p50 %7.3fms  p95 %7.3fms" % (
+            name, 1000 * sum(samples) / len(samples),
+            1000 * percentile(samples, 0.5), 1000 * percentile(samples, 0.95))
+    saved = sum(report['separate']) - sum(report['composite'])
+    print "saved %.3fms per profile" % (1000 * saved / len(report['separate']))
+    if report['mismatches']:
+        print "%d profiles differ from the separate calls" % report['mismatches']
+        sys.exit(1)
@@ -0,0 +1,360 @@
+"""
+Bulk loader for users, papers, tags and likes.
+
+Seeding or migrating an instance through signup, add_new_paper and like_paper
+costs several round trips and a commit per row. This module instead streams
+the input rows into temporary staging tables with COPY and then moves them
+into the real tables with a handful of set-based statements, all inside one
+transaction.
+
+Input streams are either JSONL (one object per line) or CSV (with a header
+line). The recognized fields are:
+
+    users:  username, password
+    papers: key, username, title, description, text, tags, [begin_time]
+    likes:  username, key or pid, [like_time]
+
+For papers, key is any string that identifies the paper inside the load; the
+pid assigned to it is returned in the pid mapping so likes (and callers) can
+refer to it. In JSONL tags is a list of strings, in CSV it is a single field of
+space separated tags. A like refers either to a paper of the same load by key
+or to an existing paper by pid.
+
+The same rules as the per-row APIs are enforced:
+    - a paper with a non alphanumeric tag is rejected
+    - a paper whose key was already used earlier in the load is rejected
+      and listed in the report
+    - a username that is already used is not signed up again
+    - a user can not like his/her own paper, nor like a paper twice
+"""
+
+import csv
+import json
+import sys
+import time
+
+import psycopg2 as psy
+
+from datetime import datetime
+from pytz import timezone
+
+import recommend
+import tag_index
+import results
+
+
+# Size of the chunks handed to COPY when reading from a row stream
+COPY_CHUNK_SIZE = 1 << 16
+
+
+def read_jsonl(stream):
+    """
+    Read records from a JSONL stream, skipping blank lines.
+
+    :param stream: A file-like object
+    :return: A generator of dicts
+    """
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_csv(stream):
+    """
+    Read records from a CSV stream with a header line.
+
+    Tags are given as one space separated field and are split into a list.
+
+    :param stream: A file-like object
+    :return: A generator of dicts
+    """
+    for row in csv.DictReader(stream):
+        record = dict((k, v.decode('utf-8') if v else None) for k, v in row.iteritems())
+        if 'tags' in record:
+            record['tags'] = (record['tags'] or '').split()
+        yield record
+
+
+READERS = {
+    'jsonl': read_jsonl,
+    'csv': read_csv,
+}
+
+
+def _copy_value(value):
+    """
+    Format a single value for COPY ... FROM STDIN in text format
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyStream(object):
+    """
+    File-like object that renders an iterator of row tuples as COPY text
+    format on demand, so the whole input never has to sit in memory.
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buf = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = COPY_CHUNK_SIZE
+        chunks = [self.buf]
+        length = len(self.buf)
+        while length < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            line = '\t'.join(_copy_value(v) for v in row) + '\n'
+            chunks.append(line)
+            length += len(line)
+            self.count += 1
+        data = ''.join(chunks)
+        self.buf = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def _copy(cur, table, columns, rows):
+    """
+    COPY rows into a staging table and return how many were sent
+    """
+    stream = CopyStream(rows)
+    sql = "COPY %s(%s) FROM STDIN" % (table, ', '.join(columns))
+    cur.copy_expert(sql, stream, size=COPY_CHUNK_SIZE)
+    return stream.count
+
+
+def _user_rows(users):
+    for u in users:
+        yield (u.get('username'), u.get('password'))
+
+
+def _array_value(values):
+    """
+    Format a list of strings as an array literal, every element quoted so
+    e.g. a tag named NULL stays a string
+    """
+    return u'{%s}' % u','.join(
+        u'"%s"' % unicode(v).replace(u'\\', u'\\\\').replace(u'"', u'\\"') for v in values)
+
+
+def _paper_rows(papers, rejected, duplicates):
+    """
+    Yield paper rows for staging. Papers without a key or with a non
+    alphanumeric tag are rejected like add_new_paper does, and so are
+    papers with a key that was seen before in the load.
+    """
+    seen = set()
+    for p in papers:
+        key = p.get('key')
+        tags = p.get('tags') or []
+        if key is None or not all(t.isalnum() for t in tags):
+            rejected.append(key)
+            continue
+        key = unicode(key)
+        if key in seen:
+            duplicates.append(key)
+            continue
+        seen.add(key)
+        yield (key, p.get('username'), p.get('title'), p.get('begin_time'),
+               p.get('description'), p.get('text'), _array_value(sorted(set(tags))))
+
+
+def _like_rows(likes):
+    for l in likes:
+        key = l.get('key')
+        yield (l.get('username'), unicode(key) if key is not None else None,
+               l.get('pid'), l.get('like_time'))
+
+
+def bulk_load(conn, users=None, papers=None, likes=None, fmt='jsonl'):
+    """
+    Load users, papers (with tags) and likes in a single transaction.
+
+    :param conn: A postgres database connection object
+    :param users: A file-like object of user records, or None
+    :param papers: A file-like object of paper records, or None
+    :param likes: A file-like object of like records, or None
+    :param fmt: 'jsonl' or 'csv', the format of all the streams
+    :return: (status, retval)
+        (0, report)     Success, report is a dict with
+                            'pids'          mapping of paper key to the new pid
+                            'rows'          dict of rows inserted per table
+                            'rejected'      dict of rows skipped per table
+                            'duplicate_keys' list of paper keys given more
+                                            than once, only the first paper
+                                            of each was loaded
+                            'seconds'       elapsed wall time
+                            'rows_per_sec'  inserted rows per second
+        (1, None)       Failure, nothing was loaded
+    """
+    read = READERS[fmt]
+    start = time.time()
+    now = str(datetime.now(timezone('US/Eastern')))
+    rows = {'users': 0, 'papers': 0, 'tags': 0, 'likes': 0}
+    rejected = {'users': 0, 'papers': 0, 'likes': 0}
+    pids = {}
+    duplicates = []
+    try:
+        cur = conn.cursor()
+        cur.execute("CREATE TEMP TABLE stage_users( \
+            username VARCHAR(50), password VARCHAR(32)) ON COMMIT DROP;")
+        cur.execute("CREATE TEMP TABLE stage_papers( \
+            key TEXT PRIMARY KEY, pid INT, username VARCHAR(50), title VARCHAR(50), \
+            begin_time TIMESTAMP, description VARCHAR(500), data TEXT, text_hash BYTEA, \
+            tags VARCHAR(50)[]) ON COMMIT DROP;")
+        cur.execute("CREATE TEMP TABLE stage_likes( \
+            username VARCHAR(50), key TEXT, pid INT, like_time TIMESTAMP) ON COMMIT DROP;")
+        cur.execute("CREATE TEMP TABLE new_likes( \
+            pid INT, username VARCHAR(50), like_time TIMESTAMP) ON COMMIT DROP;")
+
+        if users is not None:
+            staged = _copy(cur, 'stage_users', ('username', 'password'),
+                           _user_rows(read(users)))
+            # like signup, a username that is already used is skipped
+            cur.execute("INSERT INTO users \
+                SELECT DISTINCT ON (username) username, password FROM stage_users \
+                ORDER BY username ON CONFLICT (username) DO NOTHING;")
+            rows['users'] = cur.rowcount
+            rejected['users'] = staged - cur.rowcount
+
+        if papers is not None:
+            bad_tags = []
+            staged = _copy(cur, 'stage_papers',
+                           ('key', 'username', 'title', 'begin_time', 'description',
+                            'data', 'tags'),
+                           _paper_rows(read(papers), bad_tags, duplicates))
+            # hand out pids up front so the key -> pid mapping is known,
+            # papers of unknown users get none and are not loaded
+            cur.execute("UPDATE stage_papers s \
+                SET pid = nextval(pg_get_serial_sequence('papers', 'pid')), \
+                    begin_time = COALESCE(s.begin_time, TIMESTAMP %s), \
+                    text_hash = sha256(convert_to(s.data, 'UTF8')) \
+                FROM users u WHERE u.username = s.username;", (now,))
+            # texts are stored once per distinct content, see add_new_paper
+            cur.execute("INSERT INTO paper_texts(hash, content) \
+                SELECT DISTINCT ON (text_hash) text_hash, data FROM stage_papers \
+                WHERE text_hash IS NOT NULL ORDER BY text_hash \
+                ON CONFLICT (hash) DO UPDATE SET refs = paper_texts.refs;")
+            cur.execute("INSERT INTO papers(pid, username, title, begin_time, description, text_hash) \
+                SELECT pid, username, title, begin_time, description, text_hash \
+                FROM stage_papers WHERE pid IS NOT NULL ORDER BY pid;")
+            rows['papers'] = cur.rowcount
+            rejected['papers'] = staged - cur.rowcount + len(bad_tags) + len(duplicates)
+            cur.execute("INSERT INTO tagnames \
+                SELECT DISTINCT unnest(tags) FROM stage_papers WHERE pid IS NOT NULL \
+                ON CONFLICT (tagname) DO NOTHING;")
+            cur.execute("INSERT INTO tags \
+                SELECT pid, unnest(tags) FROM stage_papers WHERE pid IS NOT NULL;")
+            rows['tags'] = cur.rowcount
+            cur.execute("SELECT key, pid FROM stage_papers WHERE pid IS NOT NULL;")
+            pids = dict(cur.fetchall())
+
+        if likes is not None:
+            staged = _copy(cur, 'stage_likes', ('username', 'key', 'pid', 'like_time'),
+                           _like_rows(read(likes)))
+            # no self likes, no double likes and only known users and papers
+            cur.execute("WITH ins AS ( \
+                INSERT INTO likes \
+                SELECT DISTINCT ON (p.pid, l.username) \
+                    p.pid, l.username, COALESCE(l.like_time, TIMESTAMP %s) \
+                FROM stage_likes l \
+                LEFT JOIN stage_papers s ON s.key = l.key \
+                INNER JOIN papers p ON p.pid = COALESCE(s.pid, l.pid) \
+                INNER JOIN users u ON u.username = l.username \
+                WHERE p.username != l.username AND p.deleted_at IS NULL \
+                ORDER BY p.pid, l.username \
+                ON CONFLICT (pid, username) DO NOTHING \
+                RETURNING pid, username, like_time) \
+                INSERT INTO new_likes SELECT * FROM ins;", (now,))
+            rows['likes'] = cur.rowcount
+            rejected['likes'] = staged - cur.rowcount
+            cur.execute("UPDATE papers p SET like_count = p.like_count + n.count \
+                FROM (SELECT pid, COUNT(*) AS count FROM new_likes GROUP BY pid) n \
+                WHERE p.pid = n.pid;")
+            cur.execute("INSERT INTO like_buckets \
+                SELECT pid, date_trunc('hour', like_time), COUNT(*) FROM new_likes GROUP BY 1, 2 \
+                ON CONFLICT (pid, bucket) DO UPDATE SET likes = like_buckets.likes + EXCLUDED.likes;")
+            # a new like pairs its user with every other liker of the paper;
+            # the reverse direction is only added for likers that are not new
+            # themselves, so pairs of two new likes are not counted twice
+            cur.execute("INSERT INTO co_likes \
+                SELECT username, other, COUNT(*) FROM ( \
+                    SELECT n.username, l.username AS other FROM new_likes n \
+                        INNER JOIN likes l ON l.pid = n.pid AND l.username != n.username \
+                    UNION ALL \
+                    SELECT l.username, n.username FROM new_likes n \
+                        INNER JOIN likes l ON l.pid = n.pid AND l.username != n.username \
+                        WHERE NOT EXISTS (SELECT 1 FROM new_likes o \
+                            WHERE o.pid = l.pid AND o.username = l.username)) pairs \
+                GROUP BY username, other \
+                ON CONFLICT (username, other) DO UPDATE \
+                    SET shared = co_likes.shared + EXCLUDED.shared;")
+
+        conn.commit()
+    except psy.DatabaseError, e:
+        conn.rollback()
+        return 1, None
+    if likes is not None:
+        recommend.clear()
+    if papers is not None:
+        tag_index.clear()
+    results.clear()
+    seconds = time.time() - start
+    total = sum(rows.values())
+    report = {
+        'pids': pids,
+        'rows': rows,
+        'rejected': rejected,
+        'duplicate_keys': duplicates,
+        'seconds': seconds,
+        'rows_per_sec': total / seconds if seconds > 0 else float(total),
+    }
+    return 0, report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Bulk load users, papers and likes")
+    parser.add_argument('--dsn', default='', help="libpq connection string")
+    parser.add_argument('--users', help="users file")
+    parser.add_argument('--papers', help="papers file")
+    parser.add_argument('--likes', help="likes file")
+    parser.add_argument('--format', default='jsonl', choices=sorted(READERS))
+    args = parser.parse_args()
+
+    streams = {}
+    for name in ('users', 'papers', 'likes'):
+        path = getattr(args, name)
+        streams[name] = open(path) if path else None
+    conn = psy.connect(args.dsn)
+    try:
+        status, report = bulk_load(conn, fmt=args.format, **streams)
+    finally:
+        conn.close()
+    if status != 0:
+        print "bulk load failed"
+        sys.exit(1)
+    for table in ('users', 'papers', 'tags', 'likes'):
+        print "%-7s %10d loaded %10d rejected" % (
+            table, report['rows'][table], report['rejected'].get(table, 0))
+    if report['duplicate_keys']:
+        print "%d papers with a repeated key, e.g. %s" % (
+            len(report['duplicate_keys']), report['duplicate_keys'][0])
+    print "%d rows in %.2fs (%.0f rows/sec)" % (
+        sum(report['rows'].values()), report['seconds'], report['rows_per_sec'])
@@ -5,15 +5,25 @@ to the line of code with "kfuh". The function extra_test_recommendations
 was added to do some extra testing for get_recommend_papers without
 disturbing the existing tests from simple_checker
 
+Run it as "python customize_checker.py --async" to make every call through
+paper.async_api on pooled connections instead, with the independent reads
+issued concurrently. The pool connects with the PG* environment variables.
+"python customize_checker.py --memory" runs it against paper.memory_engine,
+without a database.
+
 Name: Kathleen Fuh
 AndrewID: kfuh
 """
 
 # Import necessary packages
+import paper.async_api as async_api
 import paper.database_wrapper as db_wrapper
 import paper.functions as funcs
+import paper.memory_engine as memory_engine
 from paper.constants import *
 
+import sys
+
 from datetime import datetime
 from datetime import timedelta
 
@@ -41,6 +51,8 @@ ALL_FUNCS = ['add_new_paper', 'delete_paper', 'get_paper_tags',
              'signup', 'unlike_paper', 'like_paper']
 RES = {}
 VERBOSE = False
+ASYNC = "--async" in sys.argv
+MEMORY = "--memory" in sys.argv
 
 
 def report_result():
@@ -88,19 +100,45 @@ def status_error(func, should_abort = True):
     error_message(func, "failed unexpectedly", should_abort)
 
 
+def debug_call(func, argdict):
+    msg = "[Test] %s(" % func.__name__
+    for k,v in argdict.iteritems():
+        msg += " %s = %s," % (str(k), str(v))
+    msg += " )"
+    print msg
+
+
 def db_wrapper_debug(func, argdict, verbose = VERBOSE):
     if verbose:
-        msg = "[Test] %s(" % func.__name__
-        for k,v in argdict.iteritems():
-            msg += " %s = %s," % (str(k), str(v))
-        msg += " )"
-        print msg
-    res = db_wrapper.call_db(func, argdict)
+        debug_call(func, argdict)
+    if MEMORY:
+        res = memory_engine.call_db(func, argdict)
+    elif ASYNC:
+        res = async_api.get_api().submit(func, argdict).get()
+    else:
+        res = db_wrapper.call_db(func, argdict)
     if verbose:
         print "\treturn: %s" % str(res)
     return res
 
 
+def db_wrapper_many(calls, verbose = VERBOSE):
+    # independent calls, issued all at once on the async path
+    if not ASYNC:
+        return [db_wrapper_debug(func, argdict, verbose) for func, argdict in calls]
+    api = async_api.get_api()
+    handles = []
+    for func, argdict in calls:
+        if verbose:
+            debug_call(func, argdict)
+        handles.append(api.submit(func, argdict))
+    res = async_api.gather(handles)
+    if verbose:
+        for r in res:
+            print "\treturn: %s" % str(r)
+    return res
+
+
 # I'm calling this function at the end of main and resetting up the
 # db with my own values so I don't run into problems with the existing
 # tests from simple_checker
@@ -154,6 +192,33 @@ def extra_test_recommendations():
             error_message(funcs.get_recommend_papers, "recommended papers incorrect") 
     except TypeError:
         format_error(funcs.get_recommend_papers)
+    try:
+        # USERS[1] and USERS[2] only share paper 1, so deleting it takes
+        # paper 4 out of the recommendations of USERS[1]
+        status, res = db_wrapper_debug(funcs.delete_paper, {'pid':1})
+        if status != SUCCESS:
+            status_error(funcs.delete_paper)
+        status, res = db_wrapper_debug(funcs.get_recommend_papers, {'uname':USERS[1]})
+        if res != []:
+            error_message(funcs.get_recommend_papers, "recommended papers of a deleted paper's cohort")
+        # likes of a deleted paper can not be taken back
+        status, res = db_wrapper_debug(funcs.unlike_paper, {'uname':USERS[1], 'pid':1})
+        if status != FAILURE:
+            error_message(funcs.unlike_paper, "unliked a deleted paper")
+    except TypeError:
+        format_error(funcs.get_recommend_papers)
+    try:
+        # a name longer than the column is unknown, not the user whose
+        # name is its first 50 characters
+        db_wrapper_debug(funcs.signup, {'uname':'u' * 50, 'pwd':'u'})
+        status, res = db_wrapper_debug(funcs.like_papers_bulk, {'events':[('u' * 51, 4)]})
+        if status != SUCCESS or res != [FAILURE]:
+            error_message(funcs.like_papers_bulk, "liked as another user")
+        status, res = db_wrapper_debug(funcs.unlike_papers_bulk, {'events':[('u' * 51, 4)]})
+        if status != SUCCESS or res != [FAILURE]:
+            error_message(funcs.unlike_papers_bulk, "unliked as another user")
+    except TypeError:
+        format_error(funcs.like_papers_bulk)
 
 
 if __name__ == "__main__":
@@ -300,10 +365,11 @@ if __name__ == "__main__":
         (funcs.get_recommend_papers, [2], {'uname':USERS[3]})
     ]
 
-    for func, ans, args in list_funcs_ctx:
+    list_res = db_wrapper_many([(func, args) for func, ans, args in list_funcs_ctx])
+    for (func, ans, args), ret in zip(list_funcs_ctx, list_res):
         RES[func.__name__] = True
         try:
-            status, res = db_wrapper_debug(func, args)
+            status, res = ret
             if status != SUCCESS:
                 status_error(func,)
             else:
@@ -350,10 +416,11 @@ if __name__ == "__main__":
         
     ]
 
-    for func, ans, args in value_func_ctx:
+    value_res = db_wrapper_many([(func, args) for func, ans, args in value_func_ctx])
+    for (func, ans, args), ret in zip(value_func_ctx, value_res):
         RES[func.__name__] = True
         try:
-            status, res = db_wrapper_debug(func, args)
+            status, res = ret
             if status != SUCCESS:
                 status_error(funcs,)
             else:
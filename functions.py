@@ -9,6 +9,14 @@ from datetime import datetime
 from pytz import timezone
 from constants import *
 
+import keyset
+import migrations
+import recommend
+import results
+import sessions
+import statements
+import tag_index
+
 """
 General rules:
     (1) How will the WebApp call these APIs?
@@ -73,70 +81,127 @@ def example_select_current_time(conn):
 def reset_db(conn):
     """
     Reset the entire database.
-    Delete all tables and then recreate them.
+    Delete all tables and then recreate them by applying every migration.
 
     :param conn: A postgres database connection object
     :return: (status, retval)
         (0, None)   Success
         (1, None)   Failure
     """
-    commands = (
-        """
-        DROP TABLE IF EXISTS tags, tagnames, likes, papers, users
-        """,
-        """
-        CREATE TABLE IF NOT EXISTS users(
-            username VARCHAR(50) NOT NULL,
-            password VARCHAR(32) NOT NULL,
-            PRIMARY KEY(username)
-        )
-        """,
-        """
-        CREATE TABLE IF NOT EXISTS papers(
-            pid  SERIAL PRIMARY KEY,
-            username VARCHAR(50) NOT NULL,
-            title VARCHAR(50),
-            begin_time TIMESTAMP NOT NULL,
-            description VARCHAR(500),
-            data TEXT,
-            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
-        );
-        """,
-        """
-        CREATE INDEX paper_text_idx ON papers USING gin(to_tsvector('english', data))
-        """,
-        """
-        CREATE TABLE IF NOT EXISTS tagnames(
-            tagname VARCHAR(50) NOT NULL,
-            PRIMARY KEY(tagname)
-        );
-        """,
-        """
-        CREATE TABLE IF NOT EXISTS likes(
-            pid INT NOT NULL,
-            username VARCHAR(50) NOT NULL,
-            like_time TIMESTAMP NOT NULL,
-            PRIMARY KEY(pid, username),
-            FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE,
-            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
-        );
-        """,
-        """
-        CREATE TABLE IF NOT EXISTS tags(
-            pid INT NOT NULL,
-            tagname VARCHAR(50) NOT NULL,
-            PRIMARY KEY(pid, tagname),
-            FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE,
-            FOREIGN KEY(tagname) REFERENCES tagnames ON DELETE CASCADE
-        );
-        """,
-    )
     cur = conn.cursor()
-    for command in commands:
-        cur.execute(command)
+    cur.execute("DROP TABLE IF EXISTS schema_version, co_likes, tag_pair_counts, tag_counts, \
+        tags, tagnames, like_buckets, likes, papers, paper_texts, users CASCADE;")
     conn.commit()
+    # the schema itself is defined by the migrations
+    status, res = migrations.migrate(conn)
+    # prepared statements refer to the dropped tables
+    statements.schema_changed()
+    sessions.clear()
+    recommend.clear()
+    results.clear()
+    tag_index.clear()
+    if status != 0:
+        return 1, None
     return 0, None
 
+
+def reconcile_like_counts(conn, repair=True):
+    """
+    Find papers whose like counter does not match their likes, e.g. after
+    likes were removed by a cascade from users, and optionally fix them.
+
+    :param conn: A postgres database connection object
+    :param repair: Whether to fix the drifted counters
+    :return: (status, retval)
+        (0, [(pid, stored_count, actual_count), ...])
+            Success, retval lists every paper whose counter was wrong
+        (1, None)   Failure
+    """
+    try:
+        cur = conn.cursor()
+        if repair:
+            # keep likes from changing between counting and fixing
+            cur.execute("LOCK TABLE likes IN SHARE MODE;")
+        sql = "SELECT p.pid, p.like_count, COALESCE(l.count, 0) \
+            FROM papers p LEFT JOIN ( \
+                SELECT pid, COUNT(*) AS count FROM likes GROUP BY pid) l \
+                ON p.pid = l.pid \
+            WHERE p.like_count != COALESCE(l.count, 0) AND p.deleted_at IS NULL \
+            ORDER BY p.pid;"
+        cur.execute(sql)
+        drift = cur.fetchall()
+        if repair and drift:
+            sql = "UPDATE papers SET like_count = %s WHERE pid = %s;"
+            cur.executemany(sql, [(actual, pid) for pid, stored, actual in drift])
+            # the like buckets of these papers drifted the same way
+            pids = [pid for pid, stored, actual in drift]
+            cur.execute("DELETE FROM like_buckets WHERE pid = ANY(%s);", (pids,))
+            cur.execute("INSERT INTO like_buckets \
+                SELECT pid, date_trunc('hour', like_time), COUNT(*) FROM likes \
+                WHERE pid = ANY(%s) GROUP BY 1, 2;", (pids,))
+        conn.commit()
+        if repair and drift:
+            results.invalidate([('likes',)] + [('likes', pid) for pid, stored, actual in drift])
+        return 0, drift
+    except psy.DatabaseError, e:
+        conn.rollback()
+        return 1, None
+
+# Key of the advisory lock held by purge_deleted_papers
+PURGE_LOCK = 0x70757267
+# Likes, and papers, removed per purge_deleted_papers call at most
+PURGE_BATCH = 1000
+
+
+def purge_deleted_papers(conn, batch=PURGE_BATCH):
+    """
+    Remove papers marked by delete_paper(s) for good, with their likes.
+
+    At most $batch likes and $batch papers are removed per call, so a paper
+    with many likes is purged over several short transactions. Keep calling
+    it while it removes something, see purge.Purger. One call runs at a time,
+    a concurrent one returns without doing anything.
+
+    :param conn: A postgres database connection object
+    :param batch: The maximum number of likes and of papers to remove
+    :return: (status, retval)
+        (0, (likes, papers))    Success, the numbers of likes and papers removed
+        (1, None)               Failure
+    """
+    try:
+        cur = conn.cursor()
+        # co_likes would be decremented twice by two purges of the same likes
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s);", (PURGE_LOCK,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return 0, (0, 0)
+        cur.execute("CREATE TEMP TABLE purged_likes( \
+            pid INT, username VARCHAR(50)) ON COMMIT DROP;")
+        cur.execute("WITH doomed AS ( \
+                SELECT l.pid, l.username FROM papers p INNER JOIN likes l ON l.pid = p.pid \
+                WHERE p.deleted_at IS NOT NULL \
+                ORDER BY l.pid, l.username LIMIT %s), \
+            del AS ( \
+                DELETE FROM likes l USING doomed d \
+                WHERE l.pid = d.pid AND l.username = d.username \
+                RETURNING l.pid, l.username) \
+            INSERT INTO purged_likes SELECT pid, username FROM del;", (batch,))
+        likes = cur.rowcount
+        _remove_co_likes(cur, 'purged_likes')
+        # papers without likes left go with their like buckets and texts
+        cur.execute("DELETE FROM papers WHERE pid IN ( \
+            SELECT pid FROM papers p WHERE p.deleted_at IS NOT NULL \
+                AND NOT EXISTS (SELECT 1 FROM likes l WHERE l.pid = p.pid) \
+            ORDER BY pid LIMIT %s);", (batch,))
+        papers = cur.rowcount
+        conn.commit()
+        if likes:
+            recommend.clear()
+        return 0, (likes, papers)
+    except psy.DatabaseError, e:
+        conn.rollback()
+        return 1, None
+
 # Basic APIs
 
 
@@ -159,18 +224,20 @@ def signup(conn, uname, pwd):
         # check if username already exists
         sql = "SELECT COUNT(*) FROM users WHERE username = %s;"
         data = (uname,)
-        cur.execute(sql, data)
+        statements.execute(cur, 'signup_exists', sql, data)
         count = cur.fetchone()
         if count[0] > 0:
             return 1, None
 
         sql = "INSERT INTO users VALUES(%s,%s);"
         data = (uname, pwd,)
-        cur.execute(sql, data)
+        statements.execute(cur, 'signup_insert', sql, data)
     
         conn.commit()
         # one row was affected which means successful insert
         if cur.rowcount == 1:
+            # drop sessions left over from an earlier user of this name
+            sessions.invalidate_user(uname)
             return 0, None
         # since we already checked for existing user at this point
         # unsuccessful insert is another error
@@ -195,35 +262,58 @@ def login(conn, uname, pwd):
     """
     try:
         cur = conn.cursor()
-        sql = "SELECT COUNT(*) FROM users WHERE username = %s AND password = %s;"
-        data = (uname, pwd,)
-        cur.execute(sql, data)
-        count = cur.fetchone()[0]
-        if count == 1:
-            return 0, None
-        # check reason for failure
-        else:
-            sql = "SELECT COUNT(*) FROM users WHERE username = %s;"
-            data = (uname,)
-            cur.execute(sql, data)
-            user_count = cur.fetchone()[0]
-            # user did not exist
-            if user_count == 0:
-                return 1, None
-            else:
-                sql = "SELECT password FROM users WHERE username = %s;"
-                data = (uname,)
-                cur.execute(sql, data)
-                # must not None from fetchone bc at this point we know user exists
-                password = cur.fetchone()[0]
-                if password != pwd:
-                    return 2, None
-                else:
-                    return 3, None
+        # one round trip: 1 when there is no such user, otherwise 0 or 2
+        # depending on whether the password matches
+        sql = "SELECT COALESCE(( \
+            SELECT CASE WHEN password = %s THEN 0 ELSE 2 END \
+                FROM users WHERE username = %s), 1);"
+        data = (pwd, uname,)
+        statements.execute(cur, 'login', sql, data)
+        return cur.fetchone()[0], None
     except psy.DatabaseError, e:
         return 3, None
 
 
+def login_session(conn, uname, pwd):
+    """
+    Login and open a session if user and password match.
+
+    The returned token can be passed to check_session on later requests,
+    which does not need the database.
+
+    :param conn: A postgres database connection object
+    :param uname: A string of username
+    :param pwd: A string of user's password
+    :return: (status, retval)
+        (0, token)  Success, retval is a string token of the session
+        (1, None)   Failure -- User does not exist
+        (2, None)   Failure -- Password incorrect
+        (3, None)   Failure -- Other errors
+    """
+    status, res = login(conn, uname, pwd)
+    if status != 0:
+        return status, None
+    return 0, sessions.create(uname)
+
+
+def check_session(conn, token):
+    """
+    Get the user of a session opened by login_session.
+
+    This is answered from the in-process session cache, conn is not used.
+
+    :param conn: A postgres database connection object
+    :param token: A string token returned by login_session
+    :return: (status, retval)
+        (0, uname)  Success, retval is the username of the session
+        (1, None)   Failure -- Unknown or expired session
+    """
+    uname = sessions.lookup(token)
+    if uname is None:
+        return 1, None
+    return 0, uname
+
+
 # Event related
 
 
@@ -248,10 +338,20 @@ def add_new_paper(conn, uname, title, desc, text, tags):
     try:
         cur = conn.cursor()
         time = datetime.now(timezone('US/Eastern'))
-        sql =  "INSERT INTO papers(username, title, begin_time, description, data) \
+        text_hash = None
+        if text is not None:
+            # stored once per distinct text; the no-op update locks an
+            # existing row so it can not be dropped before the paper refers to it
+            sql = "INSERT INTO paper_texts(hash, content) \
+                SELECT sha256(convert_to(t, 'UTF8')), t FROM (VALUES(%s::text)) v(t) \
+                ON CONFLICT (hash) DO UPDATE SET refs = paper_texts.refs RETURNING hash;"
+            data = (text,)
+            statements.execute(cur, 'add_new_paper_text', sql, data)
+            text_hash = cur.fetchone()[0]
+        sql =  "INSERT INTO papers(username, title, begin_time, description, text_hash) \
             VALUES(%s, %s, %s, %s, %s) RETURNING pid;"
-        data = (uname, title, str(time), desc, text,)
-        cur.execute(sql, data)
+        data = (uname, title, str(time), desc, text_hash,)
+        statements.execute(cur, 'add_new_paper_insert', sql, data)
         pid_db = cur.fetchone()
         # something went wrong with insert and no pid was returned
         # should be caught by a database exception, but this is just in case
@@ -259,22 +359,28 @@ def add_new_paper(conn, uname, title, desc, text, tags):
         if pid_db is None:
             return 1, None
         pid = pid_db[0]
-        for t in tags:
+        # insert in a fixed order so concurrent papers update the shared
+        # tag counters in the same order
+        for t in sorted(tags):
             if not t.isalnum():
+                conn.rollback()
                 return 1, None
             sql = "SELECT COUNT(*) FROM tagnames WHERE tagname = %s"
             data = (t,)
-            cur.execute(sql, data)
+            statements.execute(cur, 'add_new_paper_tag_exists', sql, data)
             t_count = cur.fetchone()[0]
             if t_count == 0:
                 sql = "INSERT INTO tagnames VALUES(%s);"
                 data = (t,)
-                cur.execute(sql, data)
+                statements.execute(cur, 'add_new_paper_tagname', sql, data)
             sql = "INSERT INTO tags VALUES(%s, %s);"
             data = (pid, t,)
-            cur.execute(sql, data)
+            statements.execute(cur, 'add_new_paper_tag', sql, data)
         # once everything has been inserted commit so full insertion is atomic
         conn.commit()
+        results.invalidate([('papers',), ('user', uname), ('tags',), ('paper', pid), ('likes', pid)]
+                           + [('tag', t) for t in tags])
+        tag_index.update([(t, 1) for t in tags])
         return 0, pid
     except psy.DatabaseError, e:
         # something went wrong so rollback
@@ -286,6 +392,10 @@ def delete_paper(conn, pid):
     """
     Delete a paper by the given pid.
 
+    The paper is only marked as deleted, and every read API leaves it out
+    from then on. Its tags go right away, its likes, which can be many, are
+    removed later by purge_deleted_papers.
+
     :param conn: A postgres database connection object
     :param pid: An int of pid
     :return: (status, retval)
@@ -294,17 +404,88 @@ def delete_paper(conn, pid):
     """
     try:
         cur = conn.cursor()
-        sql = "DELETE FROM papers WHERE pid = %s;"
+        time = datetime.now(timezone('US/Eastern'))
+        sql = "UPDATE papers SET deleted_at = CAST(%s AS TIMESTAMP) \
+            WHERE pid = %s AND deleted_at IS NULL RETURNING username;"
+        data = (str(time), pid,)
+        statements.execute(cur, 'delete_paper', sql, data)
+        scopes = [('papers',), ('tags',), ('likes',), ('paper', pid), ('likes', pid)]
+        scopes.extend(('user', row[0]) for row in cur.fetchall())
+        # the liked lists the paper was on
+        sql = "SELECT 'liked', username FROM likes WHERE pid = %s;"
+        data = (pid,)
+        statements.execute(cur, 'delete_paper_scopes', sql, data)
+        scopes.extend(cur.fetchall())
+        # a handful of rows, whose triggers keep the tag counters exact
+        sql = "DELETE FROM tags WHERE pid = %s RETURNING tagname;"
         data = (pid,)
-        cur.execute(sql, data)
+        statements.execute(cur, 'delete_paper_tags', sql, data)
+        tags = [row[0] for row in cur.fetchall()]
         conn.commit()
+        recommend.clear()
+        results.invalidate(scopes + [('tag', t) for t in tags])
+        tag_index.update([(t, -1) for t in tags])
         return 0, None
     except psy.DatabaseError, e:
         print "delete_paper"
         print e
+        conn.rollback()
         return 1, None
 
 
+def delete_papers(conn, pids):
+    """
+    Delete many papers at once, like delete_paper does one.
+
+    :param conn: A postgres database connection object
+    :param pids: A list of int pids
+    :return: (status, retval)
+        (0, [status, ...])  Success, retval has 0 for every pid that was
+                            deleted and 1 for unknown, already deleted or
+                            repeated ones, in the order of pids
+        (1, None)           Failure, nothing was deleted
+    """
+    if not pids:
+        return 0, []
+    try:
+        cur = conn.cursor()
+        time = datetime.now(timezone('US/Eastern'))
+        # in pid order, like concurrent deletes lock them
+        wanted = sorted(set(pids))
+        cur.execute("UPDATE papers SET deleted_at = CAST(%s AS TIMESTAMP) \
+            WHERE pid = ANY(CAST(%s AS INT[])) AND deleted_at IS NULL \
+            RETURNING pid, username;", (str(time), wanted,))
+        authors = dict(cur.fetchall())
+        deleted = sorted(authors)
+        scopes = [('papers',), ('tags',), ('likes',)]
+        removed = {}
+        if deleted:
+            cur.execute("SELECT DISTINCT 'liked', username FROM likes \
+                WHERE pid = ANY(CAST(%s AS INT[]));", (deleted,))
+            scopes.extend(cur.fetchall())
+            cur.execute("DELETE FROM tags WHERE pid = ANY(CAST(%s AS INT[])) \
+                RETURNING tagname;", (deleted,))
+            for row in cur.fetchall():
+                removed[row[0]] = removed.get(row[0], 0) + 1
+        conn.commit()
+        if deleted:
+            recommend.clear()
+            scopes.extend(('paper', pid) for pid in deleted)
+            scopes.extend(('likes', pid) for pid in deleted)
+            scopes.extend(('user', uname) for uname in set(authors.values()))
+            scopes.extend(('tag', t) for t in removed)
+            results.invalidate(scopes)
+            tag_index.update([(t, -n) for t, n in removed.iteritems()])
+        statuses = []
+        for pid in pids:
+            statuses.append(0 if authors.pop(pid, None) is not None else 1)
+        return 0, statuses
+    except psy.DatabaseError, e:
+        conn.rollback()
+        return 1, None
+
+
+@results.cached(lambda args: [('paper', args['pid'])])
 def get_paper_tags(conn, pid):
     """
     Get all tags of a paper
@@ -322,9 +503,9 @@ def get_paper_tags(conn, pid):
     """
     try:
         cur = conn.cursor()
-        sql = "SELECT tagname FROM tags WHERE pid = %s"
+        sql = "SELECT tagname FROM tags WHERE pid = %s ORDER BY tagname;"
         data = (pid,)
-        cur.execute(sql, data)
+        statements.execute(cur, 'get_paper_tags', sql, data)
         tags_db = cur.fetchall()
         tags = []
         # tags_db is a list of tuples so get the tags out of the tuples
@@ -352,9 +533,9 @@ def like_paper(conn, uname, pid):
     """
     try:
         cur = conn.cursor()
-        sql = "SELECT username FROM papers WHERE pid = %s;"
+        sql = "SELECT username FROM papers WHERE pid = %s AND deleted_at IS NULL;"
         data = (pid,)
-        cur.execute(sql, data)
+        statements.execute(cur, 'like_paper_author', sql, data)
         paper_author_db = cur.fetchone()
         # invalid pid
         if paper_author_db is None:
@@ -364,17 +545,36 @@ def like_paper(conn, uname, pid):
         if paper_author == uname:
             return 1, None
         time = datetime.now(timezone('US/Eastern'))
-        sql = "INSERT INTO likes VALUES(%s, %s, TIMESTAMP %s);"
+        sql = "INSERT INTO likes VALUES(%s, %s, CAST(%s AS TIMESTAMP));"
         data = (pid, uname, str(time),)
-        cur.execute(sql, data)
-        conn.commit()
-        # successful insert (i.e. valid like)
-        if cur.rowcount == 1:
-            return 0, None
+        statements.execute(cur, 'like_paper_insert', sql, data)
         # unsuccessful insert because user has liked this paper before
-        else:
+        if cur.rowcount != 1:
+            conn.rollback()
             return 1, None
+        # keep the like counter in the same transaction as the like
+        sql = "UPDATE papers SET like_count = like_count + 1 WHERE pid = %s;"
+        data = (pid,)
+        statements.execute(cur, 'like_paper_count', sql, data)
+        sql = "INSERT INTO like_buckets VALUES(%s, date_trunc('hour', CAST(%s AS TIMESTAMP)), 1) \
+            ON CONFLICT (pid, bucket) DO UPDATE SET likes = like_buckets.likes + 1;"
+        data = (pid, str(time),)
+        statements.execute(cur, 'like_paper_bucket', sql, data)
+        # the user now shares this paper with everybody else who likes it
+        sql = "INSERT INTO co_likes \
+            SELECT %s, username, 1 FROM likes WHERE pid = %s AND username != %s \
+            UNION ALL \
+            SELECT username, %s, 1 FROM likes WHERE pid = %s AND username != %s \
+            ON CONFLICT (username, other) DO UPDATE SET shared = co_likes.shared + 1;"
+        data = (uname, pid, uname, uname, pid, uname,)
+        statements.execute(cur, 'like_paper_co_likes', sql, data)
+        cohort = recommend.cohort(cur, uname)
+        conn.commit()
+        recommend.invalidate(cohort)
+        results.invalidate([('likes',), ('likes', pid), ('liked', uname)])
+        return 0, None
     except psy.DatabaseError, e:
+        conn.rollback()
         return 1, None
 
 
@@ -384,6 +584,8 @@ def unlike_paper(conn, uname, pid):
 
     You need to ensure that the user calling unlike has liked the paper before
 
+    Likes of a deleted paper can not be taken back; they go when it is purged.
+
     :param conn: A postgres database connection object
     :param uname: A string of username
     :param pid: An int of pid
@@ -393,19 +595,215 @@ def unlike_paper(conn, uname, pid):
     """
     try:
         cur = conn.cursor()
-        sql = "DELETE FROM likes WHERE pid = %s AND username = %s"
+        sql = "DELETE FROM likes l USING papers p \
+            WHERE l.pid = %s AND l.username = %s AND p.pid = l.pid AND p.deleted_at IS NULL \
+            RETURNING l.like_time;"
         data = (pid, uname,)
-        cur.execute(sql, data)
-        conn.commit()
-        # successful unlike
-        if cur.rowcount == 1:
-            return 0, None
-        else:
+        statements.execute(cur, 'unlike_paper', sql, data)
+        # the user has not liked the paper before, or it is deleted and its
+        # likes belong to purge_deleted_papers
+        if cur.rowcount != 1:
+            conn.rollback()
             return 1, None
+        like_time = cur.fetchone()[0]
+        sql = "UPDATE papers SET like_count = like_count - 1 WHERE pid = %s;"
+        data = (pid,)
+        statements.execute(cur, 'unlike_paper_count', sql, data)
+        sql = "UPDATE like_buckets SET likes = likes - 1 \
+            WHERE pid = %s AND bucket = date_trunc('hour', CAST(%s AS TIMESTAMP));"
+        data = (pid, like_time,)
+        statements.execute(cur, 'unlike_paper_bucket', sql, data)
+        sql = "DELETE FROM like_buckets \
+            WHERE pid = %s AND bucket = date_trunc('hour', CAST(%s AS TIMESTAMP)) AND likes <= 0;"
+        statements.execute(cur, 'unlike_paper_bucket_empty', sql, data)
+        # the cohort before the unlike is the one whose recommendations change
+        cohort = recommend.cohort(cur, uname)
+        sql = "UPDATE co_likes SET shared = shared - 1 \
+            WHERE (username = %s AND other IN (SELECT username FROM likes WHERE pid = %s)) \
+                OR (other = %s AND username IN (SELECT username FROM likes WHERE pid = %s));"
+        data = (uname, pid, uname, pid,)
+        statements.execute(cur, 'unlike_paper_co_likes', sql, data)
+        sql = "DELETE FROM co_likes WHERE (username = %s OR other = %s) AND shared <= 0;"
+        data = (uname, uname,)
+        statements.execute(cur, 'unlike_paper_co_likes_empty', sql, data)
+        conn.commit()
+        recommend.invalidate(cohort)
+        results.invalidate([('likes',), ('likes', pid), ('liked', uname)])
+        return 0, None
     except psy.DatabaseError, e:
+        conn.rollback()
+        return 1, None
+
+
+def _remove_co_likes(cur, removed):
+    """
+    Take likes that were just deleted out of co_likes. A removed like leaves
+    its pairs with the remaining likers, in both directions, and with the
+    other removed likes of the paper.
+
+    :param cur: A cursor of the transaction that deleted the likes
+    :param removed: Name of a table listing the pid and username of the likes
+    """
+    cur.execute("UPDATE co_likes c SET shared = c.shared - d.count FROM ( \
+            SELECT username, other, COUNT(*) AS count FROM ( \
+                SELECT r.username, l.username AS other FROM %(removed)s r \
+                    INNER JOIN likes l ON l.pid = r.pid \
+                UNION ALL \
+                SELECT l.username, r.username FROM %(removed)s r \
+                    INNER JOIN likes l ON l.pid = r.pid \
+                UNION ALL \
+                SELECT r1.username, r2.username FROM %(removed)s r1 \
+                    INNER JOIN %(removed)s r2 \
+                        ON r1.pid = r2.pid AND r1.username != r2.username) pairs \
+            GROUP BY username, other) d \
+        WHERE c.username = d.username AND c.other = d.other;" % {'removed': removed})
+    cur.execute("DELETE FROM co_likes WHERE shared <= 0 \
+        AND (username IN (SELECT username FROM %(removed)s) \
+            OR other IN (SELECT username FROM %(removed)s));" % {'removed': removed})
+
+
+def _event_statuses(cur, events):
+    """
+    Turn the ordinals of the events that took effect into one status per event
+    """
+    done = set(row[0] for row in cur.fetchall())
+    return [0 if i in done else 1 for i in range(1, len(events) + 1)]
+
+
+def like_papers_bulk(conn, events):
+    """
+    Record many likes at once, with the rules of like_paper: a like of an
+    unknown paper, of the user's own paper or of a paper the user already
+    likes fails. Of the same like repeated in events only the first succeeds.
+    All likes are timestamped with the current timestamp and committed together.
+
+    :param conn: A postgres database connection object
+    :param events: A list of (uname, pid) pairs
+    :return: (status, retval)
+        (0, [status, ...])  Success, retval has 0 for every event that was
+                            recorded and 1 for every other, in the order of events
+        (1, None)           Failure, nothing was recorded
+    """
+    if not events:
+        return 0, []
+    try:
+        cur = conn.cursor()
+        time = datetime.now(timezone('US/Eastern'))
+        cur.execute("CREATE TEMP TABLE bulk_likes( \
+            i BIGINT, pid INT, username VARCHAR(50), like_time TIMESTAMP) ON COMMIT DROP;")
+        # events are numbered from 1 in input order. Names are TEXT, a cast to
+        # VARCHAR(50) would cut a longer one down to another user's name
+        cur.execute("WITH e AS ( \
+                SELECT * FROM unnest(CAST(%s AS TEXT[]), CAST(%s AS INT[])) \
+                    WITH ORDINALITY AS e(username, pid, i)), \
+            ok AS ( \
+                SELECT DISTINCT ON (e.pid, e.username) e.i, e.pid, e.username FROM e \
+                INNER JOIN papers p ON p.pid = e.pid \
+                INNER JOIN users u ON u.username = e.username \
+                WHERE p.username != e.username AND p.deleted_at IS NULL \
+                ORDER BY e.pid, e.username, e.i), \
+            ins AS ( \
+                INSERT INTO likes SELECT pid, username, CAST(%s AS TIMESTAMP) FROM ok \
+                ORDER BY pid, username \
+                ON CONFLICT (pid, username) DO NOTHING \
+                RETURNING pid, username, like_time) \
+            INSERT INTO bulk_likes \
+                SELECT ok.i, ins.pid, ins.username, ins.like_time FROM ins \
+                INNER JOIN ok ON ok.pid = ins.pid AND ok.username = ins.username \
+            RETURNING i;",
+            ([e[0] for e in events], [e[1] for e in events], str(time),))
+        statuses = _event_statuses(cur, events)
+        cur.execute("UPDATE papers p SET like_count = p.like_count + n.count \
+            FROM (SELECT pid, COUNT(*) AS count FROM bulk_likes GROUP BY pid) n \
+            WHERE p.pid = n.pid;")
+        cur.execute("INSERT INTO like_buckets \
+            SELECT pid, date_trunc('hour', like_time), COUNT(*) FROM bulk_likes GROUP BY 1, 2 \
+            ON CONFLICT (pid, bucket) DO UPDATE SET likes = like_buckets.likes + EXCLUDED.likes;")
+        # pairs of two new likes are counted once from each side, see bulk_load
+        cur.execute("INSERT INTO co_likes \
+            SELECT username, other, COUNT(*) FROM ( \
+                SELECT n.username, l.username AS other FROM bulk_likes n \
+                    INNER JOIN likes l ON l.pid = n.pid AND l.username != n.username \
+                UNION ALL \
+                SELECT l.username, n.username FROM bulk_likes n \
+                    INNER JOIN likes l ON l.pid = n.pid AND l.username != n.username \
+                    WHERE NOT EXISTS (SELECT 1 FROM bulk_likes o \
+                        WHERE o.pid = l.pid AND o.username = l.username)) pairs \
+            GROUP BY username, other \
+            ON CONFLICT (username, other) DO UPDATE \
+                SET shared = co_likes.shared + EXCLUDED.shared;")
+        conn.commit()
+        done = [e for e, status in zip(events, statuses) if status == 0]
+        if done:
+            recommend.clear()
+            results.invalidate([('likes',)] + [('likes', pid) for uname, pid in done]
+                               + [('liked', uname) for uname, pid in done])
+        return 0, statuses
+    except psy.DatabaseError, e:
+        conn.rollback()
         return 1, None
 
 
+def unlike_papers_bulk(conn, events):
+    """
+    Take back many likes at once, with the rules of unlike_paper: unliking a
+    paper the user does not like or a deleted paper fails. Of the same unlike repeated in events
+    only the first succeeds. All unlikes are committed together.
+
+    :param conn: A postgres database connection object
+    :param events: A list of (uname, pid) pairs
+    :return: (status, retval)
+        (0, [status, ...])  Success, retval has 0 for every event that removed
+                            a like and 1 for every other, in the order of events
+        (1, None)           Failure, nothing was removed
+    """
+    if not events:
+        return 0, []
+    try:
+        cur = conn.cursor()
+        cur.execute("CREATE TEMP TABLE bulk_unlikes( \
+            i BIGINT, pid INT, username VARCHAR(50), like_time TIMESTAMP) ON COMMIT DROP;")
+        cur.execute("WITH e AS ( \
+                SELECT * FROM unnest(CAST(%s AS TEXT[]), CAST(%s AS INT[])) \
+                    WITH ORDINALITY AS e(username, pid, i)), \
+            first AS ( \
+                SELECT DISTINCT ON (e.pid, e.username) e.i, e.pid, e.username FROM e \
+                INNER JOIN papers p ON p.pid = e.pid \
+                WHERE p.deleted_at IS NULL \
+                ORDER BY e.pid, e.username, e.i), \
+            del AS ( \
+                DELETE FROM likes l USING first f \
+                WHERE l.pid = f.pid AND l.username = f.username \
+                RETURNING l.pid, l.username, l.like_time) \
+            INSERT INTO bulk_unlikes \
+                SELECT f.i, del.pid, del.username, del.like_time FROM del \
+                INNER JOIN first f ON f.pid = del.pid AND f.username = del.username \
+            RETURNING i;",
+            ([e[0] for e in events], [e[1] for e in events],))
+        statuses = _event_statuses(cur, events)
+        cur.execute("UPDATE papers p SET like_count = p.like_count - n.count \
+            FROM (SELECT pid, COUNT(*) AS count FROM bulk_unlikes GROUP BY pid) n \
+            WHERE p.pid = n.pid;")
+        cur.execute("UPDATE like_buckets b SET likes = b.likes - n.count \
+            FROM (SELECT pid, date_trunc('hour', like_time) AS bucket, COUNT(*) AS count \
+                FROM bulk_unlikes GROUP BY 1, 2) n \
+            WHERE b.pid = n.pid AND b.bucket = n.bucket;")
+        cur.execute("DELETE FROM like_buckets b USING bulk_unlikes n \
+            WHERE b.pid = n.pid AND b.bucket = date_trunc('hour', n.like_time) AND b.likes <= 0;")
+        _remove_co_likes(cur, 'bulk_unlikes')
+        conn.commit()
+        done = [e for e, status in zip(events, statuses) if status == 0]
+        if done:
+            recommend.clear()
+            results.invalidate([('likes',)] + [('likes', pid) for uname, pid in done]
+                               + [('liked', uname) for uname, pid in done])
+        return 0, statuses
+    except psy.DatabaseError, e:
+        conn.rollback()
+        return 1, None
+
+
+@results.cached(lambda args: [('likes', args['pid'])])
 def get_likes(conn, pid):
     """
     Get the number of likes of a paper
@@ -418,18 +816,71 @@ def get_likes(conn, pid):
     """
     try:
         cur = conn.cursor()
-        sql = "SELECT COUNT(*) FROM likes WHERE pid = %s"
+        sql = "SELECT like_count FROM papers WHERE pid = %s AND deleted_at IS NULL;"
         data = (pid,)
-        cur.execute(sql, data)
-        like_count = cur.fetchone()[0]
-        return 0, like_count
+        statements.execute(cur, 'get_likes', sql, data)
+        like_count_db = cur.fetchone()
+        # a paper that does not exist has no likes
+        if like_count_db is None:
+            return 0, 0
+        return 0, like_count_db[0]
+    except psy.DatabaseError, e:
+        return 1, None
+
+
+def hydrate_papers(conn, pids):
+    """
+    Get the tags and like counts of many papers at once, e.g. of a page of
+    a list API, instead of calling get_paper_tags and get_likes per paper.
+
+    :param conn: A postgres database connection object
+    :param pids: A list of int pids
+    :return: (status, retval)
+        (0, [(pid, [tag1, tag2, ...], like_count), ...])
+                    Success, one triple per pid in the order of pids. The tags
+                    are sorted like get_paper_tags sorts them; a paper that
+                    does not exist has no tags and no likes.
+        (1, None)   Failure
+    """
+    if not pids:
+        return 0, []
+    try:
+        cur = conn.cursor()
+        sql = "SELECT q.pid, \
+                ARRAY(SELECT tagname FROM tags t WHERE t.pid = q.pid ORDER BY tagname), \
+                COALESCE(p.like_count, 0) \
+            FROM unnest(CAST(%s AS INT[])) WITH ORDINALITY q(pid, n) \
+            LEFT JOIN papers p ON p.pid = q.pid AND p.deleted_at IS NULL \
+            ORDER BY q.n;"
+        data = (list(pids),)
+        statements.execute(cur, 'hydrate_papers', sql, data)
+        return 0, cur.fetchall()
     except psy.DatabaseError, e:
         return 1, None
 
+
+def _hydrate(conn, status, papers, hydrate):
+    """
+    Append the tags and like count of every paper to the quintuples of a
+    list API result, if hydrate is set
+    """
+    if status != 0 or not hydrate:
+        return status, papers
+    status, res = hydrate_papers(conn, [paper[0] for paper in papers])
+    if status != 0:
+        return status, None
+    return 0, [tuple(paper) + (tags, likes) for paper, (pid, tags, likes) in zip(papers, res)]
+
 # Search related
 
+# Read APIs decorated with results.cached are served from the result cache
+# under the scopes they depend on; the write APIs invalidate those scopes
+# once they committed
 
-def get_timeline(conn, uname, count = 10):
+# List APIs hand out an opaque cursor of keyset.py with every page
+
+
+def get_timeline(conn, uname, count = 10, hydrate = False):
     """
     Get timeline of a user.
 
@@ -439,6 +890,8 @@ def get_timeline(conn, uname, count = 10):
     :param conn: A postgres database connection object
     :param uname: A string of username
     :param count: An int indicating the maximum number of papers you can return
+    :param hydrate: Whether to append the tags and like count of every
+                    paper to its quintuple, as returned by hydrate_papers
     :return: (status, retval)
         (0, [(pid, username, title, begin_time, description), (...), ...])
           Success, retval is a list of quintuple. Each element of the quintuple is of the following type:
@@ -458,19 +911,55 @@ def get_timeline(conn, uname, count = 10):
         (1, None)
             Failure
     """
+    status, res = get_timeline_page(conn, uname, count)
+    if status != 0:
+        return status, None
+    return _hydrate(conn, 0, res[0], hydrate)
+
+
+@results.cached(lambda args: [('user', args['uname'])])
+def get_timeline_page(conn, uname, count = 10, cursor = None):
+    """
+    Get a page of the timeline of a user.
+
+    Same order as get_timeline(). Pass the returned cursor back to get the
+    next page, which starts with a seek on (begin_time, pid) instead of
+    skipping the papers of the earlier pages.
+
+    :param conn: A postgres database connection object
+    :param uname: A string of username
+    :param count: An int indicating the maximum number of papers you can return
+    :param cursor: A cursor returned by the previous page, None for the first page
+    :return: (status, retval)
+        (0, ([pid, username, title, begin_time, description), (...), ...], cursor))
+            Success, retval is the list of quintuples and the cursor of the next page,
+            which is None when there are no more papers
+
+        (1, None)
+            Failure
+    """
     try:
         cur = conn.cursor()
-        sql = "SELECT pid, username, title, begin_time, description FROM papers \
-            WHERE username = %s ORDER BY begin_time DESC, pid LIMIT %s;"
-        data = (uname, count,)
-        cur.execute(sql, data)
+        if cursor is None:
+            sql = "SELECT pid, username, title, begin_time, description FROM papers \
+                WHERE username = %s AND deleted_at IS NULL ORDER BY begin_time DESC, pid LIMIT %s;"
+            data = (uname, count,)
+            statements.execute(cur, 'get_timeline', sql, data)
+        else:
+            after_time, after_pid = keyset.decode(cursor)
+            sql = "SELECT pid, username, title, begin_time, description FROM papers \
+                WHERE username = %s AND deleted_at IS NULL \
+                    AND (begin_time < %s OR (begin_time = %s AND pid > %s)) \
+                ORDER BY begin_time DESC, pid LIMIT %s;"
+            data = (uname, after_time, after_time, after_pid, count,)
+            statements.execute(cur, 'get_timeline_seek', sql, data)
         papers = cur.fetchall()
-        return 0, papers
-    except psy.DatabaseError, e:
+        return 0, (papers, keyset.next_cursor(papers, count))
+    except (psy.DatabaseError, ValueError), e:
         return 1, None
 
 
-def get_timeline_all(conn, count = 10):
+def get_timeline_all(conn, count = 10, hydrate = False):
     """
     Get at most $count recent papers
 
@@ -478,6 +967,8 @@ def get_timeline_all(conn, count = 10):
 
     :param conn: A postgres database connection object
     :param count: An int indicating the maximum number of papers you can return
+    :param hydrate: Whether to append the tags and like count of every
+                    paper to its quintuple, as returned by hydrate_papers
     :return: (status, retval)
         (0, [pid, username, title, begin_time, description), (...), ...])
             Success, retval is a list of quintuple. Please refer to the format defined in get_timeline()'s return value
@@ -485,19 +976,52 @@ def get_timeline_all(conn, count = 10):
         (1, None)
             Failure
     """
+    status, res = get_timeline_all_page(conn, count)
+    if status != 0:
+        return status, None
+    return _hydrate(conn, 0, res[0], hydrate)
+
+
+@results.cached(lambda args: [('papers',)])
+def get_timeline_all_page(conn, count = 10, cursor = None):
+    """
+    Get a page of the most recent papers.
+
+    Same order as get_timeline_all(). Pass the returned cursor back to get the next page.
+
+    :param conn: A postgres database connection object
+    :param count: An int indicating the maximum number of papers you can return
+    :param cursor: A cursor returned by the previous page, None for the first page
+    :return: (status, retval)
+        (0, ([pid, username, title, begin_time, description), (...), ...], cursor))
+            Success, retval is the list of quintuples and the cursor of the next page,
+            which is None when there are no more papers
+
+        (1, None)
+            Failure
+    """
     try:
         cur = conn.cursor()
-        sql = "SELECT pid, username, title, begin_time, description FROM papers \
-            ORDER BY begin_time DESC LIMIT %s;"
-        data = (count,)
-        cur.execute(sql, data)
+        if cursor is None:
+            sql = "SELECT pid, username, title, begin_time, description FROM papers \
+                WHERE deleted_at IS NULL ORDER BY begin_time DESC, pid LIMIT %s;"
+            data = (count,)
+            statements.execute(cur, 'get_timeline_all', sql, data)
+        else:
+            after_time, after_pid = keyset.decode(cursor)
+            sql = "SELECT pid, username, title, begin_time, description FROM papers \
+                WHERE deleted_at IS NULL \
+                    AND (begin_time < %s OR (begin_time = %s AND pid > %s)) \
+                ORDER BY begin_time DESC, pid LIMIT %s;"
+            data = (after_time, after_time, after_pid, count,)
+            statements.execute(cur, 'get_timeline_all_seek', sql, data)
         papers = cur.fetchall()
-        return 0, papers
-    except psy.DatabaseError, e:
+        return 0, (papers, keyset.next_cursor(papers, count))
+    except (psy.DatabaseError, ValueError), e:
         return 1, None
 
 
-def get_most_popular_papers(conn, begin_time, count = 10):
+def get_most_popular_papers(conn, begin_time, count = 10, hydrate = False):
     """
     Get at most $count papers posted after $begin_time according that have the most likes.
 
@@ -507,6 +1031,8 @@ def get_most_popular_papers(conn, begin_time, count = 10):
     :param conn: A postgres database connection object
     :param begin_time: A datetime.datetime object
     :param count:   An integer
+    :param hydrate: Whether to append the tags and like count of every
+                    paper to its quintuple, as returned by hydrate_papers
     :return: (status, retval)
         (0, [pid, username, title, begin_time, description), (...), ...])
             Success, retval is a list of quintuple. Please refer to the format defined in get_timeline()'s return value
@@ -514,25 +1040,92 @@ def get_most_popular_papers(conn, begin_time, count = 10):
         (1, None)
             Failure
     """
+    status, papers = _get_most_popular_papers(conn, begin_time, count)
+    return _hydrate(conn, status, papers, hydrate)
+
+
+@results.cached(lambda args: [('likes',)])
+def _get_most_popular_papers(conn, begin_time, count):
+    """
+    Get at most $count papers posted after $begin_time with the most likes
+    """
     try:
         cur = conn.cursor()
-        sql = "WITH LikeCount AS ( \
-            SELECT pid, COUNT(*) AS count FROM likes GROUP BY pid) \
-            SELECT p.pid, p.username, title, begin_time, description \
-                FROM papers p INNER JOIN LikeCount l \
-                    ON p.pid = l.pid \
-                WHERE begin_time > TIMESTAMP %s \
-                ORDER BY l.count DESC, p.pid ASC \
-                LIMIT %s;"
+        # walks paper_like_count_idx in order and stops after $count matches
+        sql = "SELECT pid, username, title, begin_time, description \
+            FROM papers WHERE like_count > 0 AND begin_time > CAST(%s AS TIMESTAMP) \
+                AND deleted_at IS NULL \
+            ORDER BY like_count DESC, pid ASC \
+            LIMIT %s;"
         data = (str(begin_time), count,)
-        cur.execute(sql, data)
+        statements.execute(cur, 'get_most_popular_papers', sql, data)
+        papers = cur.fetchall()
+        return 0, papers
+    except psy.DatabaseError, e:
+        return 1, None
+
+
+# Buckets older than this many half-lives weigh less than 1/1000 of a new
+# like and are left out of the trending scores
+TRENDING_HORIZON = 10
+
+
+def get_trending_papers(conn, half_life, count = 10, hydrate = False):
+    """
+    Get at most $count papers with the most recent likes. Every like counts
+    for one when it is made and half as much every $half_life after that;
+    likes are counted at the start of their hour.
+
+    Order papers by score (descending) and break ties by pid (ascending).
+
+    :param conn: A postgres database connection object
+    :param half_life: A datetime.timedelta, the time after which a like
+                      counts half
+    :param count:   An integer
+    :param hydrate: Whether to append the tags and like count of every
+                    paper to its quintuple, as returned by hydrate_papers
+    :return: (status, retval)
+        (0, [pid, username, title, begin_time, description), (...), ...])
+            Success, retval is a list of quintuple. Please refer to the format defined in get_timeline()'s return value
+
+        (1, None)
+            Failure, e.g. a half_life that is not positive
+    """
+    status, papers = _get_trending_papers(conn, half_life, count)
+    return _hydrate(conn, status, papers, hydrate)
+
+
+@results.cached(lambda args: [('likes',)])
+def _get_trending_papers(conn, half_life, count):
+    """
+    Get at most $count papers with the most recent likes
+    """
+    seconds = half_life.total_seconds()
+    if seconds <= 0:
+        return 1, None
+    now = datetime.now(timezone('US/Eastern')).replace(tzinfo=None)
+    since = now - TRENDING_HORIZON * half_life
+    try:
+        cur = conn.cursor()
+        # only the buckets of the horizon are read, through like_bucket_time_idx
+        sql = "SELECT p.pid, p.username, p.title, p.begin_time, p.description \
+            FROM (SELECT pid, SUM(likes * power(0.5, \
+                        EXTRACT(EPOCH FROM CAST(%s AS TIMESTAMP) - bucket) / CAST(%s AS FLOAT8))) \
+                        AS score \
+                FROM like_buckets WHERE bucket > CAST(%s AS TIMESTAMP) GROUP BY pid) s \
+            INNER JOIN papers p ON p.pid = s.pid \
+            WHERE p.deleted_at IS NULL \
+            ORDER BY s.score DESC, p.pid ASC \
+            LIMIT %s;"
+        data = (str(now), seconds, str(since), count,)
+        statements.execute(cur, 'get_trending_papers', sql, data)
         papers = cur.fetchall()
         return 0, papers
     except psy.DatabaseError, e:
         return 1, None
 
 
-def get_recommend_papers(conn, uname, count = 10):
+def get_recommend_papers(conn, uname, count = 10, hydrate = False):
     """
     Recommended at most $count papers for a user.
 
@@ -541,6 +1134,8 @@ def get_recommend_papers(conn, uname, count = 10):
     :param conn: A postgres database connection object
     :param uname: A string of username
     :param count:   An integer
+    :param hydrate: Whether to append the tags and like count of every
+                    paper to its quintuple, as returned by hydrate_papers
     :return:    (status, retval)
         (0, [pid, username, title, begin_time, description), (...), ...])
             Success, retval is a list of quintuple. Please refer to the format defined in get_timeline()'s return value
@@ -548,29 +1143,44 @@ def get_recommend_papers(conn, uname, count = 10):
         (1, None)
             Failure
     """
+    papers = recommend.lookup(uname, count)
+    if papers is not None:
+        return _hydrate(conn, 0, papers, hydrate)
     try:
         cur = conn.cursor()
-        # Cohorts are people who like the same papers
-        sql = "WITH Cohort AS ( \
-            SELECT l1.pid, l2.username FROM likes l1 INNER JOIN likes l2 \
-                ON l1.username = %s AND l1.username != l2.username AND l1.pid = l2.pid) \
+        version = recommend.version(uname)
+        depth = max(count, recommend.RECOMMEND_DEPTH)
+        # Cohorts are people who like the same papers; co_likes lists them
+        # directly. It counts the likes of deleted papers until they are
+        # purged, so the pairs those make are taken off, like rebuild does.
+        # Papers the user likes are not recommended again
+        sql = "WITH gone AS ( \
+                SELECT b.username AS other, COUNT(*) AS count FROM papers q \
+                    INNER JOIN likes a ON a.pid = q.pid AND a.username = %s \
+                    INNER JOIN likes b ON b.pid = q.pid AND b.username != a.username \
+                    WHERE q.deleted_at IS NOT NULL \
+                    GROUP BY b.username) \
             SELECT p.pid, p.username, title, begin_time, description \
-                FROM papers p INNER JOIN ( \
-                    SELECT pid, COUNT(*) AS count FROM likes \
-                        WHERE pid NOT IN (SELECT pid FROM Cohort) \
-                            AND username IN (SELECT username FROM Cohort) \
-                        GROUP BY pid LIMIT %s) c ON p.pid = c.pid \
-                        WHERE p.username != %s \
-                        ORDER BY c.count DESC, p.pid;"
-        data = (uname, count, uname,)
-        cur.execute(sql, data)
+            FROM papers p INNER JOIN ( \
+                SELECT l.pid, COUNT(*) AS count FROM co_likes c \
+                    LEFT JOIN gone g ON g.other = c.other \
+                    INNER JOIN likes l ON l.username = c.other \
+                    WHERE c.username = %s AND c.shared > COALESCE(g.count, 0) AND NOT EXISTS ( \
+                        SELECT 1 FROM likes m WHERE m.username = %s AND m.pid = l.pid) \
+                    GROUP BY l.pid) r ON p.pid = r.pid \
+            WHERE p.username != %s AND p.deleted_at IS NULL \
+            ORDER BY r.count DESC, p.pid \
+            LIMIT %s;"
+        data = (uname, uname, uname, uname, depth,)
+        statements.execute(cur, 'get_recommend_papers', sql, data)
         papers = cur.fetchall()
-        return 0, papers
+        recommend.store(uname, version, papers, len(papers) < depth)
     except psy.DatabaseError, e:
         return 1, None
+    return _hydrate(conn, 0, papers[:count], hydrate)
 
 
-def get_papers_by_tag(conn, tag, count = 10):
+def get_papers_by_tag(conn, tag, count = 10, hydrate = False):
     """
     Get at most $count papers that have the given tag
 
@@ -579,6 +1189,8 @@ def get_papers_by_tag(conn, tag, count = 10):
     :param conn: A postgres database connection object
     :param tag: A string of tag
     :param count: An integer
+    :param hydrate: Whether to append the tags and like count of every
+                    paper to its quintuple, as returned by hydrate_papers
     :return:    (status, retval)
         (0, [pid, username, title, begin_time, description), (...), ...])
             Success, retval is a list of quintuple. Please refer to the format defined in get_timeline()'s return value
@@ -586,29 +1198,111 @@ def get_papers_by_tag(conn, tag, count = 10):
         (1, None)
             Failure
     """
+    status, res = get_papers_by_tag_page(conn, tag, count)
+    if status != 0:
+        return status, None
+    return _hydrate(conn, 0, res[0], hydrate)
+
+
+@results.cached(lambda args: [('tag', args['tag'])])
+def get_papers_by_tag_page(conn, tag, count = 10, cursor = None):
+    """
+    Get a page of the papers that have the given tag.
+
+    Same order as get_papers_by_tag(). Pass the returned cursor back to get the next page.
+
+    :param conn: A postgres database connection object
+    :param tag: A string of tag
+    :param count: An integer
+    :param cursor: A cursor returned by the previous page, None for the first page
+    :return:    (status, retval)
+        (0, ([pid, username, title, begin_time, description), (...), ...], cursor))
+            Success, retval is the list of quintuples and the cursor of the next page,
+            which is None when there are no more papers
+
+        (1, None)
+            Failure
+    """
     try:
         cur = conn.cursor()
-        sql = "SELECT p.pid, p.username, title, begin_time, description \
-            FROM papers p INNER JOIN tags t ON p.pid = t.pid \
-            WHERE t.tagname = %s ORDER BY begin_time DESC, p.pid ASC \
-            LIMIT %s"
-        data = (tag, count,)
-        cur.execute(sql, data)
+        if cursor is None:
+            sql = "SELECT p.pid, p.username, title, begin_time, description \
+                FROM papers p INNER JOIN tags t ON p.pid = t.pid \
+                WHERE t.tagname = %s AND p.deleted_at IS NULL \
+                ORDER BY begin_time DESC, p.pid ASC \
+                LIMIT %s"
+            data = (tag, count,)
+            statements.execute(cur, 'get_papers_by_tag', sql, data)
+        else:
+            after_time, after_pid = keyset.decode(cursor)
+            sql = "SELECT p.pid, p.username, title, begin_time, description \
+                FROM papers p INNER JOIN tags t ON p.pid = t.pid \
+                WHERE t.tagname = %s AND p.deleted_at IS NULL \
+                    AND (begin_time < %s OR (begin_time = %s AND p.pid > %s)) \
+                ORDER BY begin_time DESC, p.pid ASC \
+                LIMIT %s"
+            data = (tag, after_time, after_time, after_pid, count,)
+            statements.execute(cur, 'get_papers_by_tag_seek', sql, data)
         papers = cur.fetchall()
-        return 0, papers
+        return 0, (papers, keyset.next_cursor(papers, count))
+    except (psy.DatabaseError, ValueError), e:
+        return 1, None
+
+
+def suggest_tags(conn, prefix, count = 10):
+    """
+    Get at most $count tags that start with $prefix, to complete a tag being
+    typed. Tags are matched case sensitively and only tags that some paper
+    has are suggested.
+
+    The result should first be ordered by number of papers that have the tag (descending). Break ties
+    by tag name (lexically ascending).
+
+    The tags are served from the in-process index of tag_index.py, which is
+    loaded on the first call. Its tag names compare in byte order, like
+    COLLATE "C", so ties may be ordered unlike get_most_popular_tags, which
+    uses the collation of the database.
+
+    :param conn: A postgres database connection object
+    :param prefix: A string, the beginning of the tag names
+    :param count: An integer
+    :return:
+        (0, [(tagname1, count1), (tagname2, count2), ...])
+            Success, in the format of get_most_popular_tags()
+        (1, None)
+            Failure
+    """
+    tags = tag_index.suggest(prefix, count)
+    if tags is not None:
+        return 0, tags
+    try:
+        cur = conn.cursor()
+        version = tag_index.version()
+        sql = "SELECT tagname, count FROM tag_counts;"
+        statements.execute(cur, 'suggest_tags_load', sql)
+        index = tag_index.install(version, cur.fetchall())
     except psy.DatabaseError, e:
         return 1, None
+    return 0, index.suggest(prefix, count)
 
 
-def get_papers_by_keyword(conn, keyword, count = 10):
+def get_papers_by_keyword(conn, keyword, count = 10, ranked = False, hydrate = False):
     """
     Get at most $count papers that match a keyword in its title, description *or* text field
 
     The result should first be ordered by begin time (newest first). Break ties by pid (ascending).
 
+    The keyword is parsed like a web search query, so several words, "quoted phrases", "or" and
+    -negation are accepted. With ranked=True the papers are ordered by relevance instead, where
+    matches in the title weigh more than in the description, and those more than in the text.
+    Ties are broken by begin time (newest first) and then by pid (ascending).
+
     :param conn: A postgres database connection object
     :param keyword: A string of keyword, e.g. "database"
     :param count: An integer
+    :param ranked: Whether to order by relevance instead of by time
+    :param hydrate: Whether to append the tags and like count of every
+                    paper to its quintuple, as returned by hydrate_papers
     :return:    (status, retval)
         (0, [pid, username, title, begin_time, description), (...), ...])
             Success, retval is a list of quintuple. Please refer to the format defined in get_timeline()'s return value
@@ -616,21 +1310,78 @@ def get_papers_by_keyword(conn, keyword, count = 10):
         (1, None)
             Failure
     """
+    if ranked:
+        status, papers = _get_papers_by_keyword_ranked(conn, keyword, count)
+        return _hydrate(conn, status, papers, hydrate)
+    status, res = get_papers_by_keyword_page(conn, keyword, count)
+    if status != 0:
+        return status, None
+    return _hydrate(conn, 0, res[0], hydrate)
+
+
+@results.cached(lambda args: [('papers',)])
+def _get_papers_by_keyword_ranked(conn, keyword, count):
+    """
+    Get at most $count papers that match a keyword, most relevant first
+    """
     try:
         cur = conn.cursor()
         sql = "SELECT pid, username, title, begin_time, description \
-            FROM papers WHERE title @@ to_tsquery(%s) OR \
-            description @@ to_tsquery(%s) OR data @@ to_tsquery(%s) \
-            ORDER BY begin_time DESC, pid ASC LIMIT %s;"
-        data = (keyword, keyword, keyword, count,)
-        cur.execute(sql, data)
+            FROM papers, websearch_to_tsquery('english', %s) q \
+            WHERE search_vector @@ q AND deleted_at IS NULL \
+            ORDER BY ts_rank_cd(search_vector, q) DESC, begin_time DESC, pid ASC \
+            LIMIT %s;"
+        data = (keyword, count,)
+        statements.execute(cur, 'get_papers_by_keyword_ranked', sql, data)
         papers = cur.fetchall()
         return 0, papers
     except psy.DatabaseError, e:
         return 1, None
 
 
-def get_papers_by_liked(conn, uname, count = 10):
+@results.cached(lambda args: [('papers',)])
+def get_papers_by_keyword_page(conn, keyword, count = 10, cursor = None):
+    """
+    Get a page of the papers that match a keyword.
+
+    Same order as get_papers_by_keyword(). Pass the returned cursor back to get the next page.
+
+    :param conn: A postgres database connection object
+    :param keyword: A string of keyword, e.g. "database"
+    :param count: An integer
+    :param cursor: A cursor returned by the previous page, None for the first page
+    :return:    (status, retval)
+        (0, ([pid, username, title, begin_time, description), (...), ...], cursor))
+            Success, retval is the list of quintuples and the cursor of the next page,
+            which is None when there are no more papers
+
+        (1, None)
+            Failure
+    """
+    try:
+        cur = conn.cursor()
+        # search_vector covers title, description and text and is indexed
+        if cursor is None:
+            sql = "SELECT pid, username, title, begin_time, description \
+                FROM papers WHERE search_vector @@ websearch_to_tsquery('english', %s) \
+                AND deleted_at IS NULL ORDER BY begin_time DESC, pid ASC LIMIT %s;"
+            data = (keyword, count,)
+            statements.execute(cur, 'get_papers_by_keyword', sql, data)
+        else:
+            after_time, after_pid = keyset.decode(cursor)
+            sql = "SELECT pid, username, title, begin_time, description \
+                FROM papers WHERE search_vector @@ websearch_to_tsquery('english', %s) \
+                AND deleted_at IS NULL AND (begin_time < %s OR (begin_time = %s AND pid > %s)) \
+                ORDER BY begin_time DESC, pid ASC LIMIT %s;"
+            data = (keyword, after_time, after_time, after_pid, count,)
+            statements.execute(cur, 'get_papers_by_keyword_seek', sql, data)
+        papers = cur.fetchall()
+        return 0, (papers, keyset.next_cursor(papers, count))
+    except (psy.DatabaseError, ValueError), e:
+        return 1, None
+
+
+def get_papers_by_liked(conn, uname, count = 10, hydrate = False):
     """
     Get at most $count papers that liked by the given user.
 
@@ -639,6 +1390,8 @@ def get_papers_by_liked(conn, uname, count = 10):
     :param conn: A postgres database connection object
     :param uname: A string of username
     :param count: An integer
+    :param hydrate: Whether to append the tags and like count of every
+                    paper to its quintuple, as returned by hydrate_papers
     :return:    (status, retval)
         (0, [pid, username, title, begin_time, description), (...), ...])
             Success, retval is a list of quintuple. Please refer to the format defined in get_timeline()'s return value
@@ -646,24 +1399,66 @@ def get_papers_by_liked(conn, uname, count = 10):
         (1, None)
             Failure
     """
+    status, res = get_papers_by_liked_page(conn, uname, count)
+    if status != 0:
+        return status, None
+    return _hydrate(conn, 0, res[0], hydrate)
+
+
+@results.cached(lambda args: [('liked', args['uname'])])
+def get_papers_by_liked_page(conn, uname, count = 10, cursor = None):
+    """
+    Get a page of the papers liked by the given user.
+
+    Same order as get_papers_by_liked(). Pass the returned cursor back to get the next page,
+    which starts with a seek on (like_time, pid).
+
+    :param conn: A postgres database connection object
+    :param uname: A string of username
+    :param count: An integer
+    :param cursor: A cursor returned by the previous page, None for the first page
+    :return:    (status, retval)
+        (0, ([pid, username, title, begin_time, description), (...), ...], cursor))
+            Success, retval is the list of quintuples and the cursor of the next page,
+            which is None when there are no more papers
+
+        (1, None)
+            Failure
+    """
     try:
         cur = conn.cursor()
         # l.username because we want papers liked by the user
-        sql = "SELECT p.pid, p.username, title, begin_time, description \
-            FROM papers p INNER JOIN likes l ON p.pid = l.pid  \
-            WHERE l.username = %s ORDER BY like_time DESC, pid ASC \
-            LIMIT %s;"
-        data = (uname, count,)
-        cur.execute(sql, data)
-        papers = cur.fetchall()
-        return 0, papers
-    except psy.DatabaseError, e:
+        if cursor is None:
+            sql = "SELECT p.pid, p.username, title, begin_time, description, like_time \
+                FROM papers p INNER JOIN likes l ON p.pid = l.pid  \
+                WHERE l.username = %s AND p.deleted_at IS NULL \
+                ORDER BY like_time DESC, pid ASC \
+                LIMIT %s;"
+            data = (uname, count,)
+            statements.execute(cur, 'get_papers_by_liked', sql, data)
+        else:
+            after_time, after_pid = keyset.decode(cursor)
+            sql = "SELECT p.pid, p.username, title, begin_time, description, like_time \
+                FROM papers p INNER JOIN likes l ON p.pid = l.pid  \
+                WHERE l.username = %s AND p.deleted_at IS NULL \
+                    AND (like_time < %s OR (like_time = %s AND p.pid > %s)) \
+                ORDER BY like_time DESC, pid ASC \
+                LIMIT %s;"
+            data = (uname, after_time, after_time, after_pid, count,)
+            statements.execute(cur, 'get_papers_by_liked_seek', sql, data)
+        rows = cur.fetchall()
+        next_cursor = keyset.next_cursor(rows, count, key=lambda row: (row[5], row[0]))
+        # like_time is only needed for the cursor
+        papers = [row[:5] for row in rows]
+        return 0, (papers, next_cursor)
+    except (psy.DatabaseError, ValueError), e:
         return 1, None
 
 
 # Statistics related
 
 
+@results.cached(lambda args: [('papers',)])
 def get_most_active_users(conn, count = 1):
     """
     Get at most $count users that post most papers.
@@ -682,11 +1477,11 @@ def get_most_active_users(conn, count = 1):
     """
     try:
         cur = conn.cursor()
-        sql = "SELECT username, COUNT(*) AS count FROM papers \
+        sql = "SELECT username, COUNT(*) AS count FROM papers WHERE deleted_at IS NULL \
             GROUP BY username ORDER BY count DESC, username ASC \
             LIMIT %s;"
         data = (count,)
-        cur.execute(sql, data)
+        statements.execute(cur, 'get_most_active_users', sql, data)
         user_counts = cur.fetchall()
         users = []
         for u in user_counts:
@@ -696,6 +1491,7 @@ def get_most_active_users(conn, count = 1):
         return 1, None
 
 
+@results.cached(lambda args: [('tags',)])
 def get_most_popular_tags(conn, count = 1):
     """
     Get at most $count many tags that gets most used among all papers
@@ -714,17 +1510,19 @@ def get_most_popular_tags(conn, count = 1):
     """
     try:
         cur = conn.cursor()
-        sql = "SELECT tagname, COUNT(*) AS count \
-            FROM tags GROUP BY tagname ORDER BY count DESC, tagname ASC \
+        # tag_counts is kept up to date by the triggers on tags
+        sql = "SELECT tagname, count FROM tag_counts \
+            ORDER BY count DESC, tagname ASC \
             LIMIT %s;"
         data = (count,)
-        cur.execute(sql, data)
+        statements.execute(cur, 'get_most_popular_tags', sql, data)
         tags = cur.fetchall()
         return 0, tags
     except psy.DatabaseError, e:
         return 1, None
 
 
+@results.cached(lambda args: [('tags',)])
 def get_most_popular_tag_pairs(conn, count = 1):
     """
     Get at most $count many tag pairs that have been used together.
@@ -744,20 +1542,20 @@ def get_most_popular_tag_pairs(conn, count = 1):
     """
     try:
         cur = conn.cursor()
-        sql = "SELECT t1.tagname, t2.tagname, COUNT(*) AS count \
-            FROM tags t1 INNER JOIN tags t2 \
-            ON t1.pid = t2.pid AND t1.tagname < t2.tagname \
-            GROUP BY t1.tagname, t2.tagname \
-            ORDER BY count DESC, t1.tagname ASC, t2.tagname ASC \
+        # tag_pair_counts is kept up to date by the triggers on tags,
+        # with tag1 < tag2 in every row
+        sql = "SELECT tag1, tag2, count FROM tag_pair_counts \
+            ORDER BY count DESC, tag1 ASC, tag2 ASC \
             LIMIT %s;"
         data = (count,)
-        cur.execute(sql, data)
+        statements.execute(cur, 'get_most_popular_tag_pairs', sql, data)
         pairs = cur.fetchall()
         return 0, pairs
     except psy.DatabaseError, e:
         return 1, None
 
 
+@results.cached(lambda args: [('user', args['uname'])])
 def get_number_papers_user(conn, uname):
     """
     Get the number of papers posted by a given user.
@@ -772,15 +1570,16 @@ def get_number_papers_user(conn, uname):
     """
     try:
         cur = conn.cursor()
-        sql = "SELECT COUNT(*) FROM papers WHERE username = %s;"
+        sql = "SELECT COUNT(*) FROM papers WHERE username = %s AND deleted_at IS NULL;"
         data = (uname,)
-        cur.execute(sql, data)
+        statements.execute(cur, 'get_number_papers_user', sql, data)
         count = cur.fetchone()[0]
         return 0, count
     except psy.DatabaseError, e:
         return 1, None
 
 
+@results.cached(lambda args: [('liked', args['uname'])])
 def get_number_liked_user(conn, uname):
     """
     Get the number of likes liked by the user
@@ -795,15 +1594,18 @@ def get_number_liked_user(conn, uname):
     """
     try:
         cur = conn.cursor()
-        sql = "SELECT COUNT(*) FROM likes WHERE username = %s;"
+        # tombstoned papers are few, paper_deleted_idx finds them
+        sql = "SELECT COUNT(*) FROM likes l WHERE username = %s AND NOT EXISTS ( \
+            SELECT 1 FROM papers p WHERE p.pid = l.pid AND p.deleted_at IS NOT NULL);"
         data = (uname,)
-        cur.execute(sql, data)
+        statements.execute(cur, 'get_number_liked_user', sql, data)
         count = cur.fetchone()[0]
         return 0, count
     except psy.DatabaseError, e:
         return 1, None
 
 
+@results.cached(lambda args: [('user', args['uname'])])
 def get_number_tags_user(conn, uname):
     """
     Get the number of distinct tagnames used by the user.
@@ -821,10 +1623,82 @@ def get_number_tags_user(conn, uname):
     try:
         cur = conn.cursor()
         sql = "SELECT COUNT(DISTINCT tagname) FROM tags t INNER JOIN papers p \
-            on t.pid = p.pid WHERE p.username = %s;"
+            on t.pid = p.pid WHERE p.username = %s AND p.deleted_at IS NULL;"
         data = (uname,)
-        cur.execute(sql, data)
+        statements.execute(cur, 'get_number_tags_user', sql, data)
         count = cur.fetchone()[0]
         return 0, count
     except psy.DatabaseError, e:
         return 1, None
+
+
+@results.cached(lambda args: [('user', args['uname']), ('liked', args['uname'])])
+def get_user_profile(conn, uname, count = 10):
+    """
+    Get everything a profile page shows about a user in one round trip.
+
+    The values are the same as the ones of get_number_papers_user, get_number_liked_user,
+    get_number_tags_user, get_timeline and get_papers_by_liked with the same uname and count.
+
+    :param conn: A postgres database connection object
+    :param uname: A string of username
+    :param count: An int indicating the maximum number of papers in each list
+    :return:
+        (0, {'number_papers': count, 'number_liked': count, 'number_tags': count,
+             'timeline': [(pid, username, title, begin_time, description), ...],
+             'papers_by_liked': [(pid, username, title, begin_time, description), ...]})
+            Success, the lists are in the order of get_timeline and get_papers_by_liked
+        (1, None)
+            Failure
+    """
+    try:
+        cur = conn.cursor()
+        # part 0 is a single row of counters, parts 1 and 2 are the papers
+        # posted and liked by the user, sorted by post and like time
+        sql = "SELECT 0, NULL, NULL, NULL, NULL, NULL, NULL, \
+                (SELECT COUNT(*) FROM papers WHERE username = %s AND deleted_at IS NULL), \
+                (SELECT COUNT(*) FROM likes l WHERE username = %s AND NOT EXISTS ( \
+                    SELECT 1 FROM papers p WHERE p.pid = l.pid AND p.deleted_at IS NOT NULL)), \
+                (SELECT COUNT(DISTINCT tagname) FROM tags t INNER JOIN papers p \
+                    ON t.pid = p.pid WHERE p.username = %s AND p.deleted_at IS NULL) \
+            UNION ALL \
+            (SELECT 1, pid, username, title, begin_time, description, begin_time, NULL, NULL, NULL \
+                FROM papers WHERE username = %s AND deleted_at IS NULL \
+                ORDER BY begin_time DESC, pid LIMIT %s) \
+            UNION ALL \
+            (SELECT 2, p.pid, p.username, title, begin_time, description, like_time, NULL, NULL, NULL \
+                FROM papers p INNER JOIN likes l ON p.pid = l.pid \
+                WHERE l.username = %s AND p.deleted_at IS NULL ORDER BY like_time DESC, p.pid LIMIT %s) \
+            ORDER BY 1, 7 DESC, 2;"
+        data = (uname, uname, uname, uname, count, uname, count,)
+        statements.execute(cur, 'get_user_profile', sql, data)
+        rows = cur.fetchall()
+        counts = rows[0]
+        profile = {
+            'number_papers': counts[7],
+            'number_liked': counts[8],
+            'number_tags': counts[9],
+            'timeline': [row[1:6] for row in rows if row[0] == 1],
+            'papers_by_liked': [row[1:6] for row in rows if row[0] == 2],
+        }
+        return 0, profile
+    except psy.DatabaseError, e:
+        return 1, None
+
+
+# Every API of this module, for the layers that wrap all of them
+API = (
+    'reset_db', 'reconcile_like_counts', 'purge_deleted_papers',
+    'signup', 'login', 'login_session', 'check_session',
+    'add_new_paper', 'delete_paper', 'delete_papers', 'get_paper_tags',
+    'like_paper', 'unlike_paper', 'like_papers_bulk', 'unlike_papers_bulk', 'get_likes',
+    'hydrate_papers',
+    'get_timeline', 'get_timeline_page', 'get_timeline_all', 'get_timeline_all_page',
+    'get_most_popular_papers', 'get_trending_papers', 'get_recommend_papers',
+    'get_papers_by_tag', 'get_papers_by_tag_page', 'suggest_tags',
+    'get_papers_by_keyword', 'get_papers_by_keyword_page',
+    'get_papers_by_liked', 'get_papers_by_liked_page',
+    'get_most_active_users', 'get_most_popular_tags', 'get_most_popular_tag_pairs',
+    'get_number_papers_user', 'get_number_liked_user', 'get_number_tags_user',
+    'get_user_profile',
+)
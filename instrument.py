@@ -0,0 +1,286 @@
+"""
+Opt-in per-API instrumentation of functions.py.
+
+The APIs turn database errors into status codes, so a slow or failing call
+leaves no trace. enable() replaces every API in functions.API with a wrapper
+that records, per API,
+
+    - a histogram of the wall time of the calls
+    - the number of statements executed and rows fetched
+    - the number of commits and rollbacks
+    - the number of calls per returned status code (or 'exception')
+
+The wrapper hands the API a proxy of its connection whose cursors count what
+they execute and fetch. Cursors still report the real connection as their
+.connection, so statements.py keys its prepared statements by the real one.
+Calls made by an instrumented API to other APIs are counted as part of the
+outer call only.
+
+disable() puts the original functions back, so there is no cost at all when
+instrumentation is off. The data is available from stats() and, in the
+Prometheus text exposition format, from prometheus_text().
+"""
+
+import bisect
+import functools
+import threading
+import time
+
+import functions
+
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_local = threading.local()
+# api name -> _Metrics
+_metrics = {}
+# api name -> original function while enabled
+_originals = {}
+
+
+class _Call(object):
+    """
+    Counters of a single API call
+    """
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.commits = 0
+        self.rollbacks = 0
+
+
+class _Metrics(object):
+    """
+    Accumulated counters of one API. Updated under _lock.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.seconds = 0.0
+        self.calls = 0
+        self.statements = 0
+        self.rows = 0
+        self.commits = 0
+        self.rollbacks = 0
+        self.statuses = {}
+
+    def add(self, call, seconds, status):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.seconds += seconds
+        self.calls += 1
+        self.statements += call.statements
+        self.rows += call.rows
+        self.commits += call.commits
+        self.rollbacks += call.rollbacks
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+class _Cursor(object):
+    """
+    Cursor proxy counting statements and fetched rows
+    """
+
+    def __init__(self, cursor, call):
+        self._cursor = cursor
+        self._call = call
+
+    def execute(self, *args, **kwargs):
+        self._call.statements += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, sql, seq):
+        seq = list(seq)
+        self._call.statements += len(seq)
+        return self._cursor.executemany(sql, seq)
+
+    def copy_expert(self, *args, **kwargs):
+        self._call.statements += 1
+        return self._cursor.copy_expert(*args, **kwargs)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._call.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._call.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._call.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._call.rows += 1
+            yield row
+
+    def __getattr__(self, name):
+        # connection, rowcount, description, close, ... of the real cursor
+        return getattr(self._cursor, name)
+
+
+class _Connection(object):
+    """
+    Connection proxy counting commits and rollbacks and handing out
+    counting cursors
+    """
+
+    def __init__(self, conn, call):
+        self.__dict__['_conn'] = conn
+        self.__dict__['_call'] = call
+
+    def cursor(self, *args, **kwargs):
+        return _Cursor(self._conn.cursor(*args, **kwargs), self._call)
+
+    def commit(self):
+        self._call.commits += 1
+        return self._conn.commit()
+
+    def rollback(self):
+        self._call.rollbacks += 1
+        return self._conn.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        # e.g. autocommit, which migrations switch on and off
+        setattr(self._conn, name, value)
+
+
+def _wrap(name, func):
+    @functools.wraps(func)
+    def wrapper(conn, *args, **kwargs):
+        if getattr(_local, 'call', None) is not None:
+            # called by another API, which accounts for it
+            return func(conn, *args, **kwargs)
+        call = _Call()
+        _local.call = call
+        status = 'exception'
+        start = time.time()
+        try:
+            ret = func(_Connection(conn, call) if conn is not None else None,
+                       *args, **kwargs)
+            status = ret[0]
+            return ret
+        finally:
+            seconds = time.time() - start
+            _local.call = None
+            with _lock:
+                metrics = _metrics.get(name)
+                if metrics is None:
+                    metrics = _metrics[name] = _Metrics()
+                metrics.add(call, seconds, status)
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+def enable():
+    """
+    Start recording, by replacing every API in functions with a wrapper
+    """
+    with _lock:
+        for name in functions.API:
+            if name not in _originals:
+                _originals[name] = getattr(functions, name)
+                setattr(functions, name, _wrap(name, _originals[name]))
+
+
+def disable():
+    """
+    Stop recording and put the original APIs back. Recorded data is kept.
+    """
+    with _lock:
+        for name, func in _originals.items():
+            setattr(functions, name, func)
+        _originals.clear()
+
+
+def enabled():
+    return bool(_originals)
+
+
+def reset():
+    """
+    Drop everything recorded so far
+    """
+    with _lock:
+        _metrics.clear()
+
+
+def stats():
+    """
+    Get the recorded data
+
+    :return: A dict of api name to a dict with 'calls', 'seconds' (total),
+             'buckets' (list of (upper bound, cumulative count), the last bound
+             being inf), 'statements', 'rows', 'commits', 'rollbacks' and
+             'statuses' (dict of status code to number of calls)
+    """
+    result = {}
+    with _lock:
+        for name, m in _metrics.iteritems():
+            cumulative = []
+            total = 0
+            for bound, count in zip(BUCKETS + (float('inf'),), m.buckets):
+                total += count
+                cumulative.append((bound, total))
+            result[name] = {
+                'calls': m.calls,
+                'seconds': m.seconds,
+                'buckets': cumulative,
+                'statements': m.statements,
+                'rows': m.rows,
+                'commits': m.commits,
+                'rollbacks': m.rollbacks,
+                'statuses': dict(m.statuses),
+            }
+    return result
+
+
+def _bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def prometheus_text(prefix='paper_api'):
+    """
+    Dump the recorded data in the Prometheus text exposition format
+
+    :param prefix: Prefix of the metric names
+    :return: A string
+    """
+    data = stats()
+    names = sorted(data)
+    lines = [
+        '# HELP %s_duration_seconds Wall time of API calls.' % prefix,
+        '# TYPE %s_duration_seconds histogram' % prefix,
+    ]
+    for name in names:
+        for bound, count in data[name]['buckets']:
+            lines.append('%s_duration_seconds_bucket{api="%s",le="%s"} %d'
+                         % (prefix, name, _bound(bound), count))
+        lines.append('%s_duration_seconds_sum{api="%s"} %r' % (prefix, name, data[name]['seconds']))
+        lines.append('%s_duration_seconds_count{api="%s"} %d' % (prefix, name, data[name]['calls']))
+    for metric, key, text in (
+            ('statements', 'statements', 'Statements executed by API calls.'),
+            ('rows', 'rows', 'Rows fetched by API calls.'),
+            ('commits', 'commits', 'Commits made by API calls.'),
+            ('rollbacks', 'rollbacks', 'Rollbacks made by API calls.')):
+        lines.append('# HELP %s_%s_total %s' % (prefix, metric, text))
+        lines.append('# TYPE %s_%s_total counter' % (prefix, metric))
+        for name in names:
+            lines.append('%s_%s_total{api="%s"} %d' % (prefix, metric, name, data[name][key]))
+    lines.append('# HELP %s_calls_total API calls by returned status.' % prefix)
+    lines.append('# TYPE %s_calls_total counter' % prefix)
+    for name in names:
+        for status, count in sorted(data[name]['statuses'].items()):
+            lines.append('%s_calls_total{api="%s",status="%s"} %d' % (prefix, name, status, count))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,39 @@
+"""
+Opaque cursors of the paged list APIs.
+
+A cursor is the sort key (time, pid) of the last row of a page; the next page
+seeks past it instead of skipping the rows of earlier pages. Shared by
+functions.py and memory_engine.py so cursors of one work with the other.
+"""
+
+import base64
+import json
+
+from datetime import datetime
+
+
+CURSOR_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def encode(sort_time, pid):
+    return base64.urlsafe_b64encode(json.dumps([sort_time.strftime(CURSOR_TIME_FORMAT), pid]))
+
+
+def decode(cursor):
+    """
+    Get the (sort_time, pid) of a cursor, raises ValueError if it is malformed
+    """
+    try:
+        sort_time, pid = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return datetime.strptime(sort_time, CURSOR_TIME_FORMAT), int(pid)
+    except (TypeError, ValueError):
+        raise ValueError("malformed cursor")
+
+
+def next_cursor(rows, count, key=lambda row: (row[3], row[0])):
+    """
+    Get the cursor of the page after rows, None when rows was the last page
+    """
+    if not rows or len(rows) < count:
+        return None
+    return encode(*key(rows[-1]))
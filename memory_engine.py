@@ -0,0 +1,668 @@
+"""
+In-memory implementation of the functions.py API.
+
+Every API of functions.py exists here with the same name, signature and
+(status, res) contract, including the ordering and tie-break rules, but conn
+is a MemoryDatabase instead of a postgres connection. It needs neither
+Postgres nor psycopg2, so the checker runs against it in milliseconds:
+
+    python customize_checker.py --memory
+
+and a MemoryDatabase loaded from Postgres with MemoryDatabase.load() can
+serve reads as a hot tier in front of it.
+
+The data lives in indexed structures that answer each API directly:
+
+    - sorted lists of (begin_time, -pid) for all papers, per user and per
+      tag, walked backwards for newest first with ties broken by pid
+    - per paper dicts of likers and per user sorted lists of (like_time, -pid)
+    - tag and tag pair counters maintained on insert and delete
+
+Failures mirror what Postgres would reject: unknown users, strings longer
+than their column, duplicate likes or tags. Like the serial column, a pid is
+used up by every add_new_paper attempt, even a failed one.
+
+Strings compare in byte order, so ties broken by tag name or username
+follow COLLATE "C" like suggest_tags does. Postgres orders the ties of
+get_most_popular_tags and the like by the collation of the database, which
+can differ for names mixing cases or non-ASCII letters.
+
+Keyword search approximates the english text search of Postgres: words are
+matched case insensitively as whole tokens, without stemming or stop words,
+and the ranked order weighs title, description and text matches like the
+A, B and C weights of ts_rank_cd, without cover density.
+"""
+
+import bisect
+import re
+import threading
+
+from collections import namedtuple
+from datetime import datetime
+from pytz import timezone
+
+import keyset
+import sessions
+
+
+# Column widths of the schema, longer values are rejected like Postgres does
+USERNAME_MAX = 50
+PASSWORD_MAX = 32
+TITLE_MAX = 50
+DESCRIPTION_MAX = 500
+TAGNAME_MAX = 50
+
+# Weights of title, description and text matches in ranked keyword search
+RANK_WEIGHTS = (1.0, 0.4, 0.2)
+# Half-lives after which likes are left out of the trending scores, as in
+# functions.TRENDING_HORIZON
+TRENDING_HORIZON = 10
+
+Paper = namedtuple('Paper', 'pid username title begin_time description text tags')
+
+_WORD = re.compile(r'[^\W_]+', re.UNICODE)
+_QUERY_TERM = re.compile(r'-?"[^"]*"?|\S+')
+
+
+def _too_long(value, limit):
+    if value is None:
+        return False
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return len(value) > limit
+
+
+def _words(text):
+    if not text:
+        return []
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return [w.lower() for w in _WORD.findall(text)]
+
+
+def _now():
+    # stored like the TIMESTAMP columns do: US/Eastern wall clock time
+    return datetime.now(timezone('US/Eastern')).replace(tzinfo=None)
+
+
+def _naive(when):
+    if when.tzinfo is not None:
+        return when.replace(tzinfo=None)
+    return when
+
+
+def _insert(index, key):
+    bisect.insort(index, key)
+
+
+def _remove(index, key):
+    i = bisect.bisect_left(index, key)
+    if i < len(index) and index[i] == key:
+        del index[i]
+
+
+def _seek(index, count, cursor):
+    """
+    Get the pids of a page of an index of (time, -pid) keys, newest first
+    and ties broken by ascending pid. Raises ValueError for a bad cursor.
+    """
+    if cursor is None:
+        end = len(index)
+    else:
+        after_time, after_pid = keyset.decode(cursor)
+        end = bisect.bisect_left(index, (after_time, -after_pid))
+    start = max(0, end - max(count, 0))
+    return [-key[1] for key in reversed(index[start:end])]
+
+
+class MemoryDatabase(object):
+    """
+    The tables of the paper schema as in-memory indexes. All APIs of this
+    module take one as their conn.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.sessions = sessions.SessionCache()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # username -> password
+            self.users = {}
+            # pid -> Paper
+            self.papers = {}
+            self.next_pid = 1
+            # sorted (begin_time, -pid) keys
+            self.timeline = []
+            self.user_papers = {}
+            self.tag_papers = {}
+            # pid -> {username: like_time}
+            self.likers = {}
+            # username -> sorted (like_time, -pid) keys
+            self.user_likes = {}
+            self.tag_counts = {}
+            # (tag1, tag2) with tag1 < tag2 -> count
+            self.tag_pair_counts = {}
+            self.sessions.clear()
+
+    def row(self, pid):
+        """
+        Get the (pid, username, title, begin_time, description) of a paper
+        """
+        return tuple(self.papers[pid][:5])
+
+    def add_paper(self, paper):
+        self.papers[paper.pid] = paper
+        key = (paper.begin_time, -paper.pid)
+        _insert(self.timeline, key)
+        _insert(self.user_papers.setdefault(paper.username, []), key)
+        tags = sorted(paper.tags)
+        for i, tag in enumerate(tags):
+            _insert(self.tag_papers.setdefault(tag, []), key)
+            self.tag_counts[tag] = self.tag_counts.get(tag, 0) + 1
+            for other in tags[i + 1:]:
+                pair = (tag, other)
+                self.tag_pair_counts[pair] = self.tag_pair_counts.get(pair, 0) + 1
+        self.likers[paper.pid] = {}
+
+    def remove_paper(self, pid):
+        paper = self.papers.pop(pid)
+        key = (paper.begin_time, -pid)
+        _remove(self.timeline, key)
+        _remove(self.user_papers[paper.username], key)
+        tags = sorted(paper.tags)
+        for i, tag in enumerate(tags):
+            _remove(self.tag_papers[tag], key)
+            self.tag_counts[tag] -= 1
+            if not self.tag_counts[tag]:
+                del self.tag_counts[tag]
+            for other in tags[i + 1:]:
+                pair = (tag, other)
+                self.tag_pair_counts[pair] -= 1
+                if not self.tag_pair_counts[pair]:
+                    del self.tag_pair_counts[pair]
+        for uname, like_time in self.likers.pop(pid).iteritems():
+            _remove(self.user_likes[uname], (like_time, -pid))
+
+    def add_like(self, uname, pid, like_time):
+        self.likers[pid][uname] = like_time
+        _insert(self.user_likes.setdefault(uname, []), (like_time, -pid))
+
+    def remove_like(self, uname, pid):
+        like_time = self.likers[pid].pop(uname)
+        _remove(self.user_likes[uname], (like_time, -pid))
+
+    @classmethod
+    def load(cls, conn):
+        """
+        Build a MemoryDatabase from the tables of a postgres database, e.g.
+        to serve reads from memory.
+
+        :param conn: A postgres database connection object
+        :return: A MemoryDatabase
+        """
+        db = cls()
+        cur = conn.cursor()
+        cur.execute("SELECT username, password FROM users;")
+        db.users = dict(cur.fetchall())
+        cur.execute("SELECT pid, array_agg(tagname) FROM tags GROUP BY pid;")
+        tags = dict(cur.fetchall())
+        cur.execute("SELECT p.pid, p.username, p.title, p.begin_time, p.description, \
+                p.text_hash, x.content \
+            FROM papers p LEFT JOIN paper_texts x ON x.hash = p.text_hash \
+            WHERE p.deleted_at IS NULL ORDER BY p.pid;")
+        # papers sharing a text share one string, as they share one row
+        texts = {}
+        for row in cur:
+            text = texts.setdefault(str(row[5]), row[6]) if row[5] is not None else None
+            db.add_paper(Paper(*(row[:5] + (text, tuple(tags.get(row[0], ()))))))
+        # deleted papers keep their pids until they are purged
+        cur.execute("SELECT COALESCE(MAX(pid), 0) + 1 FROM papers;")
+        db.next_pid = cur.fetchone()[0]
+        cur.execute("SELECT l.pid, l.username, l.like_time \
+            FROM likes l INNER JOIN papers p ON p.pid = l.pid WHERE p.deleted_at IS NULL;")
+        for pid, uname, like_time in cur:
+            db.add_like(uname, pid, like_time)
+        conn.rollback()
+        return db
+
+
+# Admin APIs
+
+
+def reset_db(conn):
+    conn.clear()
+    return 0, None
+
+
+def reconcile_like_counts(conn, repair=True):
+    # like counts are the sizes of the liker dicts and can not drift
+    return 0, []
+
+
+def purge_deleted_papers(conn, batch=1000):
+    # deleted papers are removed right away
+    return 0, (0, 0)
+
+
+# Basic APIs
+
+
+def signup(conn, uname, pwd):
+    with conn.lock:
+        if uname in conn.users:
+            return 1, None
+        if uname is None or pwd is None or _too_long(uname, USERNAME_MAX) \
+                or _too_long(pwd, PASSWORD_MAX):
+            return 2, None
+        conn.users[uname] = pwd
+        conn.sessions.invalidate_user(uname)
+        return 0, None
+
+
+def login(conn, uname, pwd):
+    with conn.lock:
+        if uname not in conn.users:
+            return 1, None
+        if conn.users[uname] != pwd:
+            return 2, None
+        return 0, None
+
+
+def login_session(conn, uname, pwd):
+    status, res = login(conn, uname, pwd)
+    if status != 0:
+        return status, None
+    return 0, conn.sessions.create(uname)
+
+
+def check_session(conn, token):
+    uname = conn.sessions.lookup(token)
+    if uname is None:
+        return 1, None
+    return 0, uname
+
+
+# Event related
+
+
+def add_new_paper(conn, uname, title, desc, text, tags):
+    with conn.lock:
+        # the serial is used up even if the insert fails
+        pid = conn.next_pid
+        conn.next_pid += 1
+        if uname not in conn.users or _too_long(title, TITLE_MAX) \
+                or _too_long(desc, DESCRIPTION_MAX):
+            return 1, None
+        if len(set(tags)) != len(tags):
+            return 1, None
+        for t in tags:
+            if not t.isalnum() or _too_long(t, TAGNAME_MAX):
+                return 1, None
+        conn.add_paper(Paper(pid, uname, title, _now(), desc, text, tuple(tags)))
+        return 0, pid
+
+
+def delete_paper(conn, pid):
+    with conn.lock:
+        if pid in conn.papers:
+            conn.remove_paper(pid)
+        return 0, None
+
+
+def delete_papers(conn, pids):
+    with conn.lock:
+        statuses = []
+        for pid in pids:
+            if pid in conn.papers:
+                conn.remove_paper(pid)
+                statuses.append(0)
+            else:
+                statuses.append(1)
+        return 0, statuses
+
+
+def get_paper_tags(conn, pid):
+    with conn.lock:
+        paper = conn.papers.get(pid)
+        return 0, sorted(paper.tags) if paper is not None else []
+
+
+# Vote related
+
+
+def like_paper(conn, uname, pid):
+    with conn.lock:
+        paper = conn.papers.get(pid)
+        if paper is None or paper.username == uname:
+            return 1, None
+        if uname not in conn.users or uname in conn.likers[pid]:
+            return 1, None
+        conn.add_like(uname, pid, _now())
+        return 0, None
+
+
+def unlike_paper(conn, uname, pid):
+    with conn.lock:
+        if uname not in conn.likers.get(pid, ()):
+            return 1, None
+        conn.remove_like(uname, pid)
+        return 0, None
+
+
+def like_papers_bulk(conn, events):
+    with conn.lock:
+        return 0, [like_paper(conn, uname, pid)[0] for uname, pid in events]
+
+
+def unlike_papers_bulk(conn, events):
+    with conn.lock:
+        return 0, [unlike_paper(conn, uname, pid)[0] for uname, pid in events]
+
+
+def get_likes(conn, pid):
+    with conn.lock:
+        return 0, len(conn.likers.get(pid, ()))
+
+
+def hydrate_papers(conn, pids):
+    with conn.lock:
+        res = []
+        for pid in pids:
+            paper = conn.papers.get(pid)
+            tags = sorted(paper.tags) if paper is not None else []
+            res.append((pid, tags, len(conn.likers.get(pid, ()))))
+        return 0, res
+
+
+def _hydrate(conn, status, papers, hydrate):
+    if status != 0 or not hydrate:
+        return status, papers
+    status, res = hydrate_papers(conn, [paper[0] for paper in papers])
+    return 0, [tuple(paper) + (tags, likes) for paper, (pid, tags, likes) in zip(papers, res)]
+
+
+# Search related
+
+
+def get_timeline(conn, uname, count = 10, hydrate = False):
+    status, res = get_timeline_page(conn, uname, count)
+    if status != 0:
+        return status, None
+    return _hydrate(conn, 0, res[0], hydrate)
+
+
+def get_timeline_page(conn, uname, count = 10, cursor = None):
+    with conn.lock:
+        try:
+            pids = _seek(conn.user_papers.get(uname, []), count, cursor)
+        except ValueError:
+            return 1, None
+        papers = [conn.row(pid) for pid in pids]
+        return 0, (papers, keyset.next_cursor(papers, count))
+
+
+def get_timeline_all(conn, count = 10, hydrate = False):
+    status, res = get_timeline_all_page(conn, count)
+    if status != 0:
+        return status, None
+    return _hydrate(conn, 0, res[0], hydrate)
+
+
+def get_timeline_all_page(conn, count = 10, cursor = None):
+    with conn.lock:
+        try:
+            pids = _seek(conn.timeline, count, cursor)
+        except ValueError:
+            return 1, None
+        papers = [conn.row(pid) for pid in pids]
+        return 0, (papers, keyset.next_cursor(papers, count))
+
+
+def get_most_popular_papers(conn, begin_time, count = 10, hydrate = False):
+    with conn.lock:
+        after = _naive(begin_time)
+        liked = [(-len(likers), pid) for pid, likers in conn.likers.iteritems()
+                 if likers and conn.papers[pid].begin_time > after]
+        liked.sort()
+        papers = [conn.row(pid) for n, pid in liked[:max(count, 0)]]
+        return _hydrate(conn, 0, papers, hydrate)
+
+
+def get_trending_papers(conn, half_life, count = 10, hydrate = False):
+    seconds = half_life.total_seconds()
+    if seconds <= 0:
+        return 1, None
+    with conn.lock:
+        now = _now()
+        since = now - TRENDING_HORIZON * half_life
+        scores = {}
+        for pid, likers in conn.likers.iteritems():
+            for like_time in likers.itervalues():
+                # counted at the start of the hour, like the like buckets
+                bucket = like_time.replace(minute=0, second=0, microsecond=0)
+                if bucket > since:
+                    weight = 0.5 ** ((now - bucket).total_seconds() / seconds)
+                    scores[pid] = scores.get(pid, 0.0) + weight
+        ranked = sorted((-score, pid) for pid, score in scores.iteritems())
+        papers = [conn.row(pid) for score, pid in ranked[:max(count, 0)]]
+        return _hydrate(conn, 0, papers, hydrate)
+
+
+def get_recommend_papers(conn, uname, count = 10, hydrate = False):
+    with conn.lock:
+        mine = set(-key[1] for key in conn.user_likes.get(uname, ()))
+        cohort = set()
+        for pid in mine:
+            cohort.update(conn.likers[pid])
+        cohort.discard(uname)
+        scores = {}
+        for other in cohort:
+            for like_time, neg_pid in conn.user_likes[other]:
+                pid = -neg_pid
+                if pid not in mine and conn.papers[pid].username != uname:
+                    scores[pid] = scores.get(pid, 0) + 1
+        ranked = sorted((-score, pid) for pid, score in scores.iteritems())
+        papers = [conn.row(pid) for score, pid in ranked[:max(count, 0)]]
+        return _hydrate(conn, 0, papers, hydrate)
+
+
+def get_papers_by_tag(conn, tag, count = 10, hydrate = False):
+    status, res = get_papers_by_tag_page(conn, tag, count)
+    if status != 0:
+        return status, None
+    return _hydrate(conn, 0, res[0], hydrate)
+
+
+def suggest_tags(conn, prefix, count = 10):
+    with conn.lock:
+        tags = [(-n, tag) for tag, n in conn.tag_counts.iteritems() if tag.startswith(prefix)]
+        tags.sort()
+        return 0, [(tag, -n) for n, tag in tags[:max(count, 0)]]
+
+
+def get_papers_by_tag_page(conn, tag, count = 10, cursor = None):
+    with conn.lock:
+        try:
+            pids = _seek(conn.tag_papers.get(tag, []), count, cursor)
+        except ValueError:
+            return 1, None
+        papers = [conn.row(pid) for pid in pids]
+        return 0, (papers, keyset.next_cursor(papers, count))
+
+
+def _parse_query(keyword):
+    """
+    Parse a web search style query into a list of alternatives, each a list
+    of (negated, words) terms that all have to hold
+    """
+    alternatives = [[]]
+    for token in _QUERY_TERM.findall(keyword or ''):
+        if token.lower() == 'or':
+            if alternatives[-1]:
+                alternatives.append([])
+            continue
+        negated = token.startswith('-')
+        words = _words(token)
+        if words:
+            alternatives[-1].append((negated, words))
+    return [terms for terms in alternatives if terms]
+
+
+def _field_has(words, phrase):
+    n = len(phrase)
+    return any(words[i:i + n] == phrase for i in range(len(words) - n + 1))
+
+
+def _match(paper_words, terms):
+    for negated, phrase in terms:
+        found = any(_field_has(words, phrase) for words in paper_words)
+        if found == negated:
+            return False
+    return True
+
+
+def _keyword_matches(conn, keyword):
+    """
+    Get (paper words, pid) of the papers matching a keyword
+    """
+    alternatives = _parse_query(keyword)
+    matches = []
+    if not alternatives:
+        return matches
+    for pid, paper in conn.papers.iteritems():
+        paper_words = (_words(paper.title), _words(paper.description), _words(paper.text))
+        if any(_match(paper_words, terms) for terms in alternatives):
+            matches.append((paper_words, pid))
+    return matches
+
+
+def get_papers_by_keyword(conn, keyword, count = 10, ranked = False, hydrate = False):
+    if not ranked:
+        status, res = get_papers_by_keyword_page(conn, keyword, count)
+        if status != 0:
+            return status, None
+        return _hydrate(conn, 0, res[0], hydrate)
+    with conn.lock:
+        wanted = set(w for terms in _parse_query(keyword)
+                     for negated, phrase in terms if not negated for w in phrase)
+        ranking = []
+        for paper_words, pid in _keyword_matches(conn, keyword):
+            rank = sum(weight * sum(1 for w in words if w in wanted)
+                       for weight, words in zip(RANK_WEIGHTS, paper_words))
+            ranking.append((rank, conn.papers[pid].begin_time, pid))
+        # rank descending, then begin_time descending, then pid ascending;
+        # the second sort is stable, also when reversed
+        ranking.sort(key=lambda r: r[2])
+        ranking.sort(key=lambda r: r[:2], reverse=True)
+        papers = [conn.row(pid) for rank, begin_time, pid in ranking[:max(count, 0)]]
+        return _hydrate(conn, 0, papers, hydrate)
+
+
+def get_papers_by_keyword_page(conn, keyword, count = 10, cursor = None):
+    with conn.lock:
+        index = sorted((conn.papers[pid].begin_time, -pid)
+                       for paper_words, pid in _keyword_matches(conn, keyword))
+        try:
+            pids = _seek(index, count, cursor)
+        except ValueError:
+            return 1, None
+        papers = [conn.row(pid) for pid in pids]
+        return 0, (papers, keyset.next_cursor(papers, count))
+
+
+def get_papers_by_liked(conn, uname, count = 10, hydrate = False):
+    status, res = get_papers_by_liked_page(conn, uname, count)
+    if status != 0:
+        return status, None
+    return _hydrate(conn, 0, res[0], hydrate)
+
+
+def get_papers_by_liked_page(conn, uname, count = 10, cursor = None):
+    with conn.lock:
+        index = conn.user_likes.get(uname, [])
+        try:
+            pids = _seek(index, count, cursor)
+        except ValueError:
+            return 1, None
+        papers = [conn.row(pid) for pid in pids]
+        next_cursor = None
+        if pids and len(pids) >= count:
+            next_cursor = keyset.encode(conn.likers[pids[-1]][uname], pids[-1])
+        return 0, (papers, next_cursor)
+
+
+# Statistics related
+
+
+def get_most_active_users(conn, count = 1):
+    with conn.lock:
+        active = sorted((-len(keys), uname) for uname, keys in conn.user_papers.iteritems()
+                        if keys)
+        return 0, [uname for n, uname in active[:max(count, 0)]]
+
+
+def get_most_popular_tags(conn, count = 1):
+    with conn.lock:
+        ranked = sorted((-n, tag) for tag, n in conn.tag_counts.iteritems())
+        return 0, [(tag, -n) for n, tag in ranked[:max(count, 0)]]
+
+
+def get_most_popular_tag_pairs(conn, count = 1):
+    with conn.lock:
+        ranked = sorted((-n, pair) for pair, n in conn.tag_pair_counts.iteritems())
+        return 0, [(pair[0], pair[1], -n) for n, pair in ranked[:max(count, 0)]]
+
+
+def get_number_papers_user(conn, uname):
+    with conn.lock:
+        return 0, len(conn.user_papers.get(uname, ()))
+
+
+def get_number_liked_user(conn, uname):
+    with conn.lock:
+        return 0, len(conn.user_likes.get(uname, ()))
+
+
+def get_number_tags_user(conn, uname):
+    with conn.lock:
+        tags = set()
+        for begin_time, neg_pid in conn.user_papers.get(uname, ()):
+            tags.update(conn.papers[-neg_pid].tags)
+        return 0, len(tags)
+
+
+def get_user_profile(conn, uname, count = 10):
+    with conn.lock:
+        return 0, {
+            'number_papers': get_number_papers_user(conn, uname)[1],
+            'number_liked': get_number_liked_user(conn, uname)[1],
+            'number_tags': get_number_tags_user(conn, uname)[1],
+            'timeline': get_timeline(conn, uname, count)[1],
+            'papers_by_liked': get_papers_by_liked(conn, uname, count)[1],
+        }
+
+
+_db = MemoryDatabase()
+
+
+def get_db():
+    """
+    Get the MemoryDatabase used by call_db
+    """
+    return _db
+
+
+def call_db(func, argdict, db=None):
+    """
+    Call the in-memory version of an API, like pool.call_db does with a
+    pooled connection.
+
+    :param func: An API from functions.py or this module, or its name
+    :param argdict: A dict of keyword arguments for the API, without conn
+    :param db: A MemoryDatabase, the one of get_db() by default
+    :return: The (status, res) of the API
+    """
+    name = func if isinstance(func, basestring) else func.__name__
+    return globals()[name](db if db is not None else _db, **argdict)
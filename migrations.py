@@ -0,0 +1,725 @@
+"""
+Versioned schema migrations.
+
+The schema is defined as an ordered list of migrations instead of a single
+DROP/CREATE script, and the versions applied to a database are recorded in the
+schema_version table. migrate() applies the missing ones in place, so a live
+database is upgraded without wiping its data; reset_db drops every table and
+replays all of them.
+
+A database created before migrations existed has no schema_version table. The
+early migrations only use IF NOT EXISTS forms and backfill what they add, so
+such a database is upgraded by replaying them from version 1.
+
+Index-only migrations are built with CREATE INDEX CONCURRENTLY, outside of a
+transaction, so they do not block writes on a live database. An index left
+invalid by an interrupted build is dropped and built again.
+
+check_plans() checks that the read APIs are served by index scans; run this
+module with --check-plans against a scratch database to load a large
+synthetic dataset and print the result for every API.
+"""
+
+import json
+import random
+import sys
+
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+
+import psycopg2 as psy
+
+import recommend
+import results
+import statements
+
+
+# Key of the advisory lock that serializes concurrent migrate() calls
+MIGRATION_LOCK = 0x70617065
+
+
+class Migration(object):
+    """
+    One schema version.
+
+    :param version: An int, versions are applied in increasing order
+    :param description: A string describing the change
+    :param commands: SQL statements run in a single transaction
+    :param indexes: (name, definition) pairs built concurrently, where the
+                    definition is what follows "ON" in CREATE INDEX
+    """
+
+    def __init__(self, version, description, commands=(), indexes=()):
+        self.version = version
+        self.description = description
+        self.commands = commands
+        self.indexes = indexes
+
+
+MIGRATIONS = [
+    Migration(1, "base schema", commands=(
+        """
+        CREATE TABLE IF NOT EXISTS users(
+            username VARCHAR(50) NOT NULL,
+            password VARCHAR(32) NOT NULL,
+            PRIMARY KEY(username)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS papers(
+            pid  SERIAL PRIMARY KEY,
+            username VARCHAR(50) NOT NULL,
+            title VARCHAR(50),
+            begin_time TIMESTAMP NOT NULL,
+            description VARCHAR(500),
+            data TEXT,
+            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS paper_text_idx ON papers USING gin(to_tsvector('english', data))
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tagnames(
+            tagname VARCHAR(50) NOT NULL,
+            PRIMARY KEY(tagname)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS likes(
+            pid INT NOT NULL,
+            username VARCHAR(50) NOT NULL,
+            like_time TIMESTAMP NOT NULL,
+            PRIMARY KEY(pid, username),
+            FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE,
+            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tags(
+            pid INT NOT NULL,
+            tagname VARCHAR(50) NOT NULL,
+            PRIMARY KEY(pid, tagname),
+            FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE,
+            FOREIGN KEY(tagname) REFERENCES tagnames ON DELETE CASCADE
+        );
+        """,
+    )),
+    Migration(2, "like counters", commands=(
+        """
+        ALTER TABLE papers ADD COLUMN IF NOT EXISTS like_count INT NOT NULL DEFAULT 0
+        """,
+        """
+        LOCK TABLE likes IN SHARE MODE
+        """,
+        """
+        UPDATE papers p SET like_count = l.count
+            FROM (SELECT pid, COUNT(*) AS count FROM likes GROUP BY pid) l
+            WHERE p.pid = l.pid AND p.like_count != l.count
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS paper_like_count_idx ON papers(like_count DESC, pid) WHERE like_count > 0
+        """,
+    )),
+    Migration(3, "tag and tag pair counts", commands=(
+        """
+        CREATE TABLE IF NOT EXISTS tag_counts(
+            tagname VARCHAR(50) NOT NULL,
+            count BIGINT NOT NULL,
+            PRIMARY KEY(tagname)
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS tag_counts_idx ON tag_counts(count DESC, tagname)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tag_pair_counts(
+            tag1 VARCHAR(50) NOT NULL,
+            tag2 VARCHAR(50) NOT NULL,
+            count BIGINT NOT NULL,
+            PRIMARY KEY(tag1, tag2)
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS tag_pair_counts_idx ON tag_pair_counts(count DESC, tag1, tag2)
+        """,
+        # BEFORE row triggers see the rows the same statement already
+        # inserted or deleted, so a pair is counted exactly once even when
+        # all tags of a paper go in or out (e.g. by cascade) in one statement
+        """
+        CREATE OR REPLACE FUNCTION tags_count_insert() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO tag_counts VALUES(NEW.tagname, 1)
+                ON CONFLICT (tagname) DO UPDATE SET count = tag_counts.count + 1;
+            INSERT INTO tag_pair_counts
+                SELECT LEAST(NEW.tagname, t.tagname), GREATEST(NEW.tagname, t.tagname), 1
+                FROM tags t WHERE t.pid = NEW.pid AND t.tagname != NEW.tagname
+                ON CONFLICT (tag1, tag2) DO UPDATE SET count = tag_pair_counts.count + 1;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE OR REPLACE FUNCTION tags_count_delete() RETURNS trigger AS $$
+        BEGIN
+            UPDATE tag_counts SET count = count - 1 WHERE tagname = OLD.tagname;
+            DELETE FROM tag_counts WHERE tagname = OLD.tagname AND count <= 0;
+            UPDATE tag_pair_counts c SET count = c.count - 1 FROM tags t
+                WHERE t.pid = OLD.pid AND t.tagname != OLD.tagname
+                    AND c.tag1 = LEAST(OLD.tagname, t.tagname)
+                    AND c.tag2 = GREATEST(OLD.tagname, t.tagname);
+            DELETE FROM tag_pair_counts c USING tags t
+                WHERE t.pid = OLD.pid AND t.tagname != OLD.tagname
+                    AND c.tag1 = LEAST(OLD.tagname, t.tagname)
+                    AND c.tag2 = GREATEST(OLD.tagname, t.tagname)
+                    AND c.count <= 0;
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        # no tags may change between the backfill and the triggers going live
+        """
+        LOCK TABLE tags IN SHARE ROW EXCLUSIVE MODE
+        """,
+        """
+        DROP TRIGGER IF EXISTS tags_count_insert ON tags
+        """,
+        """
+        CREATE TRIGGER tags_count_insert BEFORE INSERT ON tags
+            FOR EACH ROW EXECUTE PROCEDURE tags_count_insert()
+        """,
+        """
+        DROP TRIGGER IF EXISTS tags_count_delete ON tags
+        """,
+        """
+        CREATE TRIGGER tags_count_delete BEFORE DELETE ON tags
+            FOR EACH ROW EXECUTE PROCEDURE tags_count_delete()
+        """,
+        """
+        TRUNCATE tag_counts, tag_pair_counts
+        """,
+        """
+        INSERT INTO tag_counts
+            SELECT tagname, COUNT(*) FROM tags GROUP BY tagname
+        """,
+        """
+        INSERT INTO tag_pair_counts
+            SELECT t1.tagname, t2.tagname, COUNT(*) FROM tags t1 INNER JOIN tags t2
+                ON t1.pid = t2.pid AND t1.tagname < t2.tagname
+            GROUP BY t1.tagname, t2.tagname
+        """,
+    )),
+    # access paths of get_timeline, get_timeline_all, get_papers_by_liked
+    # and get_papers_by_tag
+    Migration(4, "list API indexes", indexes=(
+        ('paper_user_time_idx', "papers(username, begin_time DESC, pid)"),
+        ('paper_time_idx', "papers(begin_time DESC, pid)"),
+        ('like_user_time_idx', "likes(username, like_time DESC)"),
+        ('tag_tagname_idx', "tags(tagname, pid)"),
+    )),
+    # weighted search vector: title A, description B, text C. The old
+    # expression index used a different expression than the queries, so
+    # it was never used
+    Migration(5, "weighted search vector", commands=(
+        """
+        ALTER TABLE papers ADD COLUMN IF NOT EXISTS search_vector tsvector
+        """,
+        """
+        CREATE OR REPLACE FUNCTION papers_search_vector() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector :=
+                setweight(to_tsvector('english', COALESCE(NEW.title, '')), 'A') ||
+                setweight(to_tsvector('english', COALESCE(NEW.description, '')), 'B') ||
+                setweight(to_tsvector('english', COALESCE(NEW.data, '')), 'C');
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        DROP TRIGGER IF EXISTS papers_search_vector ON papers
+        """,
+        """
+        CREATE TRIGGER papers_search_vector BEFORE INSERT OR UPDATE OF title, description, data
+            ON papers FOR EACH ROW EXECUTE PROCEDURE papers_search_vector()
+        """,
+        """
+        UPDATE papers SET search_vector =
+            setweight(to_tsvector('english', COALESCE(title, '')), 'A') ||
+            setweight(to_tsvector('english', COALESCE(description, '')), 'B') ||
+            setweight(to_tsvector('english', COALESCE(data, '')), 'C')
+        WHERE search_vector IS NULL
+        """,
+        """
+        DROP INDEX IF EXISTS paper_text_idx
+        """,
+    )),
+    Migration(6, "search vector index", indexes=(
+        ('paper_search_idx', "papers USING gin(search_vector)"),
+    )),
+    # number of papers liked by both users of a pair, in both directions
+    Migration(7, "co-like statistics", commands=(
+        """
+        CREATE TABLE IF NOT EXISTS co_likes(
+            username VARCHAR(50) NOT NULL,
+            other VARCHAR(50) NOT NULL,
+            shared INT NOT NULL,
+            PRIMARY KEY(username, other),
+            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE,
+            FOREIGN KEY(other) REFERENCES users ON DELETE CASCADE
+        );
+        """,
+        """
+        LOCK TABLE likes IN SHARE MODE
+        """,
+        """
+        DELETE FROM co_likes
+        """,
+        """
+        INSERT INTO co_likes
+            SELECT l1.username, l2.username, COUNT(*) FROM likes l1 INNER JOIN likes l2
+                ON l1.pid = l2.pid AND l1.username != l2.username
+            GROUP BY l1.username, l2.username
+        """,
+    )),
+    # paper texts move out of papers into a table keyed by their sha256, so
+    # the rows the list APIs scan stay narrow and a text uploaded many times
+    # is stored once. refs counts the papers using a text and is kept by a
+    # trigger, which drops a text with its last paper
+    Migration(8, "content-addressed paper texts", commands=(
+        """
+        CREATE TABLE IF NOT EXISTS paper_texts(
+            hash BYTEA NOT NULL,
+            content TEXT NOT NULL,
+            refs INT NOT NULL DEFAULT 0,
+            PRIMARY KEY(hash)
+        );
+        """,
+        """
+        ALTER TABLE papers ADD COLUMN IF NOT EXISTS text_hash BYTEA REFERENCES paper_texts
+        """,
+        """
+        LOCK TABLE papers IN SHARE ROW EXCLUSIVE MODE
+        """,
+        """
+        INSERT INTO paper_texts
+            SELECT sha256(convert_to(data, 'UTF8')), MIN(data), COUNT(*) FROM papers
+            WHERE data IS NOT NULL GROUP BY 1
+            ON CONFLICT (hash) DO NOTHING
+        """,
+        """
+        UPDATE papers SET text_hash = sha256(convert_to(data, 'UTF8'))
+            WHERE data IS NOT NULL AND text_hash IS NULL
+        """,
+        """
+        CREATE OR REPLACE FUNCTION papers_text_refs() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP != 'DELETE' AND NEW.text_hash IS NOT NULL THEN
+                UPDATE paper_texts SET refs = refs + 1 WHERE hash = NEW.text_hash;
+            END IF;
+            IF TG_OP != 'INSERT' AND OLD.text_hash IS NOT NULL THEN
+                UPDATE paper_texts SET refs = refs - 1 WHERE hash = OLD.text_hash;
+                DELETE FROM paper_texts WHERE hash = OLD.text_hash AND refs <= 0;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        DROP TRIGGER IF EXISTS papers_text_refs ON papers
+        """,
+        """
+        CREATE TRIGGER papers_text_refs AFTER INSERT OR DELETE OR UPDATE OF text_hash
+            ON papers FOR EACH ROW EXECUTE PROCEDURE papers_text_refs()
+        """,
+        # the search vector now reads the text the row points to, which is
+        # written before the paper
+        """
+        CREATE OR REPLACE FUNCTION papers_search_vector() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector :=
+                setweight(to_tsvector('english', COALESCE(NEW.title, '')), 'A') ||
+                setweight(to_tsvector('english', COALESCE(NEW.description, '')), 'B') ||
+                setweight(to_tsvector('english', COALESCE(
+                    (SELECT content FROM paper_texts WHERE hash = NEW.text_hash), '')), 'C');
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        DROP TRIGGER IF EXISTS papers_search_vector ON papers
+        """,
+        """
+        CREATE TRIGGER papers_search_vector BEFORE INSERT OR UPDATE OF title, description, text_hash
+            ON papers FOR EACH ROW EXECUTE PROCEDURE papers_search_vector()
+        """,
+        # the space of the dropped column is reused as rows are rewritten,
+        # VACUUM FULL papers gives it back at once
+        """
+        ALTER TABLE papers DROP COLUMN IF EXISTS data
+        """,
+    )),
+    # likes per paper and hour, so time windowed popularity reads a few
+    # buckets instead of every like
+    Migration(9, "hourly like buckets", commands=(
+        """
+        CREATE TABLE IF NOT EXISTS like_buckets(
+            pid INT NOT NULL,
+            bucket TIMESTAMP NOT NULL,
+            likes INT NOT NULL,
+            PRIMARY KEY(pid, bucket),
+            FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS like_bucket_time_idx ON like_buckets(bucket, pid, likes)
+        """,
+        """
+        LOCK TABLE likes IN SHARE MODE
+        """,
+        """
+        DELETE FROM like_buckets
+        """,
+        """
+        INSERT INTO like_buckets
+            SELECT pid, date_trunc('hour', like_time), COUNT(*) FROM likes GROUP BY 1, 2
+        """,
+    )),
+    # deleted papers are marked and purged later, see purge.py
+    Migration(10, "soft delete", commands=(
+        """
+        ALTER TABLE papers ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP
+        """,
+    )),
+    # the few deleted papers waiting for purge_deleted_papers
+    Migration(11, "deleted paper index", indexes=(
+        ('paper_deleted_idx', "papers(pid) WHERE deleted_at IS NOT NULL"),
+    )),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def _current_version(cur):
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+    return cur.fetchone()[0]
+
+
+def _build_index(cur, name, definition):
+    """
+    CREATE INDEX CONCURRENTLY, replacing an invalid leftover of an
+    interrupted build. The connection must be in autocommit mode.
+    """
+    cur.execute("SELECT i.indisvalid FROM pg_class c \
+        INNER JOIN pg_index i ON i.indexrelid = c.oid \
+        WHERE c.relname = %s;", (name,))
+    row = cur.fetchone()
+    if row is not None:
+        if row[0]:
+            return
+        cur.execute("DROP INDEX CONCURRENTLY IF EXISTS %s;" % name)
+    cur.execute("CREATE INDEX CONCURRENTLY %s ON %s;" % (name, definition))
+
+
+def _apply(conn, cur, migration):
+    if migration.indexes:
+        conn.commit()
+        conn.autocommit = True
+        try:
+            for name, definition in migration.indexes:
+                _build_index(cur, name, definition)
+        finally:
+            conn.autocommit = False
+    for command in migration.commands:
+        cur.execute(command)
+    cur.execute("INSERT INTO schema_version(version, description) VALUES(%s, %s);",
+                (migration.version, migration.description))
+    conn.commit()
+
+
+def migrate(conn, target=None):
+    """
+    Bring the schema up to a version, applying every missing migration in
+    order. Each migration is applied and recorded atomically, except that
+    concurrently built indexes are committed as they are built.
+
+    :param conn: A postgres database connection object
+    :param target: An int of the version to stop at, the latest by default
+    :return: (status, retval)
+        (0, [version, ...])     Success, retval lists the applied versions
+        (1, None)               Failure
+    """
+    if target is None:
+        target = LATEST_VERSION
+    applied = []
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK,))
+        try:
+            cur.execute("CREATE TABLE IF NOT EXISTS schema_version( \
+                version INT NOT NULL, \
+                description TEXT, \
+                applied_at TIMESTAMP NOT NULL DEFAULT localtimestamp, \
+                PRIMARY KEY(version));")
+            conn.commit()
+            current = _current_version(cur)
+            for migration in MIGRATIONS:
+                if current < migration.version <= target:
+                    _apply(conn, cur, migration)
+                    applied.append(migration.version)
+        finally:
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK,))
+            conn.commit()
+        if applied:
+            statements.schema_changed()
+        return 0, applied
+    except psy.DatabaseError, e:
+        conn.rollback()
+        if applied:
+            statements.schema_changed()
+        return 1, None
+
+
+def schema_version(conn):
+    """
+    Get the schema version of a database.
+
+    :param conn: A postgres database connection object
+    :return: (status, retval)
+        (0, version)    Success, 0 if no migration was applied yet
+        (1, None)       Failure
+    """
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+        if not cur.fetchone()[0]:
+            return 0, 0
+        return 0, _current_version(cur)
+    except psy.DatabaseError, e:
+        return 1, None
+
+
+# Storage
+
+# Values of set_text_compression(); None stores texts uncompressed
+TEXT_COMPRESSIONS = ('pglz', 'lz4', None)
+
+
+def set_text_compression(conn, method):
+    """
+    Choose how paper texts are compressed. Texts already stored keep their
+    compression until they are rewritten.
+
+    :param conn: A postgres database connection object
+    :param method: One of TEXT_COMPRESSIONS; lz4 needs a server built with it,
+                   and any method other than the server default PostgreSQL 14
+    :return: (status, retval)
+        (0, None)   Success
+        (1, None)   Failure, e.g. an unsupported method
+    """
+    if method not in TEXT_COMPRESSIONS:
+        return 1, None
+    try:
+        cur = conn.cursor()
+        if method is None:
+            # out of line but never compressed
+            cur.execute("ALTER TABLE paper_texts ALTER COLUMN content SET STORAGE EXTERNAL;")
+        else:
+            cur.execute("ALTER TABLE paper_texts ALTER COLUMN content SET STORAGE EXTENDED;")
+            cur.execute("ALTER TABLE paper_texts ALTER COLUMN content SET COMPRESSION %s;"
+                        % method)
+        conn.commit()
+        statements.schema_changed()
+        return 0, None
+    except psy.DatabaseError, e:
+        conn.rollback()
+        return 1, None
+
+
+# Plan checks
+
+# Tables that must never be read with a sequential scan by the checked APIs
+LARGE_TABLES = ('papers', 'likes', 'tags', 'like_buckets')
+
+
+def _plan_nodes(plan):
+    """
+    Yield every node of an EXPLAIN (FORMAT JSON) plan tree
+    """
+    stack = [plan[0]['Plan']]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(node.get('Plans', []))
+
+
+def _plan_calls(cur):
+    """
+    Get (api name, kwargs) pairs to check, with arguments picked from the
+    data so every query has rows to look at.
+    """
+    cur.execute("SELECT username FROM papers GROUP BY username ORDER BY COUNT(*) DESC LIMIT 1;")
+    author = cur.fetchone()[0]
+    cur.execute("SELECT username FROM likes GROUP BY username ORDER BY COUNT(*) DESC LIMIT 1;")
+    liker = cur.fetchone()[0]
+    cur.execute("SELECT tagname FROM tag_counts ORDER BY count ASC, tagname LIMIT 1;")
+    tag = cur.fetchone()[0]
+    cur.execute("SELECT pid, begin_time FROM papers ORDER BY like_count DESC, pid LIMIT 1;")
+    pid, begin_time = cur.fetchone()
+    return [
+        ('get_recommend_papers', {'uname': liker}),
+        # the synthetic texts contain the pid, which only a few papers match
+        ('get_papers_by_keyword', {'keyword': str(pid)}),
+        ('get_timeline', {'uname': author}),
+        ('get_timeline_all', {}),
+        ('get_papers_by_tag', {'tag': tag}),
+        ('get_papers_by_liked', {'uname': liker}),
+        ('get_paper_tags', {'pid': pid}),
+        ('get_likes', {'pid': pid}),
+        ('hydrate_papers', {'pids': [pid]}),
+        ('get_most_popular_papers', {'begin_time': begin_time}),
+        ('get_trending_papers', {'half_life': timedelta(hours=6)}),
+        ('get_most_popular_tags', {'count': 10}),
+        ('get_most_popular_tag_pairs', {'count': 10}),
+        ('get_number_papers_user', {'uname': author}),
+        ('get_number_liked_user', {'uname': liker}),
+        ('get_number_tags_user', {'uname': author}),
+        ('get_user_profile', {'uname': liker}),
+    ]
+
+
+def check_plans(conn):
+    """
+    Check that the read APIs are answered with index scans.
+
+    Every API is called once with the statements it runs being EXPLAINed.
+    This is only meaningful on a database with enough rows that the planner
+    prefers indexes, see seed_synthetic.
+
+    :param conn: A postgres database connection object
+    :return: (status, retval)
+        (0, {api: (ok, [node, ...]), ...})
+            Success, ok is False when a statement of the API scans one of
+            LARGE_TABLES sequentially. Each node is "<Node Type> on <relation>"
+        (1, None)   Failure
+    """
+    import functions
+    try:
+        cur = conn.cursor()
+        calls = _plan_calls(cur)
+        conn.rollback()
+    except psy.DatabaseError, e:
+        conn.rollback()
+        return 1, None
+    # cached results would skip the statements to be checked
+    recommend.clear()
+    checks = {}
+    for name, kwargs in calls:
+        with results.bypass(), statements.capture_plans() as plans:
+            status, res = getattr(functions, name)(conn, **kwargs)
+        conn.rollback()
+        if status != 0 or not plans:
+            return 1, None
+        ok = True
+        nodes = []
+        for plan in plans.values():
+            for node in _plan_nodes(plan):
+                relation = node.get('Relation Name')
+                if relation is None:
+                    continue
+                nodes.append("%s on %s" % (node['Node Type'], relation))
+                if node['Node Type'] == 'Seq Scan' and relation in LARGE_TABLES:
+                    ok = False
+        checks[name] = (ok, nodes)
+    return 0, checks
+
+
+def seed_synthetic(conn, users=2000, papers=100000, likes=500000, tags=1000, seed=0):
+    """
+    Load a random dataset through the bulk loader and ANALYZE it.
+
+    :param conn: A postgres database connection object
+    :param users, papers, likes, tags: Ints of how many rows to generate
+    :param seed: Seed of the random generator
+    :return: The (status, report) of bulk_load.bulk_load
+    """
+    import bulk_load
+
+    rng = random.Random(seed)
+    start = datetime(2016, 1, 1)
+    unames = ['user%d' % i for i in range(users)]
+    tagnames = ['tag%d' % i for i in range(tags)]
+
+    def jsonl(records):
+        buf = StringIO()
+        for r in records:
+            buf.write(json.dumps(r) + '\n')
+        buf.seek(0)
+        return buf
+
+    user_stream = jsonl({'username': u, 'password': u} for u in unames)
+    paper_stream = jsonl({'key': str(i), 'username': rng.choice(unames),
+                          'title': 'paper %d' % i, 'description': 'description %d' % i,
+                          'text': 'text of paper %d' % i,
+                          'tags': rng.sample(tagnames, rng.randint(1, 4)),
+                          'begin_time': str(start + timedelta(minutes=i))}
+                         for i in range(papers))
+    like_stream = jsonl({'username': rng.choice(unames), 'key': str(rng.randrange(papers)),
+                         'like_time': str(start + timedelta(minutes=rng.randrange(2 * papers)))}
+                        for i in range(likes))
+    status, report = bulk_load.bulk_load(conn, users=user_stream, papers=paper_stream,
+                                         likes=like_stream)
+    if status == 0:
+        conn.autocommit = True
+        try:
+            cur = conn.cursor()
+            cur.execute("VACUUM ANALYZE;")
+        finally:
+            conn.autocommit = False
+    return status, report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Migrate the paper schema")
+    parser.add_argument('--dsn', default='', help="libpq connection string")
+    parser.add_argument('--target', type=int, help="version to migrate to")
+    parser.add_argument('--text-compression', choices=['pglz', 'lz4', 'none'],
+                        help="compression of paper texts stored from now on")
+    parser.add_argument('--check-plans', action='store_true',
+                        help="reset the database, load synthetic data and check the "
+                             "plans of the read APIs; never use on a real database")
+    args = parser.parse_args()
+
+    conn = psy.connect(args.dsn)
+    try:
+        if args.check_plans:
+            import functions
+            functions.reset_db(conn)
+            status, report = seed_synthetic(conn)
+            if status != 0:
+                print "loading synthetic data failed"
+                sys.exit(1)
+            status, checks = check_plans(conn)
+            if status != 0:
+                print "checking plans failed"
+                sys.exit(1)
+            failed = False
+            for name in sorted(checks):
+                ok, nodes = checks[name]
+                failed = failed or not ok
+                print "[%s] %s: %s" % ("ok" if ok else "SEQ SCAN", name, ", ".join(nodes))
+            sys.exit(1 if failed else 0)
+        status, applied = migrate(conn, args.target)
+        if status != 0:
+            print "migration failed"
+            sys.exit(1)
+        print "applied %s, now at version %d" % (applied or "nothing", schema_version(conn)[1])
+        if args.text_compression:
+            method = args.text_compression if args.text_compression != 'none' else None
+            if set_text_compression(conn, method)[0] != 0:
+                print "setting the text compression failed"
+                sys.exit(1)
+    finally:
+        conn.close()
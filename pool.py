@@ -0,0 +1,343 @@
+"""
+Connection pool for the APIs in functions.py.
+
+The documented database_wrapper opens a fresh connection for every call and
+closes it afterwards, so connection setup dominates the latency of cheap calls
+like get_likes. This module keeps connections (and their server sessions) open
+between calls instead. call_db has the same shape as the wrapper used by the
+checker, so every API runs on the pool unchanged:
+
+    import paper.pool as db_wrapper
+    db_wrapper.configure(minconn=2, maxconn=20, dsn="dbname=paper")
+    status, res = db_wrapper.call_db(funcs.get_likes, {'pid': 1})
+
+Connections are
+    - health checked on checkout when they sat idle for a while
+    - rolled back on return if a transaction was left open
+    - closed once they are older than max_lifetime
+    - reaped when idle for longer than max_idle, down to minconn
+"""
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+import psycopg2 as psy
+import psycopg2.extensions as psy_ext
+
+from constants import *
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection became available within the checkout timeout
+    """
+    pass
+
+
+class _Entry(object):
+    """
+    Bookkeeping for one pooled connection
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = time.time()
+        self.last_used = self.created
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of psycopg2 connections.
+
+    :param minconn: Number of connections opened up front and kept when idle
+    :param maxconn: Maximum number of connections open at the same time
+    :param timeout: Seconds to wait for a free connection before PoolTimeout
+    :param max_lifetime: Seconds after which a connection is closed on return
+    :param max_idle: Seconds an idle connection above minconn is kept around
+    :param check_idle: Connections idle for longer than this many seconds are
+                       checked with a trivial query on checkout
+    :param connect_kwargs: Passed to psycopg2.connect
+    """
+
+    def __init__(self, minconn=1, maxconn=10, timeout=30.0, max_lifetime=3600.0,
+                 max_idle=300.0, check_idle=5.0, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size %d..%d" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_idle = check_idle
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        # idle entries, most recently used last
+        self._idle = []
+        # entries currently checked out, keyed by id of the connection
+        self._used = {}
+        self._size = 0
+        self._closed = False
+
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'saturated': 0,
+            'timeouts': 0,
+            'created': 0,
+            'closed': 0,
+            'failed_checks': 0,
+            'reaped': 0,
+            'rollbacks': 0,
+        }
+
+        for i in range(minconn):
+            entry = self._connect()
+            with self._cond:
+                self._size += 1
+                self._idle.append(entry)
+
+    def _connect(self):
+        conn = psy.connect(**self.connect_kwargs)
+        self._stats['created'] += 1
+        return _Entry(conn)
+
+    def _discard(self, entry):
+        """
+        Close a connection that is no longer tracked. Caller holds the lock.
+        """
+        self._size -= 1
+        self._stats['closed'] += 1
+        try:
+            entry.conn.close()
+        except psy.Error:
+            pass
+
+    def _expired(self, entry, now):
+        return now - entry.created > self.max_lifetime
+
+    def _healthy(self, entry, now):
+        """
+        Check a connection before handing it out
+        """
+        conn = entry.conn
+        if conn.closed:
+            return False
+        if now - entry.last_used <= self.check_idle:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            conn.rollback()
+            return True
+        except psy.Error:
+            return False
+
+    def getconn(self):
+        """
+        Check a connection out of the pool, opening a new one if the pool is
+        not at maxconn yet and otherwise waiting for one to be returned.
+
+        :return: A postgres database connection object
+        """
+        start = time.time()
+        deadline = start + self.timeout
+        waited = False
+        while True:
+            entry = None
+            create = False
+            with self._cond:
+                if self._closed:
+                    raise psy.InterfaceError("connection pool is closed")
+                while self._idle:
+                    candidate = self._idle.pop()
+                    if self._expired(candidate, time.time()):
+                        self._discard(candidate)
+                        continue
+                    entry = candidate
+                    break
+                if entry is None:
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        create = True
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self._stats['timeouts'] += 1
+                            raise PoolTimeout("no connection available after %.1fs"
+                                              % self.timeout)
+                        if not waited:
+                            waited = True
+                            self._stats['saturated'] += 1
+                        self._cond.wait(remaining)
+                        continue
+            if create:
+                try:
+                    entry = self._connect()
+                except psy.Error:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(entry, time.time()):
+                with self._cond:
+                    self._stats['failed_checks'] += 1
+                    self._discard(entry)
+                    self._cond.notify()
+                continue
+            with self._cond:
+                self._used[id(entry.conn)] = entry
+                self._stats['checkouts'] += 1
+                if waited:
+                    wait_time = time.time() - start
+                    self._stats['waits'] += 1
+                    self._stats['wait_time_total'] += wait_time
+                    self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+            return entry.conn
+
+    def putconn(self, conn, close=False):
+        """
+        Return a connection to the pool. An open transaction is rolled back
+        so the next user starts from a clean session.
+
+        :param conn: A connection obtained from getconn
+        :param close: Close the connection instead of keeping it
+        """
+        with self._cond:
+            entry = self._used.pop(id(conn), None)
+        if entry is None:
+            raise psy.InterfaceError("connection does not belong to this pool")
+        if not close and not conn.closed:
+            try:
+                status = conn.get_transaction_status()
+                if status == psy_ext.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != psy_ext.TRANSACTION_STATUS_IDLE:
+                    self._stats['rollbacks'] += 1
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psy.Error:
+                close = True
+        now = time.time()
+        with self._cond:
+            if close or conn.closed or self._closed or self._expired(entry, now):
+                self._discard(entry)
+            else:
+                entry.last_used = now
+                self._idle.append(entry)
+            self._reap(now)
+            self._cond.notify()
+
+    def _reap(self, now):
+        """
+        Close connections idle for longer than max_idle, keeping minconn
+        open. Caller holds the lock.
+        """
+        # the least recently used entries are at the front of the list
+        while self._idle and self._size > self.minconn \
+                and now - self._idle[0].last_used > self.max_idle:
+            self._stats['reaped'] += 1
+            self._discard(self._idle.pop(0))
+
+    def reap(self):
+        """
+        Close connections that have been idle for too long
+        """
+        with self._cond:
+            self._reap(time.time())
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that checks a connection out and returns it
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        """
+        Close all idle connections and refuse further checkouts. Connections
+        that are checked out are closed when they are returned.
+        """
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._discard(self._idle.pop())
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Get the pool counters
+
+        :return: A dict with the current size, idle and in use connection
+                 counts, plus the checkout, wait time and saturation counters
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = len(self._used)
+            stats['wait_time_avg'] = (stats['wait_time_total'] / stats['waits']
+                                      if stats['waits'] else 0.0)
+        return stats
+
+
+_pool = None
+
+
+def configure(**kwargs):
+    """
+    Create the pool used by call_db, closing the previous one if any.
+    Takes the same arguments as ConnectionPool.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.closeall()
+    _pool = ConnectionPool(**kwargs)
+    return _pool
+
+
+def get_pool():
+    """
+    Get the pool used by call_db, creating one with default settings if
+    configure has not been called.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool()
+    return _pool
+
+
+def call_db(func, argdict, pool=None):
+    """
+    Call an API with a pooled connection, like database_wrapper does with
+    a fresh one.
+
+    :param func: An API from functions.py
+    :param argdict: A dict of keyword arguments for the API, without conn
+    :param pool: A ConnectionPool, the configured one by default
+    :return: The (status, res) of the API, or (DB_ERROR, None)
+    """
+    if pool is None:
+        pool = get_pool()
+    conn = pool.getconn()
+    try:
+        return func(conn, **argdict)
+    except psy.DatabaseError, e:
+        print "Error %s: " % e.args[0]
+        try:
+            conn.rollback()
+        except psy.Error:
+            pass
+        return DB_ERROR, None
+    finally:
+        pool.putconn(conn)
@@ -0,0 +1,161 @@
+"""
+Background purge of deleted papers.
+
+delete_paper and delete_papers only mark papers as deleted (and drop their
+tags), so a delete costs the same whatever the number of likes of the paper.
+The read APIs leave marked papers out. purge_deleted_papers then removes
+their likes, co_likes counts, like buckets and rows in bounded batches, each
+in a short transaction of its own, and a Purger calls it on a thread until
+nothing is left:
+
+    import paper.purge as purge
+    purger = purge.Purger(interval=10.0)
+    purger.start()
+    ...
+    purger.stop()
+
+or from cron:
+
+    python purge.py --dsn "dbname=paper" --once
+"""
+
+import sys
+import threading
+import time
+
+import psycopg2 as psy
+
+import functions
+import pool as db_pool
+
+
+# Seconds between purges when there was nothing to purge
+PURGE_INTERVAL = 10.0
+
+
+def purge_all(conn, batch=functions.PURGE_BATCH):
+    """
+    Call purge_deleted_papers until it finds nothing to remove.
+
+    :param conn: A postgres database connection object
+    :param batch: Likes and papers removed per transaction at most
+    :return: (status, retval)
+        (0, (likes, papers))    Success, the numbers of likes and papers removed
+        (1, None)               Failure
+    """
+    likes = papers = 0
+    while True:
+        status, res = functions.purge_deleted_papers(conn, batch)
+        if status != 0:
+            return status, None
+        likes += res[0]
+        papers += res[1]
+        if res == (0, 0):
+            return 0, (likes, papers)
+
+
+class Purger(object):
+    """
+    Purges deleted papers on a daemon thread, with pooled connections.
+
+    :param pool: A pool.ConnectionPool, the one configured in pool by default
+    :param batch: Likes and papers removed per transaction at most
+    :param interval: Seconds to sleep once everything is purged
+    """
+
+    def __init__(self, pool=None, batch=functions.PURGE_BATCH, interval=PURGE_INTERVAL):
+        if pool is None:
+            pool = db_pool.get_pool()
+        self.pool = pool
+        self.batch = batch
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'runs': 0, 'failed_runs': 0, 'likes': 0, 'papers': 0}
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the thread once its current batch is committed.
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def run_once(self):
+        """
+        Purge one batch.
+
+        :return: The (status, res) of purge_deleted_papers, or (1, None)
+        """
+        try:
+            conn = self.pool.getconn()
+        except (psy.Error, db_pool.PoolTimeout), e:
+            status, res = 1, None
+        else:
+            try:
+                status, res = functions.purge_deleted_papers(conn, self.batch)
+            finally:
+                self.pool.putconn(conn)
+        with self._lock:
+            self._stats['runs'] += 1
+            if status != 0:
+                self._stats['failed_runs'] += 1
+            else:
+                self._stats['likes'] += res[0]
+                self._stats['papers'] += res[1]
+        return status, res
+
+    def _run(self):
+        while not self._stop.is_set():
+            status, res = self.run_once()
+            # go on right away while there is a backlog
+            if status != 0 or res == (0, 0):
+                self._stop.wait(self.interval)
+
+    def stats(self):
+        """
+        :return: A dict of the number of 'runs', 'failed_runs' and of the
+                 'likes' and 'papers' removed so far
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Purge deleted papers")
+    parser.add_argument('--dsn', default='', help="libpq connection string")
+    parser.add_argument('--batch', type=int, default=functions.PURGE_BATCH,
+                        help="likes and papers removed per transaction")
+    parser.add_argument('--interval', type=float, default=PURGE_INTERVAL,
+                        help="seconds to sleep when there is nothing to purge")
+    parser.add_argument('--once', action='store_true',
+                        help="purge what is there and exit")
+    args = parser.parse_args()
+
+    conn = psy.connect(args.dsn)
+    try:
+        while True:
+            status, res = purge_all(conn, args.batch)
+            if status != 0:
+                print "purge failed"
+                sys.exit(1)
+            if res != (0, 0):
+                print "purged %d likes and %d papers" % res
+            if args.once:
+                break
+            time.sleep(args.interval)
+    finally:
+        conn.close()
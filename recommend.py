@@ -0,0 +1,308 @@
+"""
+Recommendation engine behind get_recommend_papers.
+
+T.15 recommends to a user the papers liked by his/her cohort, i.e. the other
+users who liked at least one of the same papers, scored by how many cohort
+members liked them. Papers the user posted or already likes are left out, and
+ties are broken by pid.
+
+Instead of rebuilding the cohort with a self-join of likes on every request,
+the co_likes table keeps, for every pair of users, how many papers both of
+them like. like_paper and unlike_paper update it in the same transaction as
+the likes, and so does purge_deleted_papers when it removes the likes of
+deleted papers, so the cohort of a user is a primary key range scan of
+co_likes. Until then, get_recommend_papers takes the pairs made by the likes
+of deleted papers off the counts, so a deleted paper no longer ties a cohort
+together, as in rebuild(). cohort() does not, as a larger cohort only drops
+more cache entries.
+
+On top of that this module keeps a bounded in-process cache of each user's
+top RECOMMEND_DEPTH papers. A like or unlike changes the scores of the user
+and of his/her cohort only, so only those entries are dropped; deleting a
+paper drops everything.
+
+rebuild() recomputes co_likes from scratch and the recommendations of every
+user with sparse matrix products, for a cold start or after drift (e.g. likes
+removed by cascades from users). It needs numpy and scipy.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import psycopg2 as psy
+
+
+# Number of recommendations computed and cached per user
+RECOMMEND_DEPTH = 50
+# Maximum number of users whose recommendations are cached
+RECOMMEND_MAX_USERS = 10000
+# Seconds a cached entry is served, bounding staleness caused by other processes
+RECOMMEND_TTL = 300
+
+
+class RecommendCache(object):
+    """
+    Per user cache of recommended papers with TTL and LRU eviction.
+
+    Every user has a version that invalidate() bumps, and clear() bumps the
+    versions of everybody, so a result computed before an invalidation is
+    never stored after it.
+    """
+
+    def __init__(self, maxusers=RECOMMEND_MAX_USERS, ttl=RECOMMEND_TTL):
+        self.maxusers = maxusers
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # uname -> (papers, complete, expiry), least recently used first
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._epoch = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def version(self, uname):
+        """
+        Get the version of a user, to be passed to store()
+        """
+        with self._lock:
+            return self._epoch, self._versions.get(uname, 0)
+
+    def lookup(self, uname, count):
+        """
+        Get the top $count recommendations of a user if they are cached
+        """
+        with self._lock:
+            entry = self._entries.get(uname)
+            if entry is not None:
+                papers, complete, expiry = entry
+                if expiry < time.time():
+                    del self._entries[uname]
+                elif count <= len(papers) or complete:
+                    del self._entries[uname]
+                    self._entries[uname] = entry
+                    self._stats['hits'] += 1
+                    return papers[:count]
+            self._stats['misses'] += 1
+            return None
+
+    def store(self, uname, version, papers, complete):
+        """
+        Cache the recommendations of a user.
+
+        :param uname: A string of username
+        :param version: The version of the user before papers were computed
+        :param papers: A list of quintuples, best first
+        :param complete: Whether papers holds every recommendation of the user
+        """
+        with self._lock:
+            if (self._epoch, self._versions.get(uname, 0)) != version:
+                return
+            self._entries.pop(uname, None)
+            while len(self._entries) >= self.maxusers:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+            self._entries[uname] = (papers, complete, time.time() + self.ttl)
+
+    def invalidate(self, unames):
+        """
+        Drop the cached recommendations of some users
+        """
+        with self._lock:
+            for uname in unames:
+                self._versions[uname] = self._versions.get(uname, 0) + 1
+                if self._entries.pop(uname, None) is not None:
+                    self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._versions.clear()
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['users'] = len(self._entries)
+        return stats
+
+
+_cache = RecommendCache()
+_local = threading.local()
+
+
+def version(uname):
+    return _cache.version(uname)
+
+
+def lookup(uname, count):
+    return _cache.lookup(uname, count)
+
+
+def store(uname, version, papers, complete):
+    if not getattr(_local, 'unshared', 0):
+        _cache.store(uname, version, papers, complete)
+
+
+def cohort(cur, uname):
+    """
+    Get the users whose recommendations a like or unlike of uname changes:
+    uname and everybody in his/her cohort. Read it after a like and before
+    an unlike, when the cohort is the largest.
+
+    :param cur: A cursor to read the cohort with
+    :param uname: A string of username
+    :return: A list of usernames
+    """
+    # read even when nothing is cached: a recommendation computed before
+    # the write may still be stored, unless the versions are bumped
+    cur.execute("SELECT other FROM co_likes WHERE username = %s;", (uname,))
+    return [uname] + [row[0] for row in cur.fetchall()]
+
+
+@contextmanager
+def deferred():
+    """
+    Context manager that holds back the invalidations made inside it, in
+    this thread, like results.deferred. It yields the list of held back
+    usernames, to be passed to invalidate() once the transaction is committed.
+    """
+    outer = getattr(_local, 'deferred', None)
+    held = []
+    _local.deferred = held
+    try:
+        yield held
+    finally:
+        _local.deferred = outer
+
+
+@contextmanager
+def unshared():
+    """
+    Context manager that keeps store() from caching the recommendations
+    computed inside it, in this thread, like results.unshared.
+    """
+    depth = getattr(_local, 'unshared', 0)
+    _local.unshared = depth + 1
+    try:
+        yield
+    finally:
+        _local.unshared = depth
+
+
+def invalidate(unames):
+    """
+    Drop the cached recommendations of some users. Call it after the change
+    is committed, so a concurrent read can not cache the old state again.
+    """
+    held = getattr(_local, 'deferred', None)
+    if held is not None:
+        held.extend(unames)
+        return
+    _cache.invalidate(unames)
+
+
+def clear():
+    _cache.clear()
+
+
+def stats():
+    return _cache.stats()
+
+
+def rebuild(conn, depth=RECOMMEND_DEPTH):
+    """
+    Recompute co_likes and the recommendations of every user.
+
+    With L the binary user x paper like matrix, the cohort matrix is
+    C = (L * L^T > 0) without its diagonal, and the scores are S = C * L,
+    minus the papers each user likes or posted. The top $depth papers of
+    every user are stored in the cache, up to its size.
+
+    :param conn: A postgres database connection object
+    :param depth: Number of recommendations kept per user
+    :return: (status, retval)
+        (0, {uname: [pid, ...], ...})   Success, best first for every user
+        (1, None)                       Failure
+    """
+    import numpy as np
+    import scipy.sparse as sp
+
+    # everything cached so far is superseded; likes and unlikes from here on
+    # bump user versions, so their results are not overwritten below
+    _cache.clear()
+    base_version = _cache.version(None)
+    try:
+        cur = conn.cursor()
+        # likes must not change while the statistics are rebuilt
+        cur.execute("LOCK TABLE likes IN SHARE MODE;")
+        cur.execute("DELETE FROM co_likes;")
+        cur.execute("INSERT INTO co_likes \
+            SELECT l1.username, l2.username, COUNT(*) FROM likes l1 \
+            INNER JOIN likes l2 ON l1.pid = l2.pid AND l1.username != l2.username \
+            GROUP BY l1.username, l2.username;")
+        cur.execute("SELECT username FROM users ORDER BY username;")
+        unames = [row[0] for row in cur.fetchall()]
+        # co_likes counts the likes of deleted papers until they are purged,
+        # the recommendations leave them out
+        cur.execute("SELECT pid, username FROM papers WHERE deleted_at IS NULL ORDER BY pid;")
+        papers = cur.fetchall()
+        cur.execute("SELECT l.username, l.pid FROM likes l INNER JOIN papers p ON p.pid = l.pid \
+            WHERE p.deleted_at IS NULL;")
+        likes = cur.fetchall()
+        conn.commit()
+    except psy.DatabaseError, e:
+        conn.rollback()
+        return 1, None
+
+    user_index = dict((u, i) for i, u in enumerate(unames))
+    pids = np.array([pid for pid, author in papers], dtype=np.int64)
+    paper_index = dict((pid, j) for j, (pid, author) in enumerate(papers))
+    shape = (len(unames), len(papers))
+
+    rows = np.array([user_index[u] for u, pid in likes], dtype=np.int64)
+    cols = np.array([paper_index[pid] for u, pid in likes], dtype=np.int64)
+    liked = sp.csr_matrix((np.ones(len(likes)), (rows, cols)), shape=shape)
+    rows = np.array([user_index[author] for pid, author in papers], dtype=np.int64)
+    cols = np.arange(len(papers), dtype=np.int64)
+    posted = sp.csr_matrix((np.ones(len(papers)), (rows, cols)), shape=shape)
+
+    cohort = liked.dot(liked.T).tocsr()
+    cohort.setdiag(0)
+    cohort.eliminate_zeros()
+    cohort.data[:] = 1
+    scores = cohort.dot(liked).tocsr()
+    # drop the papers users already like or posted themselves
+    excluded = (liked + posted).tocsr()
+    excluded.data[:] = 1
+    scores = (scores - scores.multiply(excluded)).tocsr()
+    scores.eliminate_zeros()
+
+    result = {}
+    for i, uname in enumerate(unames):
+        start, end = scores.indptr[i], scores.indptr[i + 1]
+        user_pids = pids[scores.indices[start:end]]
+        user_scores = scores.data[start:end]
+        # by score descending, then pid ascending
+        order = np.lexsort((user_pids, -user_scores))[:depth]
+        result[uname] = [int(pid) for pid in user_pids[order]]
+
+    try:
+        cur = conn.cursor()
+        recommended = sorted(set(pid for top in result.itervalues() for pid in top))
+        cur.execute("SELECT pid, username, title, begin_time, description \
+            FROM papers WHERE pid = ANY(%s);", (recommended,))
+        rows = dict((row[0], row) for row in cur.fetchall())
+        conn.rollback()
+    except psy.DatabaseError, e:
+        conn.rollback()
+        return 1, None
+    for uname in unames[:_cache.maxusers]:
+        top = [rows[pid] for pid in result[uname] if pid in rows]
+        _cache.store(uname, base_version, top, len(top) < depth)
+    return 0, result
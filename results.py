@@ -0,0 +1,289 @@
+"""
+Read-through cache of the results of the read APIs in functions.py.
+
+The timeline, popularity and tag lists return the same rows between writes,
+so their results are kept in process, keyed on the API name and its
+arguments. Every cached API declares the scopes its result depends on:
+
+    ('papers',)         the set of all papers
+    ('user', uname)     the papers posted by a user
+    ('tag', tagname)    the papers that have a tag
+    ('tags',)           the tag and tag pair counters
+    ('likes',)          the like counters of all papers
+    ('likes', pid)      the like counter of a paper
+    ('liked', uname)    the papers a user likes
+    ('paper', pid)      a single paper and its tags
+
+Every scope has a version, and the versions of the scopes of an API are part
+of the key of its results. The write APIs bump the versions of the scopes
+they change once their transaction is committed, so results computed before
+the write can no longer be found and age out of the LRU, while everything
+else stays cached.
+
+Entries expire ttl seconds after they were stored, which bounds how long
+writes of other processes go unnoticed. Callers that need to read their own
+writes from elsewhere use the bypass() context manager, and set_enabled(False)
+turns the cache off altogether.
+"""
+
+import functools
+import inspect
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# Whether cached() serves results from the cache at all
+USE_CACHE = True
+# Seconds a result is served after it was computed
+RESULT_TTL = 60
+# Maximum number of results kept in memory
+RESULT_MAX = 10000
+# Maximum number of scope versions kept; beyond that everything is dropped
+RESULT_MAX_SCOPES = 100000
+
+_local = threading.local()
+
+
+class ResultCache(object):
+    """
+    Result cache with versioned keys, TTL expiry and LRU eviction.
+
+    :param ttl: Seconds a result stays valid
+    :param maxsize: Maximum number of results kept
+    :param maxscopes: Maximum number of scope versions kept
+    """
+
+    def __init__(self, ttl=RESULT_TTL, maxsize=RESULT_MAX, maxscopes=RESULT_MAX_SCOPES):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.maxscopes = maxscopes
+        self._lock = threading.Lock()
+        # key -> (result, expiry), least recently used first
+        self._entries = OrderedDict()
+        # scope -> version, scopes that were never bumped are at version 0
+        self._versions = {}
+        self._epoch = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0,
+                       'bypassed': 0, 'invalidations': 0}
+
+    def key(self, name, args, scopes):
+        """
+        Get the key of a result under the current versions of its scopes
+        """
+        with self._lock:
+            versions = tuple(self._versions.get(scope, 0) for scope in scopes)
+            return name, args, self._epoch, versions
+
+    def lookup(self, key):
+        """
+        Get a cached result.
+
+        :param key: A key returned by key()
+        :return: The result, or None if it is not cached or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            result, expiry = entry
+            if expiry < time.time():
+                del self._entries[key]
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+            # move to the most recently used end
+            del self._entries[key]
+            self._entries[key] = entry
+            self._stats['hits'] += 1
+            return result
+
+    def store(self, key, result):
+        """
+        Cache a result under the key taken before it was computed. If one of
+        its scopes was bumped meanwhile the key is already outdated and the
+        entry is never found again.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+            self._entries[key] = (result, time.time() + self.ttl)
+
+    def invalidate(self, scopes):
+        """
+        Bump the versions of some scopes, making every result that depends
+        on one of them unreachable
+        """
+        with self._lock:
+            for scope in scopes:
+                self._versions[scope] = self._versions.get(scope, 0) + 1
+            self._stats['invalidations'] += 1
+            if len(self._versions) > self.maxscopes:
+                self._clear()
+
+    def _clear(self):
+        """
+        Drop every result. Caller holds the lock.
+        """
+        self._epoch += 1
+        self._versions.clear()
+        self._entries.clear()
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def bypassed(self):
+        with self._lock:
+            self._stats['bypassed'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+            stats['scopes'] = len(self._versions)
+        return stats
+
+
+_cache = ResultCache()
+
+
+def configure(ttl=RESULT_TTL, maxsize=RESULT_MAX, maxscopes=RESULT_MAX_SCOPES):
+    """
+    Replace the result cache, dropping all results
+    """
+    global _cache
+    _cache = ResultCache(ttl, maxsize, maxscopes)
+    return _cache
+
+
+def set_enabled(flag):
+    """
+    Switch the cache on or off for every caller.
+
+    :param flag: True to serve results from the cache, False to always run the query
+    """
+    global USE_CACHE
+    USE_CACHE = bool(flag)
+
+
+@contextmanager
+def bypass():
+    """
+    Context manager that makes the cached APIs called inside it, in this
+    thread, run their queries. Fresh results are still stored for others.
+    """
+    depth = getattr(_local, 'bypass', 0)
+    _local.bypass = depth + 1
+    try:
+        yield
+    finally:
+        _local.bypass = depth
+
+
+@contextmanager
+def unshared():
+    """
+    Context manager that keeps the cached APIs called inside it, in this
+    thread, from storing what they compute. Cached results are still served.
+    For reads from a replica, which may not have the writes whose
+    invalidations this process has already seen, see router.
+    """
+    depth = getattr(_local, 'unshared', 0)
+    _local.unshared = depth + 1
+    try:
+        yield
+    finally:
+        _local.unshared = depth
+
+
+def _copy(result):
+    """
+    Copy the lists and dicts of a result, e.g. the tag lists of hydrated
+    papers or a profile, so callers can not change the cached one
+    """
+    if isinstance(result, list):
+        return [_copy(item) for item in result]
+    if isinstance(result, tuple):
+        return tuple(_copy(item) for item in result)
+    if isinstance(result, dict):
+        return dict((key, _copy(value)) for key, value in result.iteritems())
+    return result
+
+
+def cached(scopes):
+    """
+    Decorator that caches the successful results of a read API.
+
+    :param scopes: A function that gets the arguments of a call as a dict
+                   and returns the scopes its result depends on
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(conn, *args, **kwargs):
+            callargs = inspect.getcallargs(func, conn, *args, **kwargs)
+            del callargs['conn']
+            cache = _cache
+            try:
+                key = cache.key(func.__name__, tuple(sorted(callargs.items())),
+                                scopes(callargs))
+                hash(key)
+            except TypeError:
+                # unhashable arguments are never cached
+                return func(conn, *args, **kwargs)
+            if not USE_CACHE or getattr(_local, 'bypass', 0):
+                cache.bypassed()
+            else:
+                result = cache.lookup(key)
+                if result is not None:
+                    return 0, _copy(result)
+            status, res = func(conn, *args, **kwargs)
+            if status == 0 and not getattr(_local, 'unshared', 0):
+                cache.store(key, _copy(res))
+            return status, res
+        # functools.wraps does not set it on Python 2
+        wrapper.__wrapped__ = func
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def deferred():
+    """
+    Context manager that holds back the invalidations made inside it, in
+    this thread, for callers that commit after the APIs they run, see
+    write_behind. It yields the list of held back scopes, to be passed to
+    invalidate() once the transaction is committed.
+    """
+    outer = getattr(_local, 'deferred', None)
+    held = []
+    _local.deferred = held
+    try:
+        yield held
+    finally:
+        _local.deferred = outer
+
+
+def invalidate(scopes):
+    """
+    Drop the results that depend on some scopes. Call it after the change
+    is committed, so a concurrent read can not cache the old state again.
+    """
+    held = getattr(_local, 'deferred', None)
+    if held is not None:
+        held.extend(scopes)
+        return
+    _cache.invalidate(scopes)
+
+
+def clear():
+    _cache.clear()
+
+
+def stats():
+    return _cache.stats()
@@ -0,0 +1,337 @@
+"""
+Read/write splitting between a primary and a streaming replica.
+
+The read APIs (READ_APIS) run on a pool of connections to the replica and
+everything else on the primary, with the same (status, res) contract as
+pool.call_db:
+
+    import paper.router as router
+    r = router.configure(primary=pool.ConnectionPool(dsn="host=primary"),
+                         replica=pool.ConnectionPool(dsn="host=replica"))
+    session = router.Session()
+    r.like_paper(session, uname="foo", pid=1)
+    status, res = r.get_papers_by_liked(session, uname="foo")
+
+A replica replays the WAL of the primary with some lag, so a read right
+after a write might not see it. A Session remembers the WAL position
+(LSN) of the primary after the last write made through it. A read of that
+session polls the replica for up to max_wait seconds until it has replayed
+that position, and otherwise runs on the primary. Reads without a session,
+or of a session that made no write, go to the replica right away. A read
+that fails on the replica with a database error, e.g. a query canceled by a
+recovery conflict, is run again on the primary. A failure the API returns
+for its arguments, like a wrong password, is returned as it is.
+
+Results read from the replica are not stored in the result and
+recommendation caches of this process. Those caches are invalidated when
+the writes of this process commit, so a lagging replica read could cache a
+result from before the write. suggest_tags stays on the primary, as its
+index is loaded once and then served from memory.
+
+To try it with two local instances, start a primary with wal_level=replica,
+clone it with pg_basebackup -R -D <dir> into a standby, start the standby
+on another port and run the check below, which writes and reads back through
+one session:
+
+    python router.py --primary "port=5432 dbname=paper" \\
+        --replica "port=5433 dbname=paper" --rounds 200
+"""
+
+import sys
+import threading
+import time
+
+import psycopg2 as psy
+import psycopg2.extensions as psy_ext
+
+from constants import *
+
+import functions
+import pool as db_pool
+import recommend
+import results
+
+
+# The APIs that only read. The session APIs read users, and check_session
+# does not use its connection at all
+READ_APIS = frozenset([name for name in functions.API if name.startswith('get_')]
+                      + ['hydrate_papers', 'login', 'login_session', 'check_session'])
+
+# Transaction states of a replica connection whose API failed on a database
+# error, after which the read is run on the primary
+_FAILED = (psy_ext.TRANSACTION_STATUS_INERROR, psy_ext.TRANSACTION_STATUS_UNKNOWN)
+
+# Seconds a read waits for the replica to reach its session's last write
+MAX_WAIT = 0.05
+# Seconds between two replay position checks while waiting
+POLL_INTERVAL = 0.002
+
+
+def parse_lsn(text):
+    """
+    Turn a pg_lsn like '16/B374D848' into an int, so positions can be compared
+    """
+    high, low = text.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+class Session(object):
+    """
+    The WAL position a client's reads have to see: the one of the primary
+    after its last write through the router. One per client session; it can
+    be shared between threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.lsn = 0
+
+    def wrote(self, lsn):
+        with self._lock:
+            self.lsn = max(self.lsn, lsn)
+
+
+class Router(object):
+    """
+    Sends the read APIs to a replica and the others to the primary.
+
+    :param primary: A pool.ConnectionPool of the primary, the one configured
+                    in pool by default
+    :param replica: A pool.ConnectionPool of the replica, None to send
+                    everything to the primary
+    :param max_wait: Seconds a read waits for the replica to catch up with
+                     its session before it runs on the primary
+    :param poll_interval: Seconds between two replay position checks
+    """
+
+    def __init__(self, primary=None, replica=None, max_wait=MAX_WAIT,
+                 poll_interval=POLL_INTERVAL):
+        if primary is None:
+            primary = db_pool.get_pool()
+        self.primary = primary
+        self.replica = replica
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._stats = {
+            'writes': 0,
+            'replica_reads': 0,
+            'primary_reads': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'lagging': 0,
+            'replica_errors': 0,
+        }
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    def _caught_up(self, conn, lsn):
+        """
+        Wait until the replica has replayed lsn.
+
+        :return: Whether it did within max_wait
+        """
+        start = time.time()
+        deadline = start + self.max_wait
+        cur = conn.cursor()
+        waited = False
+        try:
+            while True:
+                cur.execute("SELECT pg_last_wal_replay_lsn();")
+                replayed = cur.fetchone()[0]
+                # NULL when the server is not a standby
+                if replayed is not None and parse_lsn(replayed) >= lsn:
+                    return True
+                if replayed is None or time.time() >= deadline:
+                    return False
+                waited = True
+                time.sleep(self.poll_interval)
+        finally:
+            conn.rollback()
+            if waited:
+                with self._lock:
+                    self._stats['waits'] += 1
+                    self._stats['wait_time_total'] += time.time() - start
+
+    def _write(self, func, argdict, session):
+        conn = self.primary.getconn()
+        try:
+            status, res = func(conn, **argdict)
+            if status == 0 and session is not None:
+                cur = conn.cursor()
+                cur.execute("SELECT pg_current_wal_lsn();")
+                session.wrote(parse_lsn(cur.fetchone()[0]))
+                conn.rollback()
+            self._count('writes')
+            return status, res
+        finally:
+            self.primary.putconn(conn)
+
+    def _read_replica(self, func, argdict, session):
+        """
+        :return: The (status, res) of the API on the replica, or None if the
+                 replica is unreachable, behind the session or failed the query
+        """
+        try:
+            conn = self.replica.getconn()
+        except (psy.Error, db_pool.PoolTimeout), e:
+            self._count('replica_errors')
+            return None
+        try:
+            try:
+                if session is not None and session.lsn and not self._caught_up(conn, session.lsn):
+                    self._count('lagging')
+                    return None
+                with results.unshared(), recommend.unshared():
+                    ret = func(conn, **argdict)
+            except psy.OperationalError, e:
+                # e.g. a standby that was restarted; the primary can answer
+                self._count('replica_errors')
+                return None
+            if ret[0] != 0 and conn.get_transaction_status() in _FAILED:
+                # the APIs turn database errors into a status, e.g. a query
+                # canceled by a recovery conflict, and leave the transaction
+                # aborted; other failures, like a wrong password, stand
+                self._count('replica_errors')
+                return None
+            self._count('replica_reads')
+            return ret
+        finally:
+            self.replica.putconn(conn)
+
+    def call(self, func, argdict, session=None):
+        """
+        Call an API on the primary or the replica.
+
+        :param func: An API from functions.py
+        :param argdict: A dict of keyword arguments for the API, without conn
+        :param session: A Session whose writes the call has to see, or None
+        :return: The (status, res) of the API, or (DB_ERROR, None)
+        """
+        try:
+            if func.__name__ not in READ_APIS:
+                return self._write(func, argdict, session)
+            if self.replica is not None:
+                ret = self._read_replica(func, argdict, session)
+                if ret is not None:
+                    return ret
+            self._count('primary_reads')
+            return db_pool.call_db(func, argdict, self.primary)
+        except (psy.DatabaseError, db_pool.PoolTimeout), e:
+            return DB_ERROR, None
+
+    def __getattr__(self, name):
+        if name not in functions.API:
+            raise AttributeError(name)
+        func = getattr(functions, name)
+
+        def call(session=None, **kwargs):
+            return self.call(func, kwargs, session)
+        call.__name__ = name
+        call.__doc__ = func.__doc__
+        return call
+
+    def stats(self):
+        """
+        Get the routing counters
+
+        :return: A dict with the number of 'writes', of reads served by the
+                 replica ('replica_reads') and by the primary ('primary_reads'),
+                 of reads that went to the primary because the replica was
+                 'lagging', or was unreachable or failed the query
+                 ('replica_errors'), and of reads that
+                 'waits'ed for the replica with their average 'wait_time_avg'
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['wait_time_avg'] = (stats['wait_time_total'] / stats['waits']
+                                  if stats['waits'] else 0.0)
+        return stats
+
+
+_router = None
+
+
+def configure(primary=None, replica=None, **kwargs):
+    """
+    Create the Router used by get_router. Takes the same arguments as Router.
+    """
+    global _router
+    _router = Router(primary, replica, **kwargs)
+    return _router
+
+
+def get_router():
+    """
+    Get the Router set up by configure, creating one that sends everything
+    to the pool used by pool.call_db if configure has not been called.
+    """
+    global _router
+    if _router is None:
+        _router = Router()
+    return _router
+
+
+def check(r, rounds=100, uname='router_check'):
+    """
+    Add papers through a session and read them back right away.
+
+    :param r: A Router
+    :return: (status, retval)
+        (0, stale)  Success, the number of reads that missed their own write
+        (1, None)   A write failed
+    """
+    session = Session()
+    r.signup(session, uname=uname, pwd=uname)
+    pids = []
+    stale = 0
+    try:
+        for i in range(rounds):
+            status, pid = r.add_new_paper(session, uname=uname, title='check %d' % i,
+                                          desc='router check', text=None, tags=[])
+            if status != 0:
+                return 1, None
+            pids.append(pid)
+            status, papers = r.get_timeline(session, uname=uname, count=1)
+            if status != 0 or not papers or papers[0][0] != pid:
+                stale += 1
+    finally:
+        if pids:
+            r.delete_papers(session, pids=pids)
+    return 0, stale
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check read-your-writes through a replica")
+    parser.add_argument('--primary', default='', help="libpq connection string of the primary")
+    parser.add_argument('--replica', required=True,
+                        help="libpq connection string of the streaming replica")
+    parser.add_argument('--rounds', type=int, default=100, help="writes read back")
+    parser.add_argument('--max-wait', type=float, default=MAX_WAIT,
+                        help="seconds a read waits for the replica")
+    args = parser.parse_args()
+
+    # every read has to reach a database to be checked
+    results.set_enabled(False)
+    primary = db_pool.ConnectionPool(dsn=args.primary)
+    replica = db_pool.ConnectionPool(dsn=args.replica)
+    try:
+        r = Router(primary, replica, max_wait=args.max_wait)
+        status, stale = check(r, args.rounds)
+        stats = r.stats()
+    finally:
+        primary.closeall()
+        replica.closeall()
+    if status != 0:
+        print "writing to the primary failed"
+        sys.exit(1)
+    for name in ('writes', 'replica_reads', 'primary_reads', 'lagging', 'replica_errors', 'waits'):
+        print "%-14s %8d" % (name, stats[name])
+    print "wait_time_avg  %8.3fms" % (1000 * stats['wait_time_avg'])
+    print "stale reads    %8d" % stale
+    if stale:
+        sys.exit(1)
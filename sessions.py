@@ -0,0 +1,161 @@
+"""
+In-process cache of authenticated sessions.
+
+login_session in functions.py hands out an opaque token once the credentials
+have been checked against the database. Later requests present the token and
+check_session resolves it here without touching the database.
+
+Entries expire ttl seconds after they were created, and the least recently
+used ones are evicted once the cache holds maxsize sessions. All sessions of a
+user are dropped when the user is signed up again, and the whole cache is
+dropped by reset_db.
+"""
+
+import binascii
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+
+# Seconds a session stays valid after login
+SESSION_TTL = 30 * 60
+# Maximum number of sessions kept in memory
+SESSION_MAX = 10000
+
+
+class SessionCache(object):
+    """
+    Token -> username map with TTL expiry and LRU eviction.
+
+    :param ttl: Seconds a session stays valid
+    :param maxsize: Maximum number of sessions kept
+    """
+
+    def __init__(self, ttl=SESSION_TTL, maxsize=SESSION_MAX):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        # token -> (username, expiry), least recently used first
+        self._sessions = OrderedDict()
+        # username -> set of tokens
+        self._by_user = {}
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+
+    def _drop(self, token):
+        """
+        Remove a session. Caller holds the lock.
+        """
+        uname, expiry = self._sessions.pop(token)
+        tokens = self._by_user.get(uname)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._by_user[uname]
+
+    def create(self, uname):
+        """
+        Open a session for a user whose credentials were just checked.
+
+        :param uname: A string of username
+        :return: A string token identifying the session
+        """
+        token = binascii.hexlify(os.urandom(16))
+        with self._lock:
+            while len(self._sessions) >= self.maxsize:
+                self._drop(next(iter(self._sessions)))
+                self._stats['evictions'] += 1
+            self._sessions[token] = (uname, time.time() + self.ttl)
+            self._by_user.setdefault(uname, set()).add(token)
+        return token
+
+    def lookup(self, token):
+        """
+        Resolve a token to its user.
+
+        :param token: A string token returned by create
+        :return: The username, or None if the session is unknown or expired
+        """
+        with self._lock:
+            entry = self._sessions.get(token)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            uname, expiry = entry
+            if expiry < time.time():
+                self._drop(token)
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+            # move to the most recently used end
+            del self._sessions[token]
+            self._sessions[token] = entry
+            self._stats['hits'] += 1
+            return uname
+
+    def invalidate(self, token):
+        """
+        Close a single session, e.g. on logout
+        """
+        with self._lock:
+            if token in self._sessions:
+                self._drop(token)
+
+    def invalidate_user(self, uname):
+        """
+        Close every session of a user
+        """
+        with self._lock:
+            for token in list(self._by_user.get(uname, ())):
+                self._drop(token)
+
+    def clear(self):
+        """
+        Close every session
+        """
+        with self._lock:
+            self._sessions.clear()
+            self._by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._sessions)
+        return stats
+
+
+_cache = SessionCache()
+
+
+def configure(ttl=SESSION_TTL, maxsize=SESSION_MAX):
+    """
+    Replace the session cache, dropping all sessions
+    """
+    global _cache
+    _cache = SessionCache(ttl, maxsize)
+    return _cache
+
+
+def create(uname):
+    return _cache.create(uname)
+
+
+def lookup(token):
+    return _cache.lookup(token)
+
+
+def invalidate(token):
+    _cache.invalidate(token)
+
+
+def invalidate_user(uname):
+    _cache.invalidate_user(uname)
+
+
+def clear():
+    _cache.clear()
+
+
+def stats():
+    return _cache.stats()
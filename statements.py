@@ -0,0 +1,235 @@
+"""
+Registry of server-side prepared statements.
+
+Every query in functions.py goes through execute() under a fixed statement
+name. The first time a name is used on a connection the query is PREPAREd
+there, and every later call runs it with EXECUTE, so the server neither
+re-parses nor re-plans the big CTEs of the recommendation and popularity
+queries on every call. Pooled connections keep their sessions, so statements
+are prepared once per connection rather than once per call.
+
+Statements are re-prepared when
+    - the connection is new, e.g. after a reconnect (tracked per connection
+      object, so a replaced connection starts with nothing prepared)
+    - reset_db changed the schema, which bumps the schema generation and makes
+      every connection DEALLOCATE and re-prepare lazily
+    - the server reports that a prepared statement is gone or stale, in which
+      case the connection DEALLOCATEs all of them before preparing again, and
+      a call that started its own transaction is retried once
+
+set_prepared(False) switches back to plain ad-hoc execution of the same SQL
+text, so each API can be benchmarked both ways. capture_plans() records the
+EXPLAIN output of every statement an API runs, see migrations.check_plans.
+"""
+
+import re
+import threading
+import weakref
+
+from contextlib import contextmanager
+
+import psycopg2 as psy
+import psycopg2.extensions as psy_ext
+
+
+# Whether execute() uses prepared statements or sends the SQL text each time
+USE_PREPARED = True
+
+# pgcodes meaning that a prepared statement has to be prepared again:
+# invalid_sql_statement_name and feature_not_supported ("cached plan must
+# not change result type")
+REPREPARE_CODES = ('26000', '0A000')
+
+_lock = threading.Lock()
+# statement name -> (sql with %s placeholders, sql with $n placeholders)
+_registry = {}
+# connection -> (schema generation, set of prepared statement names)
+_prepared = weakref.WeakKeyDictionary()
+_generation = 0
+# statement name -> EXPLAIN output while capture_plans is active
+_plans = None
+
+_stats = {
+    'prepares': 0,
+    'executes': 0,
+    'adhoc': 0,
+    'reprepares': 0,
+}
+
+_PLACEHOLDER = re.compile(r'%(s|%)')
+
+
+def set_prepared(flag):
+    """
+    Switch between prepared and ad-hoc execution.
+
+    :param flag: True to use prepared statements, False for ad-hoc SQL
+    """
+    global USE_PREPARED
+    USE_PREPARED = bool(flag)
+
+
+@contextmanager
+def capture_plans():
+    """
+    Context manager that EXPLAINs every statement executed inside it.
+
+    Yields a dict that is filled with statement name -> plan, where plan is
+    the parsed EXPLAIN (FORMAT JSON) output. Only meant for diagnostics, the
+    statements still run as usual.
+    """
+    global _plans
+    plans = {}
+    _plans = plans
+    try:
+        yield plans
+    finally:
+        _plans = None
+
+
+def _to_positional(sql):
+    """
+    Turn the %s placeholders of a query into $1, $2, ... for PREPARE
+    """
+    counter = [0]
+
+    def replace(match):
+        if match.group(1) == '%':
+            return '%'
+        counter[0] += 1
+        return '$%d' % counter[0]
+    return _PLACEHOLDER.sub(replace, sql)
+
+
+def register(name, sql):
+    """
+    Register the SQL text of a statement name.
+
+    :param name: A statement name, must be a valid SQL identifier
+    :param sql: The query with %s placeholders
+    """
+    entry = _registry.get(name)
+    if entry is not None:
+        if entry[0] != sql:
+            raise ValueError("statement %s registered with different SQL" % name)
+        return entry
+    with _lock:
+        entry = (sql, _to_positional(sql))
+        _registry[name] = entry
+    return entry
+
+
+def registered():
+    """
+    Get the registered statements
+
+    :return: A dict of statement name to SQL text
+    """
+    return dict((name, entry[0]) for name, entry in _registry.iteritems())
+
+
+def schema_changed():
+    """
+    Record that the schema changed, so every connection re-prepares its
+    statements the next time it uses them.
+    """
+    global _generation
+    with _lock:
+        _generation += 1
+
+
+def forget(conn):
+    """
+    Forget what is prepared on a connection, e.g. after DEALLOCATE ALL
+    """
+    with _lock:
+        _prepared.pop(conn, None)
+
+
+def _outdated(conn, name):
+    """
+    Record that a connection has statements the server can no longer run,
+    so the next _prepared_names deallocates everything before preparing
+    again. name may still exist there: on 0A000 the statement is stale, not
+    gone, and preparing it again would fail with 42P05.
+    """
+    with _lock:
+        generation, names = _prepared.get(conn, (None, None))
+        names = set(names or ())
+        names.add(name)
+        _prepared[conn] = (None, names)
+
+
+def _prepared_names(conn, cur):
+    """
+    Get the set of statements prepared on a connection for the current
+    schema generation, deallocating stale ones first.
+    """
+    with _lock:
+        generation, names = _prepared.get(conn, (None, None))
+        current = _generation
+    if generation == current:
+        return names
+    if names:
+        cur.execute("DEALLOCATE ALL")
+    names = set()
+    with _lock:
+        _prepared[conn] = (current, names)
+    return names
+
+
+def _execute_prepared(cur, name, positional, data):
+    names = _prepared_names(cur.connection, cur)
+    if name not in names:
+        cur.execute("PREPARE %s AS %s" % (name, positional))
+        names.add(name)
+        _stats['prepares'] += 1
+    if data:
+        cur.execute("EXECUTE %s(%s)" % (name, ', '.join(['%s'] * len(data))), data)
+    else:
+        cur.execute("EXECUTE %s" % name)
+    _stats['executes'] += 1
+
+
+def execute(cur, name, sql, data=()):
+    """
+    Execute a query through its prepared statement.
+
+    :param cur: A cursor of the connection to run the query on
+    :param name: The statement name of the query
+    :param sql: The query with %s placeholders
+    :param data: A tuple of query parameters
+    """
+    if _plans is not None:
+        cur.execute("EXPLAIN (FORMAT JSON) " + sql, data)
+        _plans[name] = cur.fetchone()[0]
+    if not USE_PREPARED:
+        _stats['adhoc'] += 1
+        cur.execute(sql, data)
+        return
+    positional = register(name, sql)[1]
+    conn = cur.connection
+    fresh = conn.get_transaction_status() == psy_ext.TRANSACTION_STATUS_IDLE
+    try:
+        _execute_prepared(cur, name, positional, data)
+    except psy.DatabaseError, e:
+        if e.pgcode not in REPREPARE_CODES:
+            raise
+        # the server no longer has a usable statement; it can only be
+        # retried transparently if nothing else ran in this transaction.
+        # Otherwise the caller rolls back and the next call deallocates
+        _outdated(conn, name)
+        if not fresh:
+            raise
+        conn.rollback()
+        _stats['reprepares'] += 1
+        _execute_prepared(cur, name, positional, data)
+
+
+def stats():
+    """
+    Get the prepare/execute counters
+
+    :return: A dict of counters
+    """
+    return dict(_stats)
@@ -0,0 +1,191 @@
+"""
+Streaming variants of the list APIs and a JSONL export.
+
+The list APIs in functions.py fetch their whole result with fetchall(), which
+is fine for a page but not for every paper of a big tag or user. The
+generators here yield the same quintuples in the same order from a named
+(server-side) cursor, fetching batch rows per round trip, so memory use does
+not depend on the size of the result:
+
+    for pid, uname, title, begin_time, desc in streaming.iter_timeline_all(conn):
+        ...
+
+Unlike the APIs they raise psycopg2.DatabaseError instead of returning a
+status. A named cursor lives in a transaction, which is rolled back when the
+generator is exhausted or closed; nothing is written.
+
+export() streams users, papers with their tags, and likes to JSONL files in
+the format of bulk_load, from one consistent snapshot:
+
+    python streaming.py --dsn "dbname=paper" --out /tmp/export
+"""
+
+import itertools
+import json
+import os
+import sys
+
+import psycopg2 as psy
+
+
+# Rows fetched per round trip
+STREAM_BATCH = 2000
+
+_names = itertools.count()
+
+
+def _stream(conn, sql, data=(), batch=STREAM_BATCH, finish=True):
+    """
+    Yield the rows of a query from a named cursor.
+
+    :param finish: Whether to roll back the transaction when done, False
+                   to keep it open for more queries on the same snapshot
+    """
+    cur = conn.cursor(name='paper_stream_%d' % next(_names))
+    cur.itersize = batch
+    try:
+        cur.execute(sql, data)
+        for row in cur:
+            yield row
+    finally:
+        try:
+            cur.close()
+        finally:
+            if finish:
+                conn.rollback()
+
+
+def iter_timeline(conn, uname, count=None, batch=STREAM_BATCH):
+    """
+    Stream the timeline of a user, in the order of get_timeline.
+
+    :param conn: A postgres database connection object
+    :param uname: A string of username
+    :param count: The maximum number of papers, None for all of them
+    :param batch: Number of rows fetched per round trip
+    :return: A generator of (pid, username, title, begin_time, description)
+    """
+    sql = "SELECT pid, username, title, begin_time, description FROM papers \
+        WHERE username = %s AND deleted_at IS NULL ORDER BY begin_time DESC, pid LIMIT %s;"
+    return _stream(conn, sql, (uname, count,), batch)
+
+
+def iter_timeline_all(conn, count=None, batch=STREAM_BATCH):
+    """
+    Stream all papers, in the order of get_timeline_all.
+    """
+    sql = "SELECT pid, username, title, begin_time, description FROM papers \
+        WHERE deleted_at IS NULL ORDER BY begin_time DESC, pid LIMIT %s;"
+    return _stream(conn, sql, (count,), batch)
+
+
+def iter_papers_by_tag(conn, tag, count=None, batch=STREAM_BATCH):
+    """
+    Stream the papers that have a tag, in the order of get_papers_by_tag.
+    """
+    sql = "SELECT p.pid, p.username, title, begin_time, description \
+        FROM papers p INNER JOIN tags t ON p.pid = t.pid \
+        WHERE t.tagname = %s AND p.deleted_at IS NULL ORDER BY begin_time DESC, p.pid ASC \
+        LIMIT %s;"
+    return _stream(conn, sql, (tag, count,), batch)
+
+
+def iter_papers_by_keyword(conn, keyword, count=None, batch=STREAM_BATCH):
+    """
+    Stream the papers that match a keyword, in the order of get_papers_by_keyword.
+    """
+    sql = "SELECT pid, username, title, begin_time, description \
+        FROM papers WHERE search_vector @@ websearch_to_tsquery('english', %s) \
+            AND deleted_at IS NULL \
+        ORDER BY begin_time DESC, pid ASC LIMIT %s;"
+    return _stream(conn, sql, (keyword, count,), batch)
+
+
+def iter_papers_by_liked(conn, uname, count=None, batch=STREAM_BATCH):
+    """
+    Stream the papers liked by a user, in the order of get_papers_by_liked.
+    """
+    sql = "SELECT p.pid, p.username, title, begin_time, description \
+        FROM papers p INNER JOIN likes l ON p.pid = l.pid \
+        WHERE l.username = %s AND p.deleted_at IS NULL ORDER BY like_time DESC, p.pid ASC \
+        LIMIT %s;"
+    return _stream(conn, sql, (uname, count,), batch)
+
+
+def _write_jsonl(path, records):
+    count = 0
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+            count += 1
+    return count
+
+
+def export(conn, out, batch=STREAM_BATCH):
+    """
+    Export the database to users.jsonl, papers.jsonl and likes.jsonl.
+
+    The files can be loaded again with bulk_load; papers are keyed by their
+    pid and carry their tags, likes refer to them by that key.
+
+    :param conn: A postgres database connection object
+    :param out: The directory to write the files to
+    :param batch: Number of rows fetched per round trip
+    :return: (status, retval)
+        (0, {'users': n, 'papers': n, 'likes': n})  Success, rows written per file
+        (1, None)                                   Failure
+    """
+    counts = {}
+    try:
+        cur = conn.cursor()
+        # the three files are read from the same snapshot
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY;")
+        rows = _stream(conn, "SELECT username, password FROM users ORDER BY username;",
+                       batch=batch, finish=False)
+        counts['users'] = _write_jsonl(
+            os.path.join(out, 'users.jsonl'),
+            ({'username': u, 'password': p} for u, p in rows))
+        rows = _stream(conn, "SELECT p.pid, p.username, p.title, p.description, x.content, \
+                ARRAY(SELECT tagname FROM tags t WHERE t.pid = p.pid ORDER BY tagname), \
+                p.begin_time \
+            FROM papers p LEFT JOIN paper_texts x ON x.hash = p.text_hash \
+            WHERE p.deleted_at IS NULL ORDER BY p.pid;", batch=batch, finish=False)
+        counts['papers'] = _write_jsonl(
+            os.path.join(out, 'papers.jsonl'),
+            ({'key': str(pid), 'username': uname, 'title': title, 'description': desc,
+              'text': text, 'tags': tags, 'begin_time': str(begin_time)}
+             for pid, uname, title, desc, text, tags, begin_time in rows))
+        rows = _stream(conn, "SELECT l.pid, l.username, l.like_time \
+            FROM likes l INNER JOIN papers p ON p.pid = l.pid \
+            WHERE p.deleted_at IS NULL ORDER BY l.pid, l.username;", batch=batch, finish=False)
+        counts['likes'] = _write_jsonl(
+            os.path.join(out, 'likes.jsonl'),
+            ({'username': uname, 'key': str(pid), 'like_time': str(like_time)}
+             for pid, uname, like_time in rows))
+        conn.rollback()
+        return 0, counts
+    except (psy.DatabaseError, IOError), e:
+        conn.rollback()
+        return 1, None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the database to JSONL")
+    parser.add_argument('--dsn', default='', help="libpq connection string")
+    parser.add_argument('--out', required=True, help="directory to write the files to")
+    parser.add_argument('--batch', type=int, default=STREAM_BATCH,
+                        help="rows fetched per round trip")
+    args = parser.parse_args()
+
+    conn = psy.connect(args.dsn)
+    try:
+        status, counts = export(conn, args.out, args.batch)
+    finally:
+        conn.close()
+    if status != 0:
+        print "export failed"
+        sys.exit(1)
+    for name in ('users', 'papers', 'likes'):
+        print "%-7s %10d rows" % (name, counts[name])
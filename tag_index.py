@@ -0,0 +1,201 @@
+"""
+In-process prefix index of the used tags behind suggest_tags.
+
+tagnames only has a primary key, whose text collation can not answer
+LIKE 'x%', so a prefix lookup in SQL reads every tag. This module keeps the
+names of the used tags in a sorted list with their paper counts instead: the
+tags starting with a prefix are a bisect range of that list. The top
+SUGGEST_DEPTH of each prefix asked for are memoized, so a repeated prefix is
+a dict lookup. Names are sorted and compared as Python strings, i.e. in byte
+order, which is COLLATE "C" and not the collation of the database.
+
+The index is loaded from tag_counts on the first suggest_tags call and kept
+current by add_new_paper, delete_paper and delete_papers, which pass the
+count changes of their committed tags to update(). A change only drops the
+memoized prefixes of the tags it touches. bulk_load and reset_db drop the
+whole index, and it is reloaded after TAG_INDEX_TTL seconds to pick up
+changes made by other processes.
+"""
+
+import bisect
+import heapq
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+# Suggestions computed and memoized per prefix
+SUGGEST_DEPTH = 20
+# Maximum number of memoized prefixes
+SUGGEST_MAX_PREFIXES = 10000
+# Seconds a loaded index is served, bounding staleness caused by other processes
+TAG_INDEX_TTL = 300
+
+
+class TagIndex(object):
+    """
+    Sorted tag names with their counts and a memo of the top tags per prefix.
+    Only tags with a count above 0 are kept.
+
+    :param rows: (tagname, count) pairs
+    """
+
+    def __init__(self, rows=(), depth=SUGGEST_DEPTH, maxprefixes=SUGGEST_MAX_PREFIXES):
+        self.depth = depth
+        self.maxprefixes = maxprefixes
+        self._lock = threading.Lock()
+        self._counts = dict((tag, count) for tag, count in rows if count > 0)
+        self._names = sorted(self._counts)
+        # prefix -> the top $depth (tagname, count) pairs
+        self._memo = {}
+
+    def _top(self, prefix, count):
+        lo = bisect.bisect_left(self._names, prefix)
+        hi = lo
+        while hi < len(self._names) and self._names[hi].startswith(prefix):
+            hi += 1
+        ranked = heapq.nsmallest(count, ((-self._counts[tag], tag)
+                                         for tag in self._names[lo:hi]))
+        return [(tag, -negated) for negated, tag in ranked]
+
+    def suggest(self, prefix, count):
+        """
+        Get the $count most used tags starting with prefix, ordered by count
+        (descending) and then by tag name in byte order, like COLLATE "C"
+        """
+        with self._lock:
+            if count > self.depth:
+                return self._top(prefix, count)
+            top = self._memo.get(prefix)
+            if top is None:
+                top = self._top(prefix, self.depth)
+                if len(self._memo) >= self.maxprefixes:
+                    self._memo.clear()
+                self._memo[prefix] = top
+            return top[:max(count, 0)]
+
+    def update(self, changes):
+        """
+        Apply committed count changes.
+
+        :param changes: (tagname, delta) pairs
+        """
+        with self._lock:
+            for tag, delta in changes:
+                old = self._counts.get(tag, 0)
+                new = old + delta
+                if new > 0:
+                    self._counts[tag] = new
+                    if old <= 0:
+                        bisect.insort(self._names, tag)
+                elif old > 0:
+                    del self._counts[tag]
+                    del self._names[bisect.bisect_left(self._names, tag)]
+                for end in range(len(tag) + 1):
+                    self._memo.pop(tag[:end], None)
+
+    def __len__(self):
+        return len(self._names)
+
+
+_lock = threading.Lock()
+_index = None
+_expiry = 0
+# bumped by every change, so an index loaded before a change is not installed
+_version = 0
+_stats = {'hits': 0, 'loads': 0, 'updates': 0, 'clears': 0}
+_local = threading.local()
+
+
+def version():
+    """
+    Get the version of the index, to be passed to install()
+    """
+    with _lock:
+        return _version
+
+
+def suggest(prefix, count):
+    """
+    Get the most used tags starting with prefix from the loaded index.
+
+    :return: A list of (tagname, count), or None if the index has to be
+             loaded first
+    """
+    with _lock:
+        index = _index
+        if index is None or _expiry < time.time():
+            return None
+        _stats['hits'] += 1
+    return index.suggest(prefix, count)
+
+
+def install(loaded_version, rows):
+    """
+    Build an index from the rows of tag_counts and serve it, unless it
+    changed since loaded_version was read.
+
+    :return: The built TagIndex, to answer the call that loaded it
+    """
+    global _index, _expiry
+    index = TagIndex(rows)
+    with _lock:
+        _stats['loads'] += 1
+        if _version == loaded_version:
+            _index = index
+            _expiry = time.time() + TAG_INDEX_TTL
+    return index
+
+
+@contextmanager
+def deferred():
+    """
+    Context manager that holds back the updates made inside it, in this
+    thread, like results.deferred(). It yields the list of held back
+    changes, to be passed to update() once the transaction is committed.
+    """
+    outer = getattr(_local, 'deferred', None)
+    held = []
+    _local.deferred = held
+    try:
+        yield held
+    finally:
+        _local.deferred = outer
+
+
+def update(changes):
+    """
+    Apply the tag count changes of a committed transaction.
+
+    :param changes: (tagname, delta) pairs
+    """
+    global _version
+    held = getattr(_local, 'deferred', None)
+    if held is not None:
+        held.extend(changes)
+        return
+    with _lock:
+        _version += 1
+        _stats['updates'] += 1
+        index = _index
+    if index is not None:
+        index.update(changes)
+
+
+def clear():
+    """
+    Drop the index, to be reloaded by the next suggest_tags
+    """
+    global _index, _version
+    with _lock:
+        _version += 1
+        _stats['clears'] += 1
+        _index = None
+
+
+def stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['tags'] = len(_index) if _index is not None else 0
+    return stats
@@ -0,0 +1,11 @@
+"""
+Unit tests of the modules that do not need a database: the caches, the tag
+index, cursors, the write-behind queue, the async wrapper, the router and
+the in-memory engine. Database access is replaced by small fakes. psycopg2
+and pytz still have to be importable. Run them from the directory containing
+the paper package:
+
+    python -m unittest discover -s paper/tests -t .
+
+The APIs against Postgres are covered by customize_checker.py.
+"""
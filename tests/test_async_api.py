@@ -0,0 +1,89 @@
+import unittest
+
+import paper.async_api as async_api
+import paper.functions as functions
+import paper.instrument as instrument
+import paper.results as results
+import paper.statements as statements
+
+
+class FakeCursor(object):
+    """
+    Answers every query with the tag counts of its connection
+    """
+
+    def __init__(self, conn):
+        self.connection = conn
+
+    def execute(self, sql, data=()):
+        self.connection.queries.append((sql, data))
+
+    def fetchall(self):
+        return list(self.connection.rows[:self.connection.queries[-1][1][0]])
+
+
+class FakeConnection(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+
+class FakePool(object):
+    """
+    Hands out one connection, like a pool.ConnectionPool of maxconn 1
+    """
+
+    maxconn = 1
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def getconn(self):
+        return self.conn
+
+    def putconn(self, conn):
+        pass
+
+
+class AsyncAPITest(unittest.TestCase):
+
+    def setUp(self):
+        statements.set_prepared(False)
+        results.clear()
+        self.conn = FakeConnection([('a', 3), ('b', 2), ('c', 1)])
+        self.api = async_api.AsyncAPI(FakePool(self.conn), workers=1)
+
+    def tearDown(self):
+        self.api.close()
+        instrument.disable()
+        statements.set_prepared(True)
+        results.clear()
+
+    def check_matches_direct_call(self):
+        with results.bypass():
+            expected = functions.get_most_popular_tags(self.conn, 2)
+        self.assertEqual(expected, (0, [('a', 3), ('b', 2)]))
+        # positional and keyword arguments are bound like the API binds them
+        self.assertEqual(self.api.get_most_popular_tags(2).get(5), expected)
+        self.assertEqual(self.api.get_most_popular_tags(count=2).get(5), expected)
+        self.assertEqual(self.api.get_most_popular_tags().get(5), (0, [('a', 3)]))
+
+    def test_cached_api(self):
+        self.check_matches_direct_call()
+
+    def test_instrumented_cached_api(self):
+        instrument.enable()
+        self.check_matches_direct_call()
+
+    def test_unknown_argument(self):
+        self.assertRaises(TypeError, self.api.get_most_popular_tags, limit=2)
+
+    def test_unknown_api(self):
+        self.assertRaises(AttributeError, getattr, self.api, 'no_such_api')
@@ -0,0 +1,52 @@
+import base64
+import json
+import unittest
+
+from datetime import datetime
+
+import paper.keyset as keyset
+
+
+class KeysetTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        when = datetime(2016, 3, 1, 12, 30, 5, 123456)
+        self.assertEqual(keyset.decode(keyset.encode(when, 42)), (when, 42))
+
+    def test_round_trip_without_microseconds(self):
+        when = datetime(2016, 3, 1)
+        self.assertEqual(keyset.decode(keyset.encode(when, 1)), (when, 1))
+
+    def test_cursor_is_url_safe(self):
+        cursor = keyset.encode(datetime(2016, 3, 1, 23, 59, 59, 999999), 10 ** 9)
+        self.assertTrue(all(c.isalnum() or c in '-_=' for c in cursor))
+
+    def test_unicode_cursor(self):
+        cursor = keyset.encode(datetime(2016, 3, 1), 7)
+        self.assertEqual(keyset.decode(unicode(cursor)), (datetime(2016, 3, 1), 7))
+
+    def test_malformed_cursors(self):
+        bad = [
+            'not a cursor',
+            base64.urlsafe_b64encode('not json'),
+            base64.urlsafe_b64encode(json.dumps(['2016-03-01 00:00:00.000000'])),
+            base64.urlsafe_b64encode(json.dumps(['yesterday', 1])),
+            base64.urlsafe_b64encode(json.dumps(['2016-03-01 00:00:00.000000', 'x'])),
+            None,
+        ]
+        for cursor in bad:
+            self.assertRaises(ValueError, keyset.decode, cursor)
+
+    def test_next_cursor(self):
+        when = datetime(2016, 3, 1)
+        rows = [(2, 'u', 't', when, 'd'), (1, 'u', 't', when, 'd')]
+        self.assertEqual(keyset.decode(keyset.next_cursor(rows, 2)), (when, 1))
+        # a short page is the last one
+        self.assertIsNone(keyset.next_cursor(rows, 3))
+        self.assertIsNone(keyset.next_cursor([], 0))
+
+    def test_next_cursor_key(self):
+        when = datetime(2016, 3, 1)
+        rows = [(5, when)]
+        cursor = keyset.next_cursor(rows, 1, key=lambda row: (row[1], row[0]))
+        self.assertEqual(keyset.decode(cursor), (when, 5))
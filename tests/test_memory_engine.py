@@ -0,0 +1,117 @@
+import unittest
+
+from datetime import datetime
+
+import paper.memory_engine as memory
+
+
+T0 = datetime(2016, 3, 1, 12, 0)
+T1 = datetime(2016, 3, 1, 13, 0)
+
+
+class MemoryEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = memory.MemoryDatabase()
+        for uname in ('a', 'b', 'c'):
+            self.assertEqual(memory.signup(self.db, uname, uname), (0, None))
+
+    def add(self, pid, uname, begin_time, tags=()):
+        """
+        Add a paper with a chosen begin_time, to order ties
+        """
+        self.db.add_paper(memory.Paper(pid, uname, 't%d' % pid, begin_time, 'd', 'text',
+                                       tuple(tags)))
+        self.db.next_pid = max(self.db.next_pid, pid + 1)
+
+    def pids(self, res):
+        return [paper[0] for paper in res]
+
+    def test_signup_and_login(self):
+        self.assertEqual(memory.signup(self.db, 'a', 'x'), (1, None))
+        self.assertEqual(memory.signup(self.db, 'x' * 51, 'x'), (2, None))
+        self.assertEqual(memory.login(self.db, 'a', 'a'), (0, None))
+        self.assertEqual(memory.login(self.db, 'a', 'b'), (2, None))
+        self.assertEqual(memory.login(self.db, 'x', 'x'), (1, None))
+
+    def test_add_new_paper_rules(self):
+        status, pid = memory.add_new_paper(self.db, 'a', 'title', 'desc', 'text', ['t1'])
+        self.assertEqual((status, pid), (0, 1))
+        # unknown user, repeated tag and bad tag use up a pid each
+        self.assertEqual(memory.add_new_paper(self.db, 'x', 't', 'd', None, [])[0], 1)
+        self.assertEqual(memory.add_new_paper(self.db, 'a', 't', 'd', None, ['t', 't'])[0], 1)
+        self.assertEqual(memory.add_new_paper(self.db, 'a', 't', 'd', None, ['a b'])[0], 1)
+        self.assertEqual(memory.add_new_paper(self.db, 'a', 't', 'd', None, []), (0, 5))
+        self.assertEqual(memory.get_paper_tags(self.db, 1), (0, ['t1']))
+
+    def test_timeline_newest_first_then_pid(self):
+        self.add(1, 'a', T0)
+        self.add(2, 'b', T1)
+        self.add(3, 'a', T1)
+        self.assertEqual(self.pids(memory.get_timeline_all(self.db, 10)[1]), [2, 3, 1])
+        self.assertEqual(self.pids(memory.get_timeline(self.db, 'a', 10)[1]), [3, 1])
+
+    def test_pages_follow_each_other(self):
+        for pid in range(1, 6):
+            self.add(pid, 'a', T0 if pid % 2 else T1)
+        status, (page, cursor) = memory.get_timeline_all_page(self.db, 2)
+        seen = self.pids(page)
+        while cursor is not None:
+            status, (page, cursor) = memory.get_timeline_all_page(self.db, 2, cursor)
+            seen.extend(self.pids(page))
+        self.assertEqual(seen, self.pids(memory.get_timeline_all(self.db, 10)[1]))
+        self.assertEqual(seen, [2, 4, 1, 3, 5])
+        self.assertEqual(memory.get_timeline_all_page(self.db, 2, 'bad'), (1, None))
+
+    def test_like_rules(self):
+        self.add(1, 'a', T0)
+        self.assertEqual(memory.like_paper(self.db, 'a', 1), (1, None))
+        self.assertEqual(memory.like_paper(self.db, 'b', 1), (0, None))
+        self.assertEqual(memory.like_paper(self.db, 'b', 1), (1, None))
+        self.assertEqual(memory.like_paper(self.db, 'b', 2), (1, None))
+        self.assertEqual(memory.get_likes(self.db, 1), (0, 1))
+        self.assertEqual(memory.unlike_paper(self.db, 'c', 1), (1, None))
+        self.assertEqual(memory.unlike_paper(self.db, 'b', 1), (0, None))
+        self.assertEqual(memory.get_likes(self.db, 1), (0, 0))
+        self.assertEqual(memory.like_papers_bulk(self.db, [('c', 1), ('c', 1), ('a', 1)]),
+                         (0, [0, 1, 1]))
+
+    def test_delete_paper_takes_its_tags_and_likes(self):
+        self.add(1, 'a', T0, ['x', 'y'])
+        memory.like_paper(self.db, 'b', 1)
+        self.assertEqual(memory.delete_papers(self.db, [1, 1]), (0, [0, 1]))
+        self.assertEqual(memory.get_most_popular_tags(self.db, 10), (0, []))
+        self.assertEqual(memory.get_most_popular_tag_pairs(self.db, 10), (0, []))
+        self.assertEqual(memory.get_number_liked_user(self.db, 'b'), (0, 0))
+        self.assertEqual(memory.unlike_paper(self.db, 'b', 1), (1, None))
+
+    def test_tag_ties_in_byte_order(self):
+        self.add(1, 'a', T0, ['b', 'B', 'a'])
+        self.add(2, 'a', T0, ['b'])
+        self.assertEqual(memory.get_most_popular_tags(self.db, 10),
+                         (0, [('b', 2), ('B', 1), ('a', 1)]))
+        self.assertEqual(memory.suggest_tags(self.db, 'b', 10), (0, [('b', 2)]))
+        self.assertEqual(memory.get_most_popular_tag_pairs(self.db, 1), (0, [('B', 'a', 1)]))
+
+    def test_recommendations(self):
+        self.add(1, 'a', T0)
+        self.add(2, 'b', T0)
+        self.add(3, 'c', T0)
+        self.add(4, 'a', T0)
+        # b shares paper 1 with c, who also likes 2 (b's own) and 4
+        for uname, pid in [('b', 1), ('c', 1), ('c', 2), ('c', 4)]:
+            self.assertEqual(memory.like_paper(self.db, uname, pid), (0, None))
+        self.assertEqual(self.pids(memory.get_recommend_papers(self.db, 'b')[1]), [4])
+        self.assertEqual(memory.get_recommend_papers(self.db, 'a'), (0, []))
+
+    def test_keyword_search(self):
+        status, pid = memory.add_new_paper(self.db, 'a', 'Hello world', 'd', 'x', [])
+        memory.add_new_paper(self.db, 'a', 'other', 'd', 'hello there', [])
+        self.assertEqual(len(memory.get_papers_by_keyword(self.db, 'HELLO')[1]), 2)
+        self.assertEqual(self.pids(memory.get_papers_by_keyword(self.db, 'hello -there')[1]),
+                         [pid])
+        self.assertEqual(self.pids(memory.get_papers_by_keyword(self.db, '"hello world"')[1]),
+                         [pid])
+
+    def test_call_db_by_name(self):
+        self.assertEqual(memory.call_db('login', {'uname': 'a', 'pwd': 'a'}, self.db), (0, None))
@@ -0,0 +1,99 @@
+import time
+import unittest
+
+import paper.recommend as recommend
+
+
+class FakeCursor(object):
+    """
+    Answers the co_likes query of cohort() with fixed rows
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def execute(self, sql, data=()):
+        self.queries.append((sql, data))
+
+    def fetchall(self):
+        return [(other,) for other in self.rows]
+
+
+class RecommendCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = recommend.RecommendCache(maxusers=2, ttl=60)
+
+    def test_store_and_lookup(self):
+        self.cache.store('a', self.cache.version('a'), ['p1', 'p2'], False)
+        self.assertEqual(self.cache.lookup('a', 2), ['p1', 'p2'])
+        self.assertEqual(self.cache.lookup('a', 1), ['p1'])
+        # more than was computed, and there may be more
+        self.assertIsNone(self.cache.lookup('a', 3))
+
+    def test_complete_entry_answers_any_count(self):
+        self.cache.store('a', self.cache.version('a'), ['p1'], True)
+        self.assertEqual(self.cache.lookup('a', 10), ['p1'])
+
+    def test_store_after_invalidate_is_dropped(self):
+        version = self.cache.version('a')
+        self.cache.invalidate(['a'])
+        self.cache.store('a', version, ['stale'], True)
+        self.assertIsNone(self.cache.lookup('a', 1))
+
+    def test_store_after_clear_is_dropped(self):
+        version = self.cache.version('a')
+        self.cache.clear()
+        self.cache.store('a', version, ['stale'], True)
+        self.assertIsNone(self.cache.lookup('a', 1))
+
+    def test_least_recently_used_is_evicted(self):
+        for uname in ('a', 'b'):
+            self.cache.store(uname, self.cache.version(uname), [uname], True)
+        self.cache.lookup('a', 1)
+        self.cache.store('c', self.cache.version('c'), ['c'], True)
+        self.assertIsNone(self.cache.lookup('b', 1))
+        self.assertEqual(self.cache.lookup('a', 1), ['a'])
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_expired_entry_is_not_served(self):
+        cache = recommend.RecommendCache(ttl=-1)
+        cache.store('a', cache.version('a'), ['p1'], True)
+        self.assertIsNone(cache.lookup('a', 1))
+
+
+class CohortTest(unittest.TestCase):
+
+    def setUp(self):
+        recommend.clear()
+
+    def tearDown(self):
+        recommend.clear()
+
+    def test_cohort_is_read_when_nothing_is_cached(self):
+        self.assertEqual(len(recommend._cache), 0)
+        cur = FakeCursor(['b', 'c'])
+        self.assertEqual(recommend.cohort(cur, 'a'), ['a', 'b', 'c'])
+        self.assertEqual(len(cur.queries), 1)
+
+    def test_concurrent_computation_is_not_stored(self):
+        # a reader takes the version of b, a like of a commits meanwhile
+        version = recommend.version('b')
+        recommend.invalidate(recommend.cohort(FakeCursor(['b']), 'a'))
+        recommend.store('b', version, ['before the like'], True)
+        self.assertIsNone(recommend.lookup('b', 1))
+
+    def test_deferred_invalidations_are_held(self):
+        with recommend.deferred() as held:
+            recommend.invalidate(['a'])
+        self.assertEqual(held, ['a'])
+
+    def test_unshared_does_not_store(self):
+        with recommend.unshared():
+            recommend.store('a', recommend.version('a'), ['p1'], True)
+        self.assertIsNone(recommend.lookup('a', 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
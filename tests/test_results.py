@@ -0,0 +1,111 @@
+import unittest
+
+import paper.results as results
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = results.ResultCache(ttl=60, maxsize=2, maxscopes=3)
+
+    def test_store_and_lookup(self):
+        key = self.cache.key('api', (), [('papers',)])
+        self.assertIsNone(self.cache.lookup(key))
+        self.cache.store(key, [1])
+        self.assertEqual(self.cache.lookup(key), [1])
+
+    def test_invalidated_scope_changes_the_key(self):
+        key = self.cache.key('api', (), [('user', 'a')])
+        self.cache.store(key, [1])
+        self.cache.invalidate([('user', 'a')])
+        self.assertIsNone(self.cache.lookup(self.cache.key('api', (), [('user', 'a')])))
+        # other scopes are untouched
+        other = self.cache.key('api', (), [('user', 'b')])
+        self.cache.store(other, [2])
+        self.cache.invalidate([('user', 'a')])
+        self.assertEqual(self.cache.lookup(self.cache.key('api', (), [('user', 'b')])), [2])
+
+    def test_result_computed_before_invalidation_is_unreachable(self):
+        key = self.cache.key('api', (), [('papers',)])
+        self.cache.invalidate([('papers',)])
+        self.cache.store(key, ['stale'])
+        self.assertIsNone(self.cache.lookup(self.cache.key('api', (), [('papers',)])))
+
+    def test_least_recently_used_is_evicted(self):
+        keys = [self.cache.key('api', (i,), []) for i in range(3)]
+        self.cache.store(keys[0], 0)
+        self.cache.store(keys[1], 1)
+        self.cache.lookup(keys[0])
+        self.cache.store(keys[2], 2)
+        self.assertIsNone(self.cache.lookup(keys[1]))
+        self.assertEqual(self.cache.lookup(keys[0]), 0)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_expired_result_is_not_served(self):
+        cache = results.ResultCache(ttl=-1)
+        key = cache.key('api', (), [])
+        cache.store(key, 1)
+        self.assertIsNone(cache.lookup(key))
+        self.assertEqual(cache.stats()['expired'], 1)
+
+    def test_too_many_scopes_drop_everything(self):
+        key = self.cache.key('api', (), [])
+        self.cache.store(key, 1)
+        self.cache.invalidate([('tag', str(i)) for i in range(4)])
+        self.assertIsNone(self.cache.lookup(self.cache.key('api', (), [])))
+
+
+class CachedTest(unittest.TestCase):
+
+    def setUp(self):
+        results.clear()
+        self.calls = []
+
+        @results.cached(lambda args: [('user', args['uname'])])
+        def get_thing(conn, uname, count=10):
+            self.calls.append((uname, count))
+            return 0, [uname] * count
+        self.get_thing = get_thing
+
+    def tearDown(self):
+        results.clear()
+
+    def test_second_call_is_served_from_the_cache(self):
+        self.assertEqual(self.get_thing(None, 'a', 2), (0, ['a', 'a']))
+        self.assertEqual(self.get_thing(None, uname='a', count=2), (0, ['a', 'a']))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_invalidate_runs_the_query_again(self):
+        self.get_thing(None, 'a')
+        results.invalidate([('user', 'a')])
+        self.get_thing(None, 'a')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_cached_result_can_not_be_changed_by_the_caller(self):
+        status, res = self.get_thing(None, 'a', 1)
+        res.append('changed')
+        self.assertEqual(self.get_thing(None, 'a', 1), (0, ['a']))
+
+    def test_bypass_runs_the_query(self):
+        self.get_thing(None, 'a')
+        with results.bypass():
+            self.get_thing(None, 'a')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_deferred_invalidations_are_held(self):
+        self.get_thing(None, 'a')
+        with results.deferred() as held:
+            results.invalidate([('user', 'a')])
+        self.assertEqual(held, [('user', 'a')])
+        self.get_thing(None, 'a')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_unshared_results_are_not_stored(self):
+        with results.unshared():
+            self.get_thing(None, 'a')
+        self.get_thing(None, 'a')
+        self.assertEqual(len(self.calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+
+import psycopg2 as psy
+import psycopg2.extensions as psy_ext
+
+import paper.router as router
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, data=()):
+        pass
+
+    def fetchone(self):
+        return (self.conn.lsn,)
+
+
+class FakeConnection(object):
+    """
+    A connection to a server named name, whose WAL position is lsn
+    """
+
+    def __init__(self, name, lsn='0/10'):
+        self.name = name
+        self.lsn = lsn
+        self.status = psy_ext.TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.status = psy_ext.TRANSACTION_STATUS_IDLE
+
+
+class FakePool(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def getconn(self):
+        return self.conn
+
+    def putconn(self, conn):
+        pass
+
+
+def get_timeline(conn, fail_on=()):
+    """
+    Answers with the name of the server, or fails with a database error on
+    the ones in fail_on, leaving the transaction aborted like the APIs do
+    """
+    if conn.name in fail_on:
+        conn.status = psy_ext.TRANSACTION_STATUS_INERROR
+        return 1, None
+    return 0, conn.name
+
+
+def login(conn, uname, pwd):
+    # a wrong password, the query itself went through
+    return 2, None
+
+
+def get_number_papers_user(conn):
+    raise psy.OperationalError("the standby is restarting")
+
+
+def like_paper(conn):
+    return 0, None
+
+
+class RouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.primary = FakeConnection('primary', '0/20')
+        self.replica = FakeConnection('replica', '0/10')
+        self.router = router.Router(FakePool(self.primary), FakePool(self.replica),
+                                    max_wait=0, poll_interval=0)
+
+    def test_parse_lsn(self):
+        self.assertEqual(router.parse_lsn('0/10'), 16)
+        self.assertEqual(router.parse_lsn('1/0'), 1 << 32)
+
+    def test_read_goes_to_the_replica(self):
+        self.assertEqual(self.router.call(get_timeline, {}), (0, 'replica'))
+        self.assertEqual(self.router.stats()['replica_reads'], 1)
+
+    def test_failed_replica_read_runs_on_the_primary(self):
+        self.assertEqual(self.router.call(get_timeline, {'fail_on': ['replica']}),
+                         (0, 'primary'))
+        stats = self.router.stats()
+        self.assertEqual((stats['replica_errors'], stats['primary_reads']), (1, 1))
+
+    def test_failure_of_the_arguments_stays_on_the_replica(self):
+        self.assertEqual(self.router.call(login, {'uname': 'a', 'pwd': 'b'}), (2, None))
+        stats = self.router.stats()
+        self.assertEqual((stats['replica_reads'], stats['replica_errors'],
+                          stats['primary_reads']), (1, 0, 0))
+
+    def test_failure_on_both_is_returned(self):
+        self.assertEqual(self.router.call(get_timeline,
+                                          {'fail_on': ['replica', 'primary']}), (1, None))
+
+    def test_lost_replica_runs_on_the_primary(self):
+        self.router.replica = None
+        self.assertEqual(self.router.call(get_timeline, {}), (0, 'primary'))
+
+    def test_operational_error_counts_as_replica_error(self):
+        self.router.call(get_number_papers_user, {})
+        stats = self.router.stats()
+        self.assertEqual((stats['replica_errors'], stats['primary_reads']), (1, 1))
+
+    def test_session_reads_its_writes(self):
+        session = router.Session()
+        self.router.call(like_paper, {}, session)
+        self.assertEqual(session.lsn, 0x20)
+        # the replica has not replayed the write
+        self.assertEqual(self.router.call(get_timeline, {}, session), (0, 'primary'))
+        self.assertEqual(self.router.stats()['lagging'], 1)
+        self.replica.lsn = '0/20'
+        self.assertEqual(self.router.call(get_timeline, {}, session), (0, 'replica'))
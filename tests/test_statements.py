@@ -0,0 +1,117 @@
+import unittest
+
+import psycopg2 as psy
+import psycopg2.extensions as psy_ext
+
+import paper.statements as statements
+
+
+def server_error(pgcode):
+    return type('ServerError', (psy.DatabaseError,), {'pgcode': pgcode})()
+
+
+class FakeServer(object):
+    """
+    A session's prepared statements, with EXECUTEs that fail once with stale
+    """
+
+    def __init__(self):
+        self.prepared = set()
+        self.stale = set()
+        self.in_transaction = False
+
+    def execute(self, sql):
+        words = sql.split()
+        if words[0] == 'PREPARE':
+            if words[1] in self.prepared:
+                raise server_error('42P05')
+            self.prepared.add(words[1])
+        elif words[0] == 'EXECUTE':
+            name = words[1].split('(')[0]
+            if name not in self.prepared:
+                raise server_error('26000')
+            if name in self.stale:
+                self.stale.discard(name)
+                raise server_error('0A000')
+        elif sql == 'DEALLOCATE ALL':
+            self.prepared.clear()
+        self.in_transaction = True
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.connection = conn
+
+    def execute(self, sql, data=()):
+        self.connection.server.execute(sql)
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.server = FakeServer()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        if self.server.in_transaction:
+            return psy_ext.TRANSACTION_STATUS_INTRANS
+        return psy_ext.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.server.in_transaction = False
+
+
+class ExecuteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeConnection()
+        self.cur = self.conn.cursor()
+
+    def run_query(self):
+        statements.execute(self.cur, 'test_stale', "SELECT %s;", (1,))
+
+    def test_prepared_once(self):
+        prepares = statements.stats()['prepares']
+        self.run_query()
+        self.run_query()
+        self.assertEqual(statements.stats()['prepares'], prepares + 1)
+
+    def test_stale_plan_is_retried_in_a_fresh_transaction(self):
+        self.run_query()
+        self.conn.rollback()
+        self.conn.server.stale.add('test_stale')
+        self.run_query()
+        self.assertEqual(self.conn.server.prepared, set(['test_stale']))
+        self.conn.rollback()
+        self.run_query()
+
+    def test_stale_plan_is_prepared_again_after_rollback(self):
+        self.run_query()
+        self.conn.server.stale.add('test_stale')
+        # something else ran in this transaction, so the caller has to retry
+        try:
+            self.run_query()
+            self.fail("0A000 was not raised")
+        except psy.DatabaseError, e:
+            self.assertEqual(e.pgcode, '0A000')
+        self.conn.rollback()
+        self.run_query()
+        self.run_query()
+
+    def test_missing_statement_is_prepared_again(self):
+        self.run_query()
+        self.conn.rollback()
+        self.conn.server.prepared.clear()
+        self.run_query()
+        self.assertEqual(self.conn.server.prepared, set(['test_stale']))
+
+    def test_adhoc(self):
+        statements.set_prepared(False)
+        try:
+            self.run_query()
+        finally:
+            statements.set_prepared(True)
+        self.assertEqual(self.conn.server.prepared, set())
@@ -0,0 +1,81 @@
+import unittest
+
+import paper.tag_index as tag_index
+
+
+class TagIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = tag_index.TagIndex([('ab', 2), ('abc', 5), ('abd', 2), ('b', 9),
+                                         ('aB', 2), ('gone', 0)], depth=3)
+
+    def test_unused_tags_are_left_out(self):
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.index.suggest('g', 10), [])
+
+    def test_ranked_by_count_then_byte_order(self):
+        # 'B' sorts before 'b', as with COLLATE "C"
+        self.assertEqual(self.index.suggest('a', 10),
+                         [('abc', 5), ('aB', 2), ('ab', 2), ('abd', 2)])
+        self.assertEqual(self.index.suggest('ab', 2), [('abc', 5), ('ab', 2)])
+        self.assertEqual(self.index.suggest('', 1), [('b', 9)])
+        self.assertEqual(self.index.suggest('a', 0), [])
+
+    def test_counts_beyond_the_depth(self):
+        self.assertEqual(len(self.index.suggest('', 4)), 4)
+        self.assertEqual(self.index.suggest('a', 2), [('abc', 5), ('aB', 2)])
+
+    def test_update_drops_memoized_prefixes(self):
+        self.assertEqual(self.index.suggest('a', 1), [('abc', 5)])
+        self.index.update([('abd', 4), ('abc', -5), ('new', 1)])
+        self.assertEqual(self.index.suggest('a', 2), [('abd', 6), ('aB', 2)])
+        self.assertEqual(self.index.suggest('n', 2), [('new', 1)])
+        self.assertEqual(len(self.index), 5)
+
+    def test_memo_is_bounded(self):
+        index = tag_index.TagIndex([('a', 1)], maxprefixes=2)
+        for prefix in ('', 'a', 'b', 'c'):
+            index.suggest(prefix, 1)
+        self.assertTrue(len(index._memo) <= 2)
+
+
+class ModuleTest(unittest.TestCase):
+
+    def setUp(self):
+        tag_index.clear()
+
+    def tearDown(self):
+        tag_index.clear()
+
+    def test_suggest_needs_a_loaded_index(self):
+        self.assertIsNone(tag_index.suggest('a', 1))
+        index = tag_index.install(tag_index.version(), [('a', 1)])
+        self.assertEqual(index.suggest('a', 1), [('a', 1)])
+        self.assertEqual(tag_index.suggest('a', 1), [('a', 1)])
+
+    def test_index_loaded_before_a_change_is_not_installed(self):
+        version = tag_index.version()
+        tag_index.update([('a', 1)])
+        tag_index.install(version, [('b', 1)])
+        self.assertIsNone(tag_index.suggest('b', 1))
+
+    def test_updates_apply_to_the_loaded_index(self):
+        tag_index.install(tag_index.version(), [('a', 1)])
+        tag_index.update([('a', 1), ('ab', 1)])
+        self.assertEqual(tag_index.suggest('a', 2), [('a', 2), ('ab', 1)])
+
+    def test_deferred_holds_back_updates(self):
+        tag_index.install(tag_index.version(), [('a', 1)])
+        with tag_index.deferred() as held:
+            tag_index.update([('a', 1)])
+        self.assertEqual(held, [('a', 1)])
+        self.assertEqual(tag_index.suggest('a', 1), [('a', 1)])
+
+    def test_expired_index_is_reloaded(self):
+        ttl = tag_index.TAG_INDEX_TTL
+        tag_index.TAG_INDEX_TTL = -1
+        try:
+            tag_index.install(tag_index.version(), [('a', 1)])
+        finally:
+            tag_index.TAG_INDEX_TTL = ttl
+        self.assertIsNone(tag_index.suggest('a', 1))
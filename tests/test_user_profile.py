@@ -0,0 +1,115 @@
+import unittest
+
+from datetime import datetime
+
+import paper.functions as functions
+import paper.memory_engine as memory
+import paper.results as results
+import paper.statements as statements
+
+
+T0 = datetime(2016, 3, 1, 12, 0)
+T1 = datetime(2016, 3, 1, 13, 0)
+
+
+class FakeCursor(object):
+    """
+    Answers the query of get_user_profile with fixed rows
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, sql, data=()):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self):
+        return FakeCursor(self.rows)
+
+
+class ProfileRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        statements.set_prepared(False)
+
+    def tearDown(self):
+        statements.set_prepared(True)
+
+    def test_rows_are_split_by_part(self):
+        rows = [
+            (0, None, None, None, None, None, None, 2, 1, 3),
+            (1, 2, 'a', 'p2', T1, 'd', T1, None, None, None),
+            (1, 1, 'a', 'p1', T0, 'd', T0, None, None, None),
+            (2, 5, 'b', 'p5', T0, 'd', T1, None, None, None),
+        ]
+        status, profile = functions.get_user_profile.__wrapped__(FakeConnection(rows), 'a')
+        self.assertEqual(status, 0)
+        self.assertEqual(profile, {
+            'number_papers': 2,
+            'number_liked': 1,
+            'number_tags': 3,
+            'timeline': [(2, 'a', 'p2', T1, 'd'), (1, 'a', 'p1', T0, 'd')],
+            'papers_by_liked': [(5, 'b', 'p5', T0, 'd')],
+        })
+
+
+class CachedProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        statements.set_prepared(False)
+        results.clear()
+
+    def tearDown(self):
+        statements.set_prepared(True)
+        results.clear()
+
+    def test_returned_profile_can_be_changed(self):
+        rows = [
+            (0, None, None, None, None, None, None, 1, 1, 1),
+            (1, 1, 'a', 'p1', T0, 'd', T0, None, None, None),
+        ]
+        status, profile = functions.get_user_profile(FakeConnection(rows), 'a')
+        expected = dict(profile, timeline=list(profile['timeline']))
+        profile['timeline'].append((9, 'a', 'p9', T1, 'd'))
+        del profile['number_papers']
+        # served from the cache, the connection has nothing to answer with
+        status, again = functions.get_user_profile(FakeConnection([]), 'a')
+        self.assertEqual((status, again), (0, expected))
+
+
+class MemoryProfileTest(unittest.TestCase):
+
+    def test_matches_the_single_apis(self):
+        db = memory.MemoryDatabase()
+        for uname in ('a', 'b'):
+            memory.signup(db, uname, uname)
+        for i in range(3):
+            memory.add_new_paper(db, 'a', 'a%d' % i, 'd', None, ['x', 't%d' % i])
+            memory.add_new_paper(db, 'b', 'b%d' % i, 'd', None, ['x'])
+        for pid in (2, 4, 6):
+            memory.like_paper(db, 'a', pid)
+        status, profile = memory.get_user_profile(db, 'a', 2)
+        self.assertEqual(status, 0)
+        self.assertEqual(profile, {
+            'number_papers': memory.get_number_papers_user(db, 'a')[1],
+            'number_liked': memory.get_number_liked_user(db, 'a')[1],
+            'number_tags': memory.get_number_tags_user(db, 'a')[1],
+            'timeline': memory.get_timeline(db, 'a', 2)[1],
+            'papers_by_liked': memory.get_papers_by_liked(db, 'a', 2)[1],
+        })
+        self.assertEqual((profile['number_papers'], profile['number_tags']), (3, 4))
+        self.assertEqual(len(profile['timeline']), 2)
+
+    def test_unknown_user(self):
+        status, profile = memory.get_user_profile(memory.MemoryDatabase(), 'x')
+        self.assertEqual(profile['number_papers'], 0)
+        self.assertEqual(profile['timeline'], [])
@@ -0,0 +1,151 @@
+import unittest
+
+import psycopg2 as psy
+
+import paper.recommend as recommend
+import paper.results as results
+import paper.tag_index as tag_index
+import paper.write_behind as write_behind
+
+from paper.constants import *
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, data=()):
+        self.conn.log.append(sql.split()[0])
+
+
+class FakeConnection(object):
+    """
+    Logs the first word of every statement, and of commits and rollbacks
+    """
+
+    def __init__(self):
+        self.log = []
+        self.closed = 0
+        # raised by the next commits, in order
+        self.commit_errors = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        if self.commit_errors:
+            raise self.commit_errors.pop(0)
+        self.log.append('COMMIT')
+
+    def rollback(self):
+        self.log.append('ROLLBACK')
+
+
+class FakePool(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def getconn(self):
+        return self.conn
+
+    def putconn(self, conn):
+        pass
+
+
+def like_paper(conn, uname, pid):
+    """
+    Succeeds for pids above 0, invalidating like the real API
+    """
+    conn.cursor().execute("INSERT INTO likes")
+    if pid <= 0:
+        return 1, None
+    conn.commit()
+    results.invalidate([('liked', uname)])
+    recommend.invalidate([uname])
+    return 0, pid
+
+
+@results.cached(lambda args: [('liked', args['uname'])])
+def get_papers_by_liked(conn, uname):
+    return 0, [uname]
+
+
+class WriteBehindTest(unittest.TestCase):
+
+    def setUp(self):
+        results.clear()
+        recommend.clear()
+        self.conn = FakeConnection()
+        # one batch per test: the flusher waits for all of them
+        self.writer = write_behind.WriteBehind(FakePool(self.conn), batch_size=3,
+                                               flush_interval=1.0)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def submit(self, *pids):
+        return [self.writer.submit(like_paper, {'uname': 'u%d' % i, 'pid': pid})
+                for i, pid in enumerate(pids)]
+
+    def get(self, handles):
+        return [handle.get(5) for handle in handles]
+
+    def test_batch_is_one_transaction(self):
+        self.assertEqual(self.get(self.submit(1, 2, 3)), [(0, 1), (0, 2), (0, 3)])
+        self.assertEqual(self.conn.log.count('COMMIT'), 1)
+        self.assertEqual(self.conn.log.count('SAVEPOINT'), 3)
+        stats = self.writer.stats()
+        self.assertEqual((stats['batches'], stats['calls']), (1, 3))
+
+    def test_failed_call_rolls_back_its_savepoint_only(self):
+        self.assertEqual(self.get(self.submit(1, 0, 3)), [(0, 1), (1, None), (0, 3)])
+        self.assertEqual(self.conn.log.count('ROLLBACK'), 1)
+        self.assertEqual(self.conn.log.count('COMMIT'), 1)
+
+    def test_invalidations_wait_for_the_commit(self):
+        self.assertEqual(get_papers_by_liked(None, 'u0'), (0, ['u0']))
+        hits = results.stats()['hits']
+        self.get(self.submit(1, 2, 3))
+        get_papers_by_liked(None, 'u0')
+        self.assertEqual(results.stats()['hits'], hits)
+
+    def test_failed_commit_runs_calls_alone(self):
+        self.conn.commit_errors.append(psy.DatabaseError())
+        self.assertEqual(self.get(self.submit(1, 2, 3)), [(0, 1), (0, 2), (0, 3)])
+        self.assertEqual(self.conn.log.count('COMMIT'), 3)
+        self.assertEqual(self.writer.stats()['failed_batches'], 1)
+
+    def check_unknown_commit(self):
+        # nothing cached before the batch can be served after it
+        self.assertIsNone(recommend.lookup('a', 1))
+        get_papers_by_liked(None, 'other')
+        self.assertEqual(results.stats()['hits'], self.hits)
+        # the flusher is still there
+        self.assertEqual(self.get(self.submit(1, 2, 3)), [(0, 1), (0, 2), (0, 3)])
+
+    def prime_caches(self):
+        recommend.store('a', recommend.version('a'), ['p'], True)
+        get_papers_by_liked(None, 'other')
+        self.hits = results.stats()['hits']
+
+    def test_lost_connection_fails_the_batch(self):
+        self.prime_caches()
+        self.conn.closed = 1
+        self.conn.commit_errors.append(psy.DatabaseError())
+        self.assertEqual(self.get(self.submit(1, 2, 3)), [(DB_ERROR, None)] * 3)
+        self.conn.closed = 0
+        self.check_unknown_commit()
+
+    def test_unexpected_error_fails_the_batch(self):
+        self.prime_caches()
+        self.conn.commit_errors.append(RuntimeError("boom"))
+        handles = self.submit(1, 2, 3)
+        for handle in handles:
+            self.assertRaises(RuntimeError, handle.get, 5)
+        self.check_unknown_commit()
+
+    def test_only_write_apis_are_queued(self):
+        self.assertRaises(ValueError, self.writer.submit, get_papers_by_liked, {'uname': 'a'})
+
@@ -0,0 +1,410 @@
+"""
+Write-behind queue with group commit for the mutating APIs.
+
+signup, add_new_paper, like_paper and unlike_paper each commit their own
+transaction, so a burst of writes waits for one fsync per call. In
+write-behind mode the calls are queued instead, and flusher threads apply
+them in batches, one transaction and one commit per batch:
+
+    import paper.write_behind as write_behind
+    writer = write_behind.configure(batch_size=200, flush_interval=0.005)
+    handle = writer.like_paper(uname="foo", pid=1)
+    status, res = handle.get()
+
+A batch is flushed once it has batch_size calls, or flush_interval seconds
+after its first call was taken from the queue. Each call runs in a savepoint
+of the batch, on a connection whose commit() releases the savepoint and
+whose rollback() rolls back to it, so a failing call leaves the rest of the
+batch alone and gets the status it would have had on its own. Handles
+resolve to the (status, res) of the API once the batch is committed, i.e.
+once the write is durable, which is also when the result and recommendation
+caches are invalidated and the tag index is updated. If the commit of a
+batch fails, its calls are run again one by one, each with its own commit.
+If whether it went through is unknown, e.g. the connection was lost, its
+calls fail and the caches are dropped.
+
+The queues are bounded: a call waits up to timeout seconds for room and then
+raises WriteBehindFull. Calls are spread over the flushers by username and a
+flusher applies its calls in queue order, so the writes of a user are
+applied in the order they were made. Writes of different users on different
+flushers are not ordered.
+"""
+
+import Queue
+import bisect
+import threading
+import time
+
+from multiprocessing import TimeoutError
+
+import psycopg2 as psy
+
+from constants import *
+
+import functions
+import pool as db_pool
+import recommend
+import results
+import tag_index
+
+
+# The APIs that can be queued, all of them take uname
+WRITE_APIS = ('signup', 'add_new_paper', 'like_paper', 'unlike_paper')
+
+# Calls applied in one transaction at most
+BATCH_SIZE = 100
+# Seconds a batch waits for more calls after its first one
+FLUSH_INTERVAL = 0.005
+# Calls waiting per flusher at most
+QUEUE_SIZE = 10000
+
+# Upper bounds of the batch size histogram
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class WriteBehindFull(Exception):
+    """
+    Raised when a call found no room in its queue within the timeout
+    """
+    pass
+
+
+class Handle(object):
+    """
+    The pending result of a queued call
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._error = None
+
+    def _set(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._event.set()
+
+    def ready(self):
+        return self._event.is_set()
+
+    def get(self, timeout=None):
+        """
+        Wait for the call to be committed.
+
+        :param timeout: Seconds to wait, None to wait forever
+        :return: The (status, res) of the API, or (DB_ERROR, None)
+        """
+        if not self._event.wait(timeout):
+            raise TimeoutError("write not committed after %s seconds" % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class _Call(object):
+
+    def __init__(self, func, argdict):
+        self.func = func
+        self.argdict = argdict
+        self.handle = Handle()
+        self.queued = time.time()
+
+
+class _Savepoint(object):
+    """
+    Connection proxy handed to a queued API: commit() and rollback() end the
+    savepoint of the call instead of the batch transaction
+    """
+
+    def __init__(self, conn):
+        self.__dict__['_conn'] = conn
+        self.__dict__['_open'] = False
+
+    def begin(self):
+        self._conn.cursor().execute("SAVEPOINT write_behind;")
+        self.__dict__['_open'] = True
+
+    def commit(self):
+        if self._open:
+            self._conn.cursor().execute("RELEASE SAVEPOINT write_behind;")
+            self.__dict__['_open'] = False
+
+    def rollback(self):
+        if self._open:
+            self._conn.cursor().execute("ROLLBACK TO SAVEPOINT write_behind; \
+                RELEASE SAVEPOINT write_behind;")
+            self.__dict__['_open'] = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+
+def _run_alone(conn, call):
+    """
+    Run a call in its own transaction, like pool.call_db does
+    """
+    try:
+        call.handle._set(call.func(conn, **call.argdict))
+    except psy.DatabaseError, e:
+        try:
+            conn.rollback()
+        except psy.Error:
+            pass
+        call.handle._set((DB_ERROR, None))
+    except Exception, e:
+        call.handle._set(error=e)
+
+
+class WriteBehind(object):
+    """
+    Queues the write APIs and applies them in batches on flusher threads.
+
+    :param pool: A pool.ConnectionPool, the one configured in pool by default
+    :param flushers: Number of flusher threads, each with a queue of its own
+    :param batch_size: Calls applied in one transaction at most
+    :param flush_interval: Seconds a batch waits for more calls
+    :param queue_size: Calls waiting per flusher at most
+    :param timeout: Seconds a call waits for room in a full queue, None to
+                    wait forever
+    """
+
+    def __init__(self, pool=None, flushers=1, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE, timeout=None):
+        if pool is None:
+            pool = db_pool.get_pool()
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._stats = {
+            'queued': 0,
+            'rejected': 0,
+            'batches': 0,
+            'calls': 0,
+            'failed_batches': 0,
+            'queue_time_total': 0.0,
+            'flush_time_total': 0.0,
+            'flush_time_max': 0.0,
+        }
+        self._sizes = [0] * (len(BATCH_BUCKETS) + 1)
+        self._queues = [Queue.Queue(queue_size) for i in range(flushers)]
+        self._threads = []
+        for queue in self._queues:
+            thread = threading.Thread(target=self._run, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, argdict):
+        """
+        Queue a call.
+
+        :param func: One of the WRITE_APIS of functions.py
+        :param argdict: A dict of keyword arguments for the API, without conn
+        :return: A Handle whose get() returns the (status, res) of the call
+                 once it is committed
+        """
+        if func.__name__ not in WRITE_APIS:
+            raise ValueError("%s can not be queued" % func.__name__)
+        call = _Call(func, argdict)
+        queue = self._queues[hash(argdict['uname']) % len(self._queues)]
+        try:
+            queue.put(call, True, self.timeout)
+        except Queue.Full:
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise WriteBehindFull("no room in the write queue after %s seconds"
+                                  % self.timeout)
+        with self._lock:
+            self._stats['queued'] += 1
+        return call.handle
+
+    def __getattr__(self, name):
+        if name not in WRITE_APIS:
+            raise AttributeError(name)
+        func = getattr(functions, name)
+
+        def call(**kwargs):
+            return self.submit(func, kwargs)
+        call.__name__ = name
+        call.__doc__ = func.__doc__
+        return call
+
+    def _run(self, queue):
+        stop = False
+        while not stop:
+            call = queue.get()
+            if call is None:
+                break
+            batch = [call]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    call = queue.get(True, remaining)
+                except Queue.Empty:
+                    break
+                if call is None:
+                    stop = True
+                    break
+                batch.append(call)
+            try:
+                self._flush(batch)
+            except Exception, e:
+                # keep the flusher alive for the calls queued after these
+                for call in batch:
+                    if not call.handle.ready():
+                        call.handle._set(error=e)
+
+    def _apply(self, conn, batch):
+        """
+        Run a batch in one transaction and commit it.
+
+        :return: The (status, res) or exception of every call, the held back
+                 result scopes, the held back usernames of recommend and the
+                 held back tag count changes
+        """
+        outcomes = []
+        proxy = _Savepoint(conn)
+        with results.deferred() as scopes:
+            with recommend.deferred() as unames:
+                with tag_index.deferred() as changes:
+                    for call in batch:
+                        proxy.begin()
+                        try:
+                            outcome = call.func(proxy, **call.argdict)
+                        except psy.DatabaseError, e:
+                            outcome = (DB_ERROR, None)
+                        except Exception, e:
+                            outcome = e
+                        # a call that failed without rolling back, or raised
+                        if isinstance(outcome, Exception) or outcome[0] != 0:
+                            proxy.rollback()
+                        else:
+                            proxy.commit()
+                        outcomes.append(outcome)
+                    conn.commit()
+        return outcomes, scopes, unames, changes
+
+    def _flush(self, batch):
+        start = time.time()
+        failed = False
+        try:
+            conn = self.pool.getconn()
+        except (psy.Error, db_pool.PoolTimeout), e:
+            for call in batch:
+                call.handle._set((DB_ERROR, None))
+            conn = None
+            failed = True
+        if conn is not None:
+            error = None
+            try:
+                try:
+                    outcomes, scopes, unames, changes = self._apply(conn, batch)
+                except psy.Error, e:
+                    failed = True
+                except Exception, e:
+                    failed = True
+                    error = e
+                if failed:
+                    try:
+                        conn.rollback()
+                    except psy.Error:
+                        pass
+                if not failed:
+                    results.invalidate(scopes)
+                    recommend.invalidate(unames)
+                    tag_index.update(changes)
+                    for call, outcome in zip(batch, outcomes):
+                        if isinstance(outcome, Exception):
+                            call.handle._set(error=outcome)
+                        else:
+                            call.handle._set(outcome)
+                elif conn.closed or error is not None:
+                    # whether the commit went through is unknown
+                    results.clear()
+                    recommend.clear()
+                    tag_index.clear()
+                    for call in batch:
+                        call.handle._set((DB_ERROR, None), error)
+                else:
+                    # nothing of the batch was applied
+                    for call in batch:
+                        _run_alone(conn, call)
+            finally:
+                self.pool.putconn(conn)
+        seconds = time.time() - start
+        with self._lock:
+            stats = self._stats
+            stats['batches'] += 1
+            stats['calls'] += len(batch)
+            stats['failed_batches'] += failed
+            stats['queue_time_total'] += sum(start - call.queued for call in batch)
+            stats['flush_time_total'] += seconds
+            stats['flush_time_max'] = max(stats['flush_time_max'], seconds)
+            self._sizes[bisect.bisect_left(BATCH_BUCKETS, len(batch))] += 1
+
+    def close(self):
+        """
+        Apply the queued calls and stop the flushers. The connection pool is
+        left open.
+        """
+        for queue in self._queues:
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        """
+        Get the queue counters
+
+        :return: A dict with the number of calls 'queued', 'rejected' by a full
+                 queue and 'waiting', the number of 'batches', 'calls' and
+                 'failed_batches' (whose calls were run one by one or failed),
+                 the average and maximum flush time in seconds, the average
+                 seconds a call waited in the queue, the average batch size and
+                 'batch_sizes', a list of (upper bound, batches)
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            sizes = list(self._sizes)
+        stats['waiting'] = sum(queue.qsize() for queue in self._queues)
+        batches = stats['batches']
+        stats['flush_time_avg'] = stats['flush_time_total'] / batches if batches else 0.0
+        stats['queue_time_avg'] = (stats['queue_time_total'] / stats['calls']
+                                   if stats['calls'] else 0.0)
+        stats['batch_size_avg'] = float(stats['calls']) / batches if batches else 0.0
+        stats['batch_sizes'] = zip(BATCH_BUCKETS + (float('inf'),), sizes)
+        return stats
+
+
+_writer = None
+
+
+def configure(pool=None, **kwargs):
+    """
+    Create the WriteBehind used by get_writer, flushing and stopping the
+    previous one if any. Takes the same arguments as WriteBehind.
+    """
+    global _writer
+    if _writer is not None:
+        _writer.close()
+    _writer = WriteBehind(pool, **kwargs)
+    return _writer
+
+
+def get_writer():
+    """
+    Get the WriteBehind set up by configure, creating one with default
+    settings on the pool used by pool.call_db if configure has not been called.
+    """
+    global _writer
+    if _writer is None:
+        _writer = WriteBehind()
+    return _writer